@@ -0,0 +1,79 @@
+# In-memory stand-ins for the discord.py objects that DiscogClient
+# touches: guilds, channels, messages, and slash-command interactions.
+# They implement only what the bot calls. Sent messages are counted
+# (and optionally kept) rather than going anywhere.
+
+import itertools
+
+_ids = itertools.count(1000)
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+
+class FakeAuthor:
+    def __init__(self, name='player'):
+        self.name = name
+
+class FakeMessage:
+    def __init__(self, content, channel=None, author=None, **kwargs):
+        self.id = next(_ids)
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild if channel else None
+        self.author = author
+        self.attachments = []
+        self.kwargs = kwargs
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+    async def pin(self):
+        pass
+
+class FakeChannel:
+    def __init__(self, guild, id, name=None, keep=False):
+        self.guild = guild
+        self.id = id
+        self.name = name or ('chan%d' % (id,))
+        self.keep = keep
+        self.sentcount = 0
+        self.sentbytes = 0
+        self.sent = []
+        self.messages = {}
+
+    async def send(self, content=None, **kwargs):
+        msg = FakeMessage(content, channel=self, **kwargs)
+        self.sentcount += 1
+        self.sentbytes += len(content or '')
+        if self.keep:
+            self.sent.append(content)
+            self.messages[msg.id] = msg
+        return msg
+
+    def get_partial_message(self, msgid):
+        msg = self.messages.get(msgid)
+        if msg is None:
+            msg = FakeMessage(None, channel=self)
+            msg.id = msgid
+        return msg
+
+class FakePermissions:
+    def __init__(self, administrator=False):
+        self.administrator = administrator
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send_message(self, content=None, **kwargs):
+        self.interaction.responses.append(content)
+
+class FakeInteraction:
+    def __init__(self, channel, user=None, administrator=False):
+        self.channel = channel
+        self.guild_id = channel.guild.id
+        self.user = user
+        self.permissions = FakePermissions(administrator)
+        self.response = FakeResponse(self)
+        self.responses = []
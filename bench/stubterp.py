@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# A stand-in interpreter for benchmarking. It speaks just enough of the
+# RemGlk JSON protocol to satisfy Discoggin: it accepts the same
+# arguments as glulxe (-singleturn, --autodir, --autorestore, etc), reads
+# an input event, and writes an update with one buffer window and a
+# one-line status window. In single-turn mode it exits after one event;
+# otherwise it keeps going until stdin closes.
+#
+# Its behavior is controlled by environment variables (which the bot
+# passes through to interpreters):
+#   BENCH_STUB_LATENCY: seconds to wait before replying (default 0)
+#   BENCH_STUB_OUTPUT: bytes of story text per turn (default 400)
+
+import sys
+import os, os.path
+import json
+import time
+
+def main():
+    args = sys.argv[1:]
+    singleturn = ('-singleturn' in args)
+    autodir = args[args.index('--autodir')+1]
+    latency = float(os.environ.get('BENCH_STUB_LATENCY', '0'))
+    outputsize = int(os.environ.get('BENCH_STUB_OUTPUT', '400'))
+
+    statepath = os.path.join(autodir, 'stubstate.json')
+    gen = 0
+    if '--autorestore' in args and os.path.exists(statepath):
+        with open(statepath) as fl:
+            gen = json.load(fl)['gen']
+
+    for ln in sys.stdin:
+        ln = ln.strip()
+        if not ln:
+            continue
+        event = json.loads(ln)
+        gen += 1
+        if latency:
+            time.sleep(latency)
+        write_update(gen, event, outputsize)
+        with open(statepath, 'w') as fl:
+            json.dump({ 'gen': gen }, fl)
+        if singleturn:
+            break
+
+def write_update(gen, event, outputsize):
+    val = event.get('value')
+    if val is None:
+        val = event.get('type')
+    text = 'You typed "%s". ' % (val,)
+    # Pad out to the requested size, in paragraphs of a few hundred
+    # characters.
+    paras = []
+    filler = 'The quick brown fox jumps over the lazy dog. '
+    while len(text) < outputsize:
+        text += filler
+        if len(text) >= 300:
+            paras.append(text)
+            outputsize -= len(text)
+            text = ''
+    if text or not paras:
+        paras.append(text)
+    update = {
+        'type': 'update', 'gen': gen,
+        'windows': [
+            { 'id': 1, 'type': 'buffer', 'rock': 0 },
+            { 'id': 2, 'type': 'grid', 'rock': 0, 'gridwidth': 40, 'gridheight': 1 },
+        ],
+        'content': [
+            { 'id': 1, 'text': [ { 'content': [ { 'style': 'normal', 'text': para } ] } for para in paras ] },
+            { 'id': 2, 'lines': [ { 'line': 0, 'content': [ { 'style': 'normal', 'text': 'Turn %d' % (gen,) } ] } ] },
+        ],
+        'input': [ { 'id': 1, 'type': 'line', 'gen': gen, 'maxlen': 256 } ],
+    }
+    sys.stdout.write(json.dumps(update))
+    sys.stdout.write('\n\n')
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# End-to-end throughput benchmark for Discoggin.
+#
+#   python3 bench/throughput.py --channels 1,4,16 --turns 20
+#
+# For each point in the sweep, this sets up a scratch directory and
+# database, installs a stub game whose "interpreter" is bench/stubterp.py,
+# and creates a DiscogClient. It never connects to Discord; channels,
+# messages, and interactions are the in-memory fakes in fakediscord.py.
+# Each channel starts its sessions (/newsession, /start) and then plays
+# turns by feeding ">look" messages to on_message(), one after another,
+# with all channels running at once. If there are several sessions per
+# channel, the channel switches between them with /select every turn.
+#
+# We report turns per second, the latency of each turn (from the message
+# arriving to the last reply going out), and how long the event loop
+# stalled (a watchdog task that wakes every few milliseconds measures
+# how late it is).
+
+import sys
+import os, os.path
+import time
+import shutil
+import tempfile
+import argparse
+import configparser
+import logging
+import asyncio
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchdir))
+
+from discoggin.client import DiscogClient
+from discoggin.schema import upgrade_schema
+from discoggin.games import create_game
+from discoggin.metrics import percentiles
+
+from fakediscord import FakeGuild, FakeChannel, FakeMessage, FakeAuthor, FakeInteraction
+
+GAMEHASH = 'bench0000'
+GAMEFILE = 'bench.ulx'
+
+popt = argparse.ArgumentParser(prog='bench/throughput.py')
+popt.add_argument('--channels', default='1,4,16',
+                  help='comma-separated list of channel counts to sweep (default 1,4,16)')
+popt.add_argument('--sessions', default='1',
+                  help='comma-separated list of sessions-per-channel counts to sweep (default 1)')
+popt.add_argument('--guilds', type=int, default=4,
+                  help='spread the channels across this many servers (default 4)')
+popt.add_argument('--turns', type=int, default=20,
+                  help='turns per channel (default 20)')
+popt.add_argument('--latency', type=float, default=0.0,
+                  help='stub interpreter delay per turn, in seconds (default 0)')
+popt.add_argument('--output', type=int, default=400,
+                  help='stub interpreter output per turn, in bytes (default 400)')
+popt.add_argument('--live', type=int, default=0,
+                  help='LiveProcesses setting (default 0)')
+popt.add_argument('--prespawn', type=int, default=0,
+                  help='PrespawnWindow setting (default 0)')
+popt.add_argument('--paced', action='store_true',
+                  help='keep the default Discord send pacing (normally turned off)')
+popt.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                  help='set any other config option')
+popt.add_argument('--stages', action='store_true',
+                  help='show the per-stage timing breakdown for each run')
+
+class StallMonitor:
+    """Wakes up every interval seconds and records how late it was.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.loop())
+
+    def stop(self):
+        self.task.cancel()
+
+    async def loop(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.monotonic() - start - self.interval))
+
+def make_config(basedir, args):
+    config = configparser.ConfigParser()
+    opts = config['DEFAULT']
+    opts['BotToken'] = 'none'
+    opts['LogFile'] = os.path.join(basedir, 'log.txt')
+    opts['DBFile'] = os.path.join(basedir, 'bench.db')
+    opts['InterpretersDir'] = os.path.join(basedir, 'terps')
+    opts['GamesDir'] = os.path.join(basedir, 'games')
+    opts['AutoSaveDir'] = os.path.join(basedir, 'autosaves')
+    opts['SaveFileDir'] = os.path.join(basedir, 'savefiles')
+    opts['LiveProcesses'] = str(args.live)
+    opts['PrespawnWindow'] = str(args.prespawn)
+    opts['ExpireDays'] = '0'
+    if not args.paced:
+        opts['ChannelSendRate'] = '100000'
+        opts['ChannelSendBurst'] = '100000'
+        opts['GlobalSendRate'] = '100000'
+    for val in args.set:
+        key, _, val = val.partition('=')
+        opts[key.strip()] = val.strip()
+    return config
+
+def make_tree(basedir):
+    """Create the directories, the stub game, and the wrapper which
+    runs stubterp.py as "glulxe".
+    """
+    for subdir in ('terps', 'games', 'autosaves', 'savefiles'):
+        os.mkdir(os.path.join(basedir, subdir))
+    os.mkdir(os.path.join(basedir, 'games', GAMEHASH))
+    with open(os.path.join(basedir, 'games', GAMEHASH, GAMEFILE), 'wb') as fl:
+        fl.write(b'Glul' + bytes(60))
+    terppath = os.path.join(basedir, 'terps', 'glulxe')
+    with open(terppath, 'w') as fl:
+        fl.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(benchdir, 'stubterp.py'),))
+    os.chmod(terppath, 0o755)
+
+async def run_point(args, numchannels, numsessions):
+    basedir = tempfile.mkdtemp(prefix='discoggin-bench-')
+    try:
+        make_tree(basedir)
+        config = make_config(basedir, args)
+        os.environ['BENCH_STUB_LATENCY'] = str(args.latency)
+        os.environ['BENCH_STUB_OUTPUT'] = str(args.output)
+
+        app = DiscogClient(config)
+        upgrade_schema(app.db, report=lambda msg: None)
+        create_game(app, GAMEHASH, GAMEFILE, 'file:bench', 'glulx')
+
+        guilds = [ FakeGuild(100+ix) for ix in range(max(1, args.guilds)) ]
+        channels = []
+        curs = app.db.cursor()
+        for ix in range(numchannels):
+            guild = guilds[ix % len(guilds)]
+            chan = FakeChannel(guild, 5000+ix)
+            channels.append(chan)
+            gckey = '%s-%s' % (guild.id, chan.id,)
+            curs.execute('INSERT INTO channels (gckey, gid, chanid, sessid) VALUES (?, ?, ?, ?)', (gckey, str(guild.id), str(chan.id), None))
+
+        await app.setup_hook()
+
+        # Create and start each channel's sessions.
+        chansessions = {}
+        for chan in channels:
+            gckey = '%s-%s' % (chan.guild.id, chan.id,)
+            ls = []
+            for _ in range(numsessions):
+                await app.on_cmd_newsession(FakeInteraction(chan), GAMEFILE)
+                await app.on_cmd_start(FakeInteraction(chan))
+                ls.append(app.objcache.channels[gckey].sessid)
+            chansessions[chan.id] = ls
+
+        author = FakeAuthor()
+        latencies = []
+        failures = 0
+        shedbefore = app.scheduler.stats()['shed']
+        app.metrics.histograms.clear()
+
+        async def play(chan):
+            nonlocal failures
+            sessls = chansessions[chan.id]
+            for turn in range(args.turns):
+                if len(sessls) > 1:
+                    await app.on_cmd_select(FakeInteraction(chan), str(sessls[turn % len(sessls)]))
+                sentbefore = chan.sentcount
+                start = time.monotonic()
+                await app.on_message(FakeMessage('>look', channel=chan, author=author))
+                latencies.append(time.monotonic() - start)
+                if chan.sentcount == sentbefore:
+                    failures += 1
+
+        monitor = StallMonitor()
+        monitor.start()
+        start = time.monotonic()
+        await asyncio.gather(*[ play(chan) for chan in channels ])
+        elapsed = time.monotonic() - start
+        monitor.stop()
+
+        res = {
+            'channels': numchannels,
+            'sessions': numsessions,
+            'turns': len(latencies),
+            'elapsed': elapsed,
+            'shed': app.scheduler.stats()['shed'] - shedbefore,
+            'failures': failures,
+            'sent': sum([ chan.sentcount for chan in channels ]),
+            'latency': percentiles(sorted(latencies)),
+            'stallmax': max(monitor.lags) if monitor.lags else 0.0,
+            'stalltotal': sum([ lag for lag in monitor.lags if lag > 0.001 ]),
+        }
+        if args.stages:
+            res['stages'] = [ (stage, app.metrics.summary('turn.'+stage)) for stage in app.metrics.turn_stages() ]
+
+        await app.close()
+        return res
+    finally:
+        shutil.rmtree(basedir, ignore_errors=True)
+
+def print_result(res, showstages=False):
+    (p50, p95, p99, pmax) = res['latency']
+    print('%4d %4d %6d %8.2f %9.1f %7.1f %7.1f %7.1f %7.1f %8.1f %8.1f %5d %5d' % (
+        res['channels'], res['sessions'], res['turns'], res['elapsed'],
+        res['turns'] / res['elapsed'],
+        p50*1000, p95*1000, p99*1000, pmax*1000,
+        res['stallmax']*1000, res['stalltotal']*1000,
+        res['shed'], res['failures'],))
+    if showstages:
+        for (stage, tup) in res['stages']:
+            if tup:
+                (count, s50, s95, s99, smax) = tup
+                print('        %-9s p50 %7.1f  p95 %7.1f  p99 %7.1f  max %7.1f ms' % (stage, s50*1000, s95*1000, s99*1000, smax*1000,))
+    sys.stdout.flush()
+
+async def main():
+    args = popt.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    chanls = [ int(val) for val in args.channels.split(',') ]
+    sessls = [ int(val) for val in args.sessions.split(',') ]
+
+    print('latency %.3fs, output %d bytes, live %d, prespawn %d, %s pacing' % (args.latency, args.output, args.live, args.prespawn, ('Discord' if args.paced else 'no'),))
+    print('chan sess  turns  elapsed  turns/sec  lat p50     p95     p99     max stallmax stalltot  shed  fail')
+    print('                      (s)               (ms)                                (ms)     (ms)')
+    for numchannels in chanls:
+        for numsessions in sessls:
+            res = await run_point(args, numchannels, numsessions)
+            print_result(res, args.stages)
+
+if __name__ == '__main__':
+    asyncio.run(main())
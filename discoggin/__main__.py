@@ -4,7 +4,7 @@ import argparse
 import configparser
 
 from .client import DiscogClient
-from .clifunc import cmd_createdb, cmd_addchannel, cmd_delchannel, cmd_delsession, cmd_delgame, cmd_cmdinstall
+from .clifunc import cmd_createdb, cmd_addchannel, cmd_delchannel, cmd_delsession, cmd_delgame, cmd_scangames, cmd_cmdinstall
 
 popt = argparse.ArgumentParser(prog='python -m discoggin')
 subopt = popt.add_subparsers(dest='cmd', title='commands')
@@ -35,6 +35,10 @@ pcmd = subopt.add_parser('delgame', help='delete a game')
 pcmd.add_argument('game')
 pcmd.set_defaults(cmdfunc=cmd_delgame)
 
+pcmd = subopt.add_parser('scangames', help='record file info for installed games')
+pcmd.add_argument('--all', action='store_true', help='rescan games which already have info')
+pcmd.set_defaults(cmdfunc=cmd_scangames)
+
 args = popt.parse_args()
 
 config = configparser.ConfigParser()
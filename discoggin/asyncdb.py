@@ -0,0 +1,256 @@
+import functools
+import asyncio
+import concurrent.futures
+
+from . import sessions
+from . import games
+from . import schema
+
+class DBThread:
+    """A dedicated thread for database access.
+    The bot never touches app.db on the event loop; it hands each query
+    to this thread and awaits the result. There is just one worker,
+    so database calls are serialized just as they were when everything
+    ran on the loop.
+    (The command-line functions still call the sessions/games functions
+    directly. They don't run an event loop.)
+    """
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='discoggin-db')
+
+    async def run(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) on the database thread and return
+        the result (or raise its exception).
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def _dbcall(func):
+    """Wrap a synchronous accessor (which takes app as its first argument)
+    as a coroutine which runs it on app.dbthread.
+    """
+    @functools.wraps(func)
+    async def wrapper(app, *args, **kwargs):
+        return await app.dbthread.run(func, app, *args, **kwargs)
+    return wrapper
+
+# These don't use the object cache.
+get_sessions = _dbcall(sessions.get_sessions)
+get_sessions_for_server = _dbcall(sessions.get_sessions_for_server)
+get_sessions_for_hash = _dbcall(sessions.get_sessions_for_hash)
+get_available_session_for_hash = _dbcall(sessions.get_available_session_for_hash)
+get_playchannels = _dbcall(sessions.get_playchannels)
+get_playchannels_for_server = _dbcall(sessions.get_playchannels_for_server)
+get_gamelist = _dbcall(games.get_gamelist)
+get_gamemap = _dbcall(games.get_gamemap)
+get_expired_sessions = _dbcall(sessions.get_expired_sessions)
+get_server_usage = _dbcall(sessions.get_server_usage)
+get_orphan_games = _dbcall(games.get_orphan_games)
+
+async def get_data_version(app):
+    return await app.dbthread.run(schema.get_data_version, app.db)
+
+async def check_data_version(app):
+    """If another process (the command-line tool) has changed the
+    database since the object cache was loaded, reload it.
+    """
+    version = await get_data_version(app)
+    if version != app.objcache.dataversion:
+        await app.cache_playchannels()
+
+# Game lookups by name go through app.catalog.
+
+async def get_game_by_name(app, val):
+    """Find the game which a name (or hash) identifies, or None if it
+    matches no game or more than one equally well.
+    """
+    await check_data_version(app)
+    return app.catalog.find(val)
+
+async def search_games(app, val, limit=25):
+    """Return a list of games matching val, best first.
+    """
+    return app.catalog.search(val, limit=limit)
+
+# The rest go through app.objcache.
+
+async def get_session_by_id(app, sessid):
+    """Get one session by ID (or None).
+    """
+    try:
+        sessid = int(sessid)
+    except:
+        return None
+    session = app.objcache.sessions.get(sessid)
+    if session is not None:
+        return session
+    session = await app.dbthread.run(sessions.get_session_by_id, app, sessid)
+    if session is not None:
+        app.objcache.add_session(session)
+    return session
+
+async def create_session(app, game, gid):
+    """Create a new session for a game on a server.
+    """
+    session = await app.dbthread.run(sessions.create_session, app, game, gid)
+    app.objcache.add_session(session)
+    return session
+
+async def update_session_movecount(app, session, movecount=None, statusmarkup=None, usage=None):
+    """Update the movecount and current time (and optionally the status
+    line and disk usage) for a session. The Session object (and the
+    cached one, if that's different) is updated too.
+    """
+    (movecount, lastupdate) = await app.dbthread.run(sessions.update_session_movecount, app, session, movecount, statusmarkup, usage)
+    for obj in (session, app.objcache.sessions.get(session.sessid)):
+        if obj is not None:
+            obj.movecount = movecount
+            obj.lastupdate = lastupdate
+            if statusmarkup is not None:
+                obj.statusmarkup = statusmarkup
+            if usage is not None:
+                (obj.autosavebytes, obj.savefilebytes) = usage
+
+async def set_session_usage(app, session, usage):
+    """Record a session's disk usage. The Session object (and the cached
+    one, if that's different) is updated too.
+    """
+    await app.dbthread.run(sessions.set_session_usage, app, session, usage)
+    for obj in (session, app.objcache.sessions.get(session.sessid)):
+        if obj is not None:
+            (obj.autosavebytes, obj.savefilebytes) = usage
+
+async def clear_session_statusmarkup(app, session):
+    """Forget the recorded status line for a session.
+    """
+    await app.dbthread.run(sessions.clear_session_statusmarkup, app, session)
+    for obj in (session, app.objcache.sessions.get(session.sessid)):
+        if obj is not None:
+            obj.statusmarkup = None
+
+async def get_playchannel(app, gckey):
+    """Get one channel by ID (or None).
+    """
+    playchan = app.objcache.get_channel(gckey)
+    if playchan is not None:
+        return playchan
+    return await app.dbthread.run(sessions.get_playchannel, app, gckey)
+
+async def get_playchannel_for_session(app, sessid):
+    """Get the channel playing a given session, by session ID.
+    If no channel is playing that session, return None.
+    """
+    return app.objcache.get_channel_for_session(sessid)
+
+async def set_channel_session(app, playchan, session):
+    """Set the current session for a given channel.
+    """
+    await app.dbthread.run(sessions.set_channel_session, app, playchan, session)
+    app.objcache.set_channel_session(playchan.gckey, session.sessid)
+    playchan.sessid = session.sessid
+    playchan.session = session
+    playchan.game = None
+
+async def set_channel_statusmsg(app, playchan, msgid):
+    """Record the tracked status message for a channel.
+    """
+    await app.dbthread.run(sessions.set_channel_statusmsg, app, playchan, msgid)
+    app.objcache.set_channel_statusmsg(playchan.gckey, msgid)
+    playchan.statusmsgid = msgid
+
+async def get_game_by_hash(app, hash):
+    game = app.objcache.games.get(hash)
+    if game is not None:
+        return game
+    game = await app.dbthread.run(games.get_game_by_hash, app, hash)
+    if game is not None:
+        app.objcache.add_game(game)
+    return game
+
+async def get_game_by_session(app, sessid):
+    session = await get_session_by_id(app, sessid)
+    if not session:
+        return None
+    return await get_game_by_hash(app, session.hash)
+
+async def get_game_by_channel(app, gckey):
+    playchan = await get_playchannel(app, gckey)
+    if not playchan:
+        return None
+    if not playchan.sessid:
+        return None
+    return await get_game_by_session(app, playchan.sessid)
+
+async def create_game(app, hash, filename, url, format, info=None):
+    game = await app.dbthread.run(games.create_game, app, hash, filename, url, format, info)
+    app.objcache.add_game(game)
+    app.catalog.add(game)
+    return game
+
+async def delete_game(app, hash):
+    await app.dbthread.run(games.delete_game, app, hash)
+    app.objcache.delete_game(hash)
+    app.catalog.remove(hash)
+
+async def delete_expired_session(app, sessid, cutoff):
+    """Delete an expired session's database row (see
+    sessions.delete_expired_session). Returns whether it was deleted.
+    """
+    res = await app.dbthread.run(sessions.delete_expired_session, app, sessid, cutoff)
+    if res:
+        app.objcache.delete_session(sessid)
+    return res
+
+async def delete_orphan_game(app, hash):
+    """Delete an orphaned game's database rows (see
+    games.delete_orphan_game). Returns whether it was deleted.
+    """
+    res = await app.dbthread.run(games.delete_orphan_game, app, hash)
+    if res:
+        app.objcache.delete_game(hash)
+        app.catalog.remove(hash)
+    return res
+
+async def get_valid_playchannel(app, interaction=None, message=None, withgame=False):
+    """Awaitable version of sessions.get_valid_playchannel().
+    This does the fast rejection check without touching the database.
+    Otherwise, in the common case, the channel comes from the object
+    cache and the only database access is the data_version check.
+    (A channel newly enabled by the command-line tool is not seen until
+    something else reloads the cache, such as /channels.)
+    If withgame is false, the session and game are not loaded; call
+    hydrate_playchannel() to get them later.
+    """
+    tup = sessions.playchannel_key(interaction=interaction, message=message)
+    if not tup:
+        return None
+    (gckey, channame) = tup
+    if gckey not in app.playchannels:
+        return None
+    await check_data_version(app)
+    if gckey not in app.playchannels:
+        # Disabled by the command-line tool.
+        return None
+    playchan = await get_playchannel(app, gckey)
+    if not playchan:
+        return None
+    if channame:
+        playchan.channame = channame
+    if withgame:
+        await hydrate_playchannel(app, playchan)
+    return playchan
+
+async def hydrate_playchannel(app, playchan, withgame=True):
+    """Fill in the session (and, if withgame is true, the game) of
+    a PlayChannel.
+    """
+    if not playchan.sessid:
+        return
+    if playchan.session is None:
+        playchan.session = await get_session_by_id(app, playchan.sessid)
+    if withgame and playchan.game is None:
+        if playchan.session and playchan.session.hash:
+            playchan.game = await get_game_by_hash(app, playchan.session.hash)
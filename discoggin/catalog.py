@@ -0,0 +1,160 @@
+import re
+
+# Fuzzy matches below this similarity are ignored.
+MIN_SIMILARITY = 0.3
+
+# How well a name matches a query, best first.
+RANK_EXACT = 3
+RANK_PREFIX = 2
+RANK_SUBSTRING = 1
+RANK_SIMILAR = 0
+
+# Filenames are matched without case or punctuation.
+pat_nonword = re.compile(r'[^a-z0-9]+')
+
+def normalize_name(val):
+    return pat_nonword.sub(' ', val.lower()).strip()
+
+def trigrams(val):
+    """The set of trigrams in a normalized name. Each word is padded
+    with spaces, so that word beginnings and endings count.
+    """
+    res = set()
+    for word in val.split():
+        word = '  ' + word + ' '
+        for ix in range(len(word)-2):
+            res.add(word[ix:ix+3])
+    return res
+
+class CatalogEntry:
+    def __init__(self, game):
+        self.game = game
+        self.lname = game.filename.lower()
+        self.norm = normalize_name(game.filename)
+        self.trigrams = trigrams(self.norm)
+
+class GameCatalog:
+    """An in-memory index of installed games, for looking them up by
+    name. Names are indexed by trigram; a lookup scores the games which
+    share trigrams with the query, rather than scanning them all.
+    The bot loads this at startup and keeps it up to date as games are
+    installed and deleted (see asyncdb.py). Like the object cache, it
+    won't see changes made by the command-line tool until it's reloaded.
+    """
+    def __init__(self):
+        self.entries = {}   # hash to CatalogEntry
+        self.index = {}     # trigram to set of hashes
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, gamels):
+        self.entries.clear()
+        self.index.clear()
+        for game in gamels:
+            self.add(game)
+
+    def add(self, game):
+        if game.hash in self.entries:
+            self.remove(game.hash)
+        ent = CatalogEntry(game)
+        self.entries[game.hash] = ent
+        for tri in ent.trigrams:
+            self.index.setdefault(tri, set()).add(game.hash)
+
+    def remove(self, hash):
+        ent = self.entries.pop(hash, None)
+        if ent is None:
+            return
+        for tri in ent.trigrams:
+            hashes = self.index.get(tri)
+            if hashes is not None:
+                hashes.discard(hash)
+                if not hashes:
+                    del self.index[tri]
+
+    def games(self):
+        """All the games, sorted by filename.
+        """
+        ls = [ ent.game for ent in self.entries.values() ]
+        ls.sort(key=lambda game: game.filename.lower())
+        return ls
+
+    def search(self, val, limit=25):
+        """Return a list of games matching val, best first.
+        An exact hash or filename comes first, then names starting with
+        val, then names containing it, then names which are merely
+        similar (sharing enough trigrams).
+        """
+        return [ game for (rank, game) in self.ranked(val, limit) ]
+
+    def ranked(self, val, limit=25):
+        """Like search(), but return a list of (rank, game). The rank is
+        RANK_EXACT, RANK_PREFIX, RANK_SUBSTRING, or RANK_SIMILAR.
+        """
+        val = val.strip()
+        if not val:
+            return [ (RANK_SIMILAR, game) for game in self.games()[ : limit ] ]
+        ent = self.entries.get(val)
+        if ent is not None:
+            return [ (RANK_EXACT, ent.game) ]
+
+        lval = val.lower()
+        norm = normalize_name(val)
+        qtris = trigrams(norm)
+
+        # A name containing the query contains the (unpadded) trigrams
+        # of each of its words, at least for words of three letters or
+        # more. So the candidates are the games which share trigrams
+        # with every long word. If there are no long words, look at
+        # everything.
+        candidates = None
+        for word in norm.split():
+            if len(word) < 3:
+                continue
+            hashes = set()
+            for ix in range(len(word)-2):
+                hashes.update(self.index.get(word[ix:ix+3], ()))
+            if candidates is None:
+                candidates = hashes
+            else:
+                candidates &= hashes
+        if candidates is None:
+            candidates = self.entries.keys()
+
+        scored = []
+        for hash in candidates:
+            ent = self.entries[hash]
+            if ent.lname == lval:
+                rank = RANK_EXACT
+            elif ent.lname.startswith(lval) or (norm and ent.norm.startswith(norm)):
+                rank = RANK_PREFIX
+            elif lval in ent.lname or (norm and norm in ent.norm):
+                rank = RANK_SUBSTRING
+            else:
+                rank = RANK_SIMILAR
+            count = len(qtris & ent.trigrams)
+            similarity = count / (len(qtris) + len(ent.trigrams) - count) if count else 0.0
+            if rank == RANK_SIMILAR and similarity < MIN_SIMILARITY:
+                continue
+            scored.append( (-rank, -similarity, len(ent.lname), ent.lname, ent.game) )
+        scored.sort(key=lambda tup: tup[:4])
+        return [ (-tup[0], tup[-1]) for tup in scored[ : limit ] ]
+
+    def find(self, val):
+        """Return the game which val identifies, or None. This must be an
+        exact hash or filename, or else the only best match among the
+        names starting with (or containing) val. A merely similar name
+        doesn't count; neither does a tie.
+        """
+        ls = self.ranked(val, limit=2)
+        if not ls:
+            return None
+        (rank, game) = ls[0]
+        if rank == RANK_EXACT:
+            return game
+        if rank == RANK_SIMILAR:
+            return None
+        if len(ls) > 1 and ls[1][0] == rank:
+            return None
+        return game
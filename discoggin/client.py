@@ -1,42 +1,60 @@
 import os, os.path
+import io
 import time
 import json
-import collections
 import logging
 import sqlite3
 import asyncio
 import asyncio.subprocess
-import aiohttp
 
 import discord
 import discord.app_commands
 
-from .markup import extract_command, content_to_markup, rebalance_output, escape
+from .markup import extract_command, content_to_markup, rebalance_output, split_markup, escape, MSG_LIMIT
 from .games import GameFile
-from .games import get_gamelist, get_gamemap, get_game_by_name, get_game_by_hash, get_game_by_channel
 from .games import download_game_url
+from .downloads import DownloadManager
 from .games import format_interpreter_args
-from .sessions import get_sessions, get_session_by_id, get_sessions_for_server, get_available_session_for_hash, create_session, set_channel_session, update_session_movecount
-from .sessions import get_playchannels, get_playchannels_for_server, get_valid_playchannel, get_playchannel_for_session
+from .asyncdb import DBThread, get_data_version
+from .asyncdb import get_gamelist, get_gamemap, get_game_by_name, search_games, get_game_by_hash, get_game_by_channel
+from .asyncdb import get_session_by_id, get_sessions_for_server, get_available_session_for_hash, create_session, set_channel_session, update_session_movecount, clear_session_statusmarkup, set_channel_statusmsg
+from .asyncdb import get_playchannels, get_playchannels_for_server, get_valid_playchannel, get_playchannel_for_session, hydrate_playchannel
+from .objcache import ObjCache
+from .catalog import GameCatalog
+from .schema import SCHEMA_VERSION, get_schema_version
 from .glk import create_metrics
-from .glk import parse_json
 from .glk import ContentLine
-from .glk import GlkState, get_glkstate_for_session, put_glkstate_for_session
-from .glk import stanza_reader, stanza_is_transcript, storywindat_from_stanza
+from .glk import GlkState, GlkStateCache, get_glkstate_for_session, put_glkstate_for_session
+from .glk import storywindat_from_stanza
+from .transcript import TranscriptWriter
 from .attlist import AttachList
+from .util import FileSyncer
+from .procpool import ProcPool, Prespawner, kill_proc
+from .procpool import run_single_turn, OutputTooLarge, InvalidOutput
+from .outbound import OutboundScheduler
+from .reaper import Reaper
+from .usage import UsageTracker, format_bytes
+from .metrics import Metrics, MetricsServer, TurnTimer
+from .scheduler import TurnScheduler, SchedulerBusy, parse_weights
 
 _appcmds = []
 
-def appcmd(name, description, argdesc=None):
+def appcmd(name, description, argdesc=None, autocomplete=None, admin=False):
     """A decorator for slash commands.
     The discord module provides such a decorator but I don't like it.
     I wrote this one instead.
+    The autocomplete argument maps argument names to the names of
+    autocomplete methods. If admin is true, the command is only offered
+    to server administrators.
     """
     def decorator(func):
-        _appcmds.append( (func.__name__, name, description, argdesc) )
+        _appcmds.append( (func.__name__, name, description, argdesc, autocomplete, admin) )
         return func
     return decorator
 
+# Size of the preview message sent along with an output attachment.
+ATTACH_PREVIEW = 400
+
 class DiscogClient(discord.Client):
     """Our Discord client class.
     """
@@ -60,6 +78,45 @@ class DiscogClient(discord.Client):
         super().__init__(intents=intents)
 
         self.playchannels = set()  # of gckeys
+        self.objcache = ObjCache()
+        self.catalog = GameCatalog()
+
+        # Recently-used GlkStates. The limit is the total size of their
+        # JSON files. Zero disables the cache.
+        glkstatecachesize = config['DEFAULT'].getint('GlkStateCacheBytes', 16000000)
+        self.glkstates = GlkStateCache(maxbytes=glkstatecachesize)
+
+        # When to fsync GlkState files: none, always, or batch.
+        syncmode = config['DEFAULT'].get('GlkStateSync', 'none')
+        syncinterval = config['DEFAULT'].getint('GlkStateSyncInterval', 5)
+        self.filesyncer = FileSyncer(mode=syncmode, interval=syncinterval)
+
+        # Transcript stanzas are buffered and written in batches.
+        # Transcripts are rotated out (and gzipped) at TranscriptSegmentBytes;
+        # zero means they grow forever.
+        segmentbytes = config['DEFAULT'].getint('TranscriptSegmentBytes', 4000000)
+        flushinterval = config['DEFAULT'].getint('TranscriptFlushInterval', 1)
+        maxpending = config['DEFAULT'].getint('TranscriptBufferBytes', 262144)
+        self.transcripts = TranscriptWriter(segmentbytes=segmentbytes, interval=flushinterval, maxpending=maxpending)
+
+        # Disk usage accounting. Quotas of zero mean no limit.
+        sessionquota = config['DEFAULT'].getint('SessionQuotaBytes', 0)
+        serverquota = config['DEFAULT'].getint('ServerQuotaBytes', 0)
+        self.usage = UsageTracker(self, sessionquota=sessionquota, serverquota=serverquota)
+
+        # Discards sessions (and then games) not played for ExpireDays.
+        # Zero disables this.
+        expiredays = config['DEFAULT'].getint('ExpireDays', 30)
+        reapinterval = config['DEFAULT'].getint('ReapInterval', 3600)
+        reapbatch = config['DEFAULT'].getint('ReapBatchSize', 20)
+        reappause = config['DEFAULT'].getfloat('ReapBatchPause', 1.0)
+        self.reaper = Reaper(self, maxdays=expiredays, interval=reapinterval, batchsize=reapbatch, pause=reappause)
+        # Timing histograms for turns, and optionally a local HTTP
+        # endpoint which serves them (with the other statistics).
+        self.metrics = Metrics()
+        metricsport = config['DEFAULT'].getint('MetricsPort', 0)
+        self.metricsserver = MetricsServer(self, metricsport) if metricsport else None
+
         self.inflight = set()  # of session ids
         self.attachments = AttachList()
 
@@ -67,51 +124,187 @@ class DiscogClient(discord.Client):
         self.tree = discord.app_commands.CommandTree(self)
 
         # Add all the slash commands noted by the @appcmd decorator.
-        for (key, name, description, argdesc) in _appcmds:
+        for (key, name, description, argdesc, autocomplete, admin) in _appcmds:
             callback = getattr(self, key)
             cmd = discord.app_commands.Command(name=name, callback=callback, description=description)
             if argdesc:
                 for akey, adesc in argdesc.items():
                     cmd._params[akey].description = adesc
+            if autocomplete:
+                for akey, methname in autocomplete.items():
+                    cmd.autocomplete(akey)(getattr(self, methname))
+            if admin:
+                cmd.default_permissions = discord.Permissions(administrator=True)
             self.tree.add_command(cmd)
 
         # Our async HTTP client session.
         # We will set this up in setup_hook.
         self.httpsession = None
 
-        # Open the sqlite database.
-        self.db = sqlite3.connect(self.dbfile)
+        # Downloads go through this, which limits their size and merges
+        # duplicate requests.
+        maxdownload = config['DEFAULT'].getint('MaxDownloadBytes', 64000000)
+        self.downloads = DownloadManager(maxbytes=maxdownload)
+
+        # Open the sqlite database. When the bot is running, all access
+        # goes through the database thread (see asyncdb.py), so the
+        # connection must be usable from there.
+        self.db = sqlite3.connect(self.dbfile, check_same_thread=False)
         self.db.isolation_level = None   # autocommit
+        self.dbthread = DBThread()
+
+        # Most output an interpreter may produce in one turn. Beyond
+        # this, it's killed.
+        self.maxoutput = config['DEFAULT'].getint('MaxOutputBytes', 4000000)
+
+        # Live interpreter processes, for persistent mode. If LiveProcesses
+        # is zero (the default), every turn launches a fresh interpreter.
+        maxprocs = config['DEFAULT'].getint('LiveProcesses', 0)
+        idletimeout = config['DEFAULT'].getint('LiveIdleTimeout', 300)
+        self.procpool = ProcPool(self, maxprocs=maxprocs, idletimeout=idletimeout)
+
+        # Pre-spawned interpreters waiting for a session's next command.
+        # Zero (the default) disables this.
+        prespawnwindow = config['DEFAULT'].getint('PrespawnWindow', 0)
+        self.prespawner = Prespawner(self, window=prespawnwindow)
+
+        # Limits on how many interpreters run at once, and how many turns
+        # may wait for one.
+        maxrunning = config['DEFAULT'].getint('MaxInterpreters', os.cpu_count() or 4)
+        maxqueued = config['DEFAULT'].getint('MaxQueuedTurns', 32)
+        maxguildqueued = config['DEFAULT'].getint('MaxQueuedTurnsPerServer', 8)
+        weights = parse_weights(config['DEFAULT'].get('ServerWeights', ''))
+        self.scheduler = TurnScheduler(maxrunning=maxrunning, maxqueued=maxqueued, maxguildqueued=maxguildqueued, weights=weights)
+        # Pre-spawned interpreters hold scheduler slots, but give them
+        # up when a real turn needs one.
+        self.scheduler.reclaimer = self.prespawner.reclaim
 
-    async def print_lines(self, outls, chan, prefix=None):
+        # Pacing for messages we send to channels: a per-channel token
+        # bucket and a global one.
+        chanrate = config['DEFAULT'].getfloat('ChannelSendRate', 1.0)
+        chanburst = config['DEFAULT'].getint('ChannelSendBurst', 5)
+        globalrate = config['DEFAULT'].getfloat('GlobalSendRate', 40.0)
+        self.outbound = OutboundScheduler(chanrate=chanrate, chanburst=chanburst, globalrate=globalrate, globalburst=max(1, int(globalrate)))
+
+        # If some output would take more than this many messages, send
+        # it as an attached file instead. Zero means never.
+        self.attachthreshold = config['DEFAULT'].getint('AttachOutputMessages', 0)
+
+        # Status line display: "none" sends a new message each time;
+        # "edit" keeps one status message per channel and edits it;
+        # "pin" does that and pins the message too.
+        self.statusmode = config['DEFAULT'].get('StatusMessage', 'none')
+        if self.statusmode == 'none':
+            self.statusmode = None
+        elif self.statusmode not in ('edit', 'pin'):
+            raise Exception('StatusMessage must be none, edit, or pin')
+        # Maps gckey to the text of the tracked status message, so we
+        # don't edit it when nothing has changed.
+        self.statustexts = {}
+
+    async def print_lines(self, outls, chan, prefix=None, wait=True):
         """Print a bunch of lines (paragraphs) to the Discord channel.
         They should already be formatted in Discord markup.
         Add prefix if provided.
+        The messages go through the outbound scheduler, which paces them.
+        If wait is false, we queue them and return immediately. (They
+        will still go out in order, and may be combined with whatever
+        is queued next.)
         ### the prefix must be shorter than the safety margin
         """
+        starttime = time.monotonic()
         # Optimize to fit in the fewest number of Discord messages.
+        fullls = outls
         outls = rebalance_output(outls)
 
-        first = True
+        if self.attachthreshold and len(outls) > self.attachthreshold:
+            # Too many messages. Send a preview, with everything as an
+            # attached file.
+            preview = outls[0]
+            if len(preview) > ATTACH_PREVIEW:
+                (preview, _) = split_markup(preview, ATTACH_PREVIEW)
+            preview += '\n(%d messages\' worth of output; see attachment)' % (len(outls),)
+            if prefix:
+                preview = prefix+preview
+            dat = '\n'.join(fullls).encode()
+            fileobj = discord.File(io.BytesIO(dat), filename='output.md')
+            self.outbound.post(chan, preview, file=fileobj)
+            outls = []
+
         for out in outls:
-            if not first:
-                # Short sleep to avoid rate-limiting.
-                await asyncio.sleep(0.25)
             if prefix:
                 out = prefix+out
-            await chan.send(out)
-            first = False
+            self.outbound.post(chan, out)
+        gid = str(chan.guild.id) if getattr(chan, 'guild', None) else None
+        self.metrics.observe('print_lines', time.monotonic() - starttime, gid=gid)
+        if wait:
+            await self.outbound.drain(chan)
+
+    async def show_status(self, chan, playchan, outls, wait=True):
+        """Display the status line (a list of Discord markup strings)
+        for a channel. Returns whether anything was displayed.
+        Normally this just prints the lines. In StatusMessage mode, we
+        edit the channel's tracked status message instead -- but only if
+        the text has changed -- or post one if the channel doesn't have
+        one yet.
+        """
+        if not self.statusmode:
+            await self.print_lines(outls, chan, '|\n', wait=wait)
+            return sum([ len(out) for out in outls ]) > 4
+
+        text = '\n'.join([ out.rstrip() for out in outls ]).strip()
+        if not text:
+            return False
+        text = '|\n' + text
+        if len(text) >= MSG_LIMIT:
+            (text, _) = split_markup(text, MSG_LIMIT)
+        if playchan.statusmsgid and self.statustexts.get(playchan.gckey) == text:
+            return False
+
+        if playchan.statusmsgid:
+            try:
+                await chan.get_partial_message(playchan.statusmsgid).edit(content=text)
+                self.statustexts[playchan.gckey] = text
+                return True
+            except discord.NotFound:
+                # Somebody deleted it. We'll post a new one.
+                pass
+            except discord.HTTPException as ex:
+                playchan.logger().warning('Failed to edit status message: %s', ex)
+                return False
+
+        msg = await self.outbound.send(chan, text, coalesce=False)
+        await set_channel_statusmsg(self, playchan, msg.id)
+        self.statustexts[playchan.gckey] = text
+        if self.statusmode == 'pin':
+            try:
+                await msg.pin()
+            except discord.HTTPException as ex:
+                playchan.logger().warning('Failed to pin status message: %s', ex)
+        return True
 
     async def setup_hook(self):
         """Called when the client is starting up. We have not yet connected
         to Discord, but we have entered the async regime.
         """
+        version = await self.dbthread.run(get_schema_version, self.db)
+        if version != SCHEMA_VERSION:
+            self.logger.error('Database schema is version %d; expected %d', version, SCHEMA_VERSION)
+            raise Exception('database schema is out of date; run "python -m discoggin createdb"')
+
         # Create the HTTP session, which must happen inside the async
         # event loop.
         headers = { 'user-agent': 'Discoggin-IF-Terp' }
-        self.httpsession = aiohttp.ClientSession(headers=headers)
+        self.httpsession = self.downloads.create_session(headers=headers)
+
+        await self.cache_playchannels()
 
-        self.cache_playchannels()
+        self.procpool.start()
+        self.filesyncer.start()
+        self.transcripts.start()
+        self.reaper.start()
+        if self.metricsserver:
+            await self.metricsserver.start()
         
         if self.cmdsync:
             # Push our slash commands to Discord. We only need to do
@@ -129,14 +322,24 @@ class DiscogClient(discord.Client):
         finalize resources.
         """
         self.logger.warning('Shutting down...')
+
+        self.prespawner.close()
+        await self.procpool.close()
+        self.reaper.close()
+        if self.metricsserver:
+            await self.metricsserver.close()
+        await self.outbound.close()
+        await self.transcripts.close()
+        await self.filesyncer.close()
         
         if self.httpsession:
             await self.httpsession.close()
             self.httpsession = None
 
         if self.db:
-            self.db.close()
+            await self.dbthread.run(self.db.close)
             self.db = None
+        self.dbthread.close()
             
         await super().close()
         
@@ -146,14 +349,85 @@ class DiscogClient(discord.Client):
         """
         self.logger.info('Logged in as %s', self.user)
 
-    def cache_playchannels(self):
+    def discard_session_procs(self, sessid):
+        """Shut down any live or pre-spawned interpreter for a session.
+        Call this whenever the session's state changes other than by
+        a normal turn, so that no process runs against stale state.
+        (This also nudges the transcript writer, since a session switch
+        is a natural point to get buffered stanzas onto disk.)
+        """
+        if sessid is None:
+            return
+        self.procpool.discard(sessid)
+        self.prespawner.discard(sessid)
+        self.transcripts.flush_soon()
+
+    def gather_gauges(self):
+        """Collect the current statistics from the scheduler, outbound
+        queue, reaper, and caches, as a flat dict of numbers.
+        """
+        res = {}
+        for (key, val) in self.scheduler.stats().items():
+            res['scheduler_'+key] = val
+        for (key, val) in self.outbound.stats().items():
+            res['outbound_'+key] = val
+        res['reaper_sweeps'] = self.reaper.sweeps
+        res['reaper_sessions'] = self.reaper.sessionsreaped
+        res['reaper_games'] = self.reaper.gamesreaped
+        res['reaper_bytes'] = self.reaper.bytesreclaimed
+        res['glkstate_cache_bytes'] = self.glkstates.totalbytes
+        res['transcript_pending_bytes'] = self.transcripts.pendingbytes
+        res['inflight'] = len(self.inflight)
+        return res
+
+    def get_status_markup(self, session):
+        """Return the status line of a session, as a list of Discord
+        markup strings. This is normally recorded in the session itself;
+        if not (an older session), we fall back to the GlkState. Returns
+        None if the game has never run (or was force-quit).
+        """
+        if session.statusmarkup is not None:
+            return session.statusmarkup
+        glkstate = get_glkstate_for_session(self, session)
+        if glkstate is None:
+            return None
+        return glkstate.statusmarkup
+
+    async def cache_playchannels(self):
         """Grab the list of valid playchannels and store it in memory.
-        We will use this for fast channel-checking.
+        We will use this for fast channel-checking. This also resets
+        the object cache.
         """
-        ls = get_playchannels(self)
+        # Read the stamp first, so that a change made while we're
+        # loading is caught next time.
+        self.objcache.dataversion = await get_data_version(self)
+        ls = await get_playchannels(self)
+        self.objcache.set_channels(ls)
+        self.catalog.load(await get_gamelist(self))
+        self.usage.forget()
         self.playchannels.clear()
         for chan in ls:
             self.playchannels.add(chan.gckey)
+
+    async def autocomplete_game(self, interaction, current):
+        """Autocomplete handler for game-name arguments.
+        """
+        gamels = await search_games(self, current, limit=25)
+        # Choice names and values are limited to 100 characters.
+        return [ discord.app_commands.Choice(name=game.filename[:100], value=game.filename[:100]) for game in gamels ]
+        
+    async def respond_game_not_found(self, interaction, gamearg):
+        """Respond to a game name which doesn't pick out a single game.
+        If it's ambiguous (or close to some names), list the candidates.
+        """
+        gamels = await search_games(self, gamearg, limit=10)
+        if not gamels:
+            await interaction.response.send_message('Game not found: "%s"' % (gamearg,))
+            return
+        ls = [ 'No single game matches "%s". Did you mean:' % (gamearg,) ]
+        for game in gamels:
+            ls.append('- %s' % (game.filename,))
+        await interaction.response.send_message('\n'.join(ls))
         
     # Slash command implementations.
         
@@ -161,7 +435,7 @@ class DiscogClient(discord.Client):
     async def on_cmd_start(self, interaction):
         """/start
         """
-        playchan = get_valid_playchannel(self, interaction=interaction, withgame=True)
+        playchan = await get_valid_playchannel(self, interaction=interaction, withgame=True)
         if not playchan:
             await interaction.response.send_message('Discoggin does not play games in this channel.')
             return
@@ -179,7 +453,7 @@ class DiscogClient(discord.Client):
             return
         self.inflight.add(playchan.sessid)
         try:
-            await self.run_turn(None, interaction.channel, playchan, None)
+            await self.run_turn(None, interaction.channel, playchan, None, timer=TurnTimer())
         finally:
             self.inflight.discard(playchan.sessid)
     
@@ -187,7 +461,7 @@ class DiscogClient(discord.Client):
     async def on_cmd_stop(self, interaction):
         """/forcequit
         """
-        playchan = get_valid_playchannel(self, interaction=interaction, withgame=True)
+        playchan = await get_valid_playchannel(self, interaction=interaction, withgame=True)
         if not playchan:
             await interaction.response.send_message('Discoggin does not play games in this channel.')
             return
@@ -202,14 +476,16 @@ class DiscogClient(discord.Client):
         # exit flag. This lets us recover from a corrupted GlkState or
         # autosave entry.
         playchan.logger().info('game force-quit')
+        self.discard_session_procs(playchan.sessid)
         put_glkstate_for_session(self, playchan.session, None)
+        await clear_session_statusmarkup(self, playchan.session)
         await interaction.response.send_message('Game has been stopped. (**/start** to restart it.)')
 
     @appcmd('files', description='List the save files for the current session')
     async def on_cmd_listfiles(self, interaction):
         """/files
         """
-        playchan = get_valid_playchannel(self, interaction=interaction, withgame=True)
+        playchan = await get_valid_playchannel(self, interaction=interaction, withgame=True)
         if not playchan:
             await interaction.response.send_message('Discoggin does not play games in this channel.')
             return
@@ -232,29 +508,28 @@ class DiscogClient(discord.Client):
     async def on_cmd_status(self, interaction):
         """/status
         """
-        playchan = get_valid_playchannel(self, interaction=interaction, withgame=True)
+        playchan = await get_valid_playchannel(self, interaction=interaction, withgame=True)
         if not playchan:
             await interaction.response.send_message('Discoggin does not play games in this channel.')
             return
         if not playchan.game:
             await interaction.response.send_message('No game is being played in this channel.')
             return
-        glkstate = get_glkstate_for_session(self, playchan.session)
-        if glkstate is None:
+        outls = self.get_status_markup(playchan.session)
+        if outls is None:
             # Actually we can view the status line of an exited game.
             await interaction.response.send_message('The game is not running.')
             return
         chan = interaction.channel
         await interaction.response.send_message('Status line displayed.', ephemeral=True)
-        outls = [ content_to_markup(val, glkstate.hyperlinklabels) for val in glkstate.statuswindat ]
-        await self.print_lines(outls, chan, '|\n')
+        await self.show_status(chan, playchan, outls)
 
     @appcmd('recap', description='Recap the last few commands',
             argdesc={ 'count':'Number of commands to recap' })
     async def on_cmd_recap(self, interaction, count:int=3):
         """/recap NUM
         """
-        playchan = get_valid_playchannel(self, interaction=interaction, withgame=True)
+        playchan = await get_valid_playchannel(self, interaction=interaction, withgame=True)
         if not playchan:
             await interaction.response.send_message('Discoggin does not play games in this channel.')
             return
@@ -269,26 +544,24 @@ class DiscogClient(discord.Client):
         playchan.logger().info('recap %d', count)
             
         autosavedir = os.path.join(self.autosavedir, playchan.session.sessdir)
-        trapath = os.path.join(autosavedir, 'transcript.glktra')
-
-        if not os.path.exists(trapath):
-            await interaction.response.send_message('No transcript is available.')
-            return
 
         # Fake in the initial prompt...
         storywindat = [ ContentLine('>') ]
         try:
-            reader = stanza_reader(trapath)
-            # skip comments and other non-glkote stanzas
-            trareader = filter(stanza_is_transcript, reader)
-            # tail recipe from itertools docs
-            tailreader = iter(collections.deque(trareader, maxlen=count))
-            for stanza in tailreader:
-                storywindat_from_stanza(stanza, storywindat=storywindat)
+            # This gets any buffered stanzas onto disk first, and then
+            # reads the tail of the transcript off the event loop.
+            stanzas = await self.transcripts.read_tail(autosavedir, count)
+            if stanzas is not None:
+                for stanza in stanzas:
+                    storywindat_from_stanza(stanza, storywindat=storywindat)
         except Exception as ex:
             self.logger.error('Transcript: %s', ex, exc_info=ex)
             await interaction.response.send_message('Transcript error: %s' % (ex,))
             return
+
+        if stanzas is None:
+            await interaction.response.send_message('No transcript is available.')
+            return
         
         await interaction.response.send_message('Recapping last %d commands.' % (count,))
         
@@ -301,7 +574,7 @@ class DiscogClient(discord.Client):
     async def on_cmd_install(self, interaction, url:str):
         """/install URL
         """
-        playchan = get_valid_playchannel(self, interaction=interaction)
+        playchan = await get_valid_playchannel(self, interaction=interaction)
         if not playchan:
             await interaction.response.send_message('Discoggin does not play games in this channel.')
             return
@@ -337,6 +610,7 @@ class DiscogClient(discord.Client):
         except Exception as ex:
             self.logger.error('Download: %s', ex, exc_info=ex)
             await interaction.response.send_message('Download error: %s' % (ex,))
+            return
         if isinstance(res, str):
             await interaction.response.send_message(res)
             return
@@ -346,8 +620,9 @@ class DiscogClient(discord.Client):
             await interaction.response.send_message('download_game_url: not a game')
             return
 
-        session = create_session(self, game, interaction.guild_id)
-        set_channel_session(self, playchan, session)
+        session = await create_session(self, game, interaction.guild_id)
+        self.discard_session_procs(playchan.sessid)
+        await set_channel_session(self, playchan, session)
         session.logger().info('installed "%s" in #%s', game.filename, playchan.channame)
         await interaction.response.send_message('Downloaded "%s" and began a new session. (**/start** to start the game.)' % (game.filename,))
 
@@ -355,28 +630,34 @@ class DiscogClient(discord.Client):
     async def on_cmd_gamelist(self, interaction):
         """/games
         """
-        gamels = get_gamelist(self)
+        gamels = self.catalog.games()
         if not gamels:
             await interaction.response.send_message('No games are installed. (**/install URL** to install one.)')
             return
         ls = [ 'Downloaded games available for play: (**/select** one)' ]
-        for game in gamels:
-            ls.append('- %s (%s)' % (game.filename, game.format,))
+        total = len(ls[0])
+        for ix, game in enumerate(gamels):
+            line = '- %s (%s)' % (game.filename, game.format,)
+            # Leave room for the "more" line.
+            if total + len(line) + 80 > MSG_LIMIT:
+                ls.append('...and %d more. (Start typing a name in **/select** to search.)' % (len(gamels)-ix,))
+                break
+            ls.append(line)
+            total += len(line) + 1
         val = '\n'.join(ls)
-        ### is there a message size limit here?
         await interaction.response.send_message(val)
                 
     @appcmd('sessions', description='List game sessions')
     async def on_cmd_sessionlist(self, interaction):
         """/sessions
         """
-        sessls = get_sessions_for_server(self, interaction.guild_id)
+        sessls = await get_sessions_for_server(self, interaction.guild_id)
         if not sessls:
             await interaction.response.send_message('No game sessions are in progress.')
             return
         sessls.sort(key=lambda sess: -sess.lastupdate)
-        gamemap = get_gamemap(self)
-        chanls = get_playchannels_for_server(self, interaction.guild_id)
+        gamemap = await get_gamemap(self)
+        chanls = await get_playchannels_for_server(self, interaction.guild_id)
         chanmap = {}
         for playchan in chanls:
             if playchan.sessid:
@@ -394,15 +675,89 @@ class DiscogClient(discord.Client):
         ### is there a message size limit here?
         await interaction.response.send_message(val)
 
+    @appcmd('usage', description='Show disk usage of game sessions')
+    async def on_cmd_usage(self, interaction):
+        """/usage
+        This reports the recorded usage figures; it doesn't measure
+        anything. (The reaper's sweep keeps them up to date.)
+        """
+        playchan = await get_valid_playchannel(self, interaction=interaction, withgame=True)
+        sessls = await get_sessions_for_server(self, interaction.guild_id)
+        if not sessls:
+            await interaction.response.send_message('No game sessions are in progress.')
+            return
+        ls = []
+        total = await self.usage.server_total(interaction.guild_id)
+        val = 'Game sessions on this server are using %s of disk space' % (format_bytes(total),)
+        if self.usage.serverquota:
+            val += '; the limit is %s' % (format_bytes(self.usage.serverquota),)
+        ls.append(val + '.')
+        if playchan and playchan.session:
+            session = playchan.session
+            if session.autosavebytes is None and session.savefilebytes is None:
+                val = 'This channel\'s session (%d) has not yet been measured' % (session.sessid,)
+            else:
+                val = 'This channel\'s session (%d) is using %s: %s of game state and transcript, %s of save files' % (session.sessid, format_bytes(session.diskbytes()), format_bytes(session.autosavebytes or 0), format_bytes(session.savefilebytes or 0),)
+            if self.usage.sessionquota:
+                val += '; the limit is %s' % (format_bytes(self.usage.sessionquota),)
+            ls.append(val + '.')
+        sessls.sort(key=lambda sess: -sess.diskbytes())
+        gamemap = await get_gamemap(self)
+        ls.append('Largest sessions:')
+        for sess in sessls[ : 5 ]:
+            game = gamemap.get(sess.hash)
+            gamestr = game.filename if game else '???'
+            if sess.autosavebytes is None and sess.savefilebytes is None:
+                sizestr = 'not yet measured'
+            else:
+                sizestr = format_bytes(sess.diskbytes())
+            ls.append('- session %s: %s, %s' % (sess.sessid, gamestr, sizestr,))
+        await interaction.response.send_message('\n'.join(ls))
+
+    @appcmd('stats', description='Show bot performance statistics', admin=True)
+    async def on_cmd_stats(self, interaction):
+        """/stats
+        Turn timings are shown for all servers and for this one.
+        """
+        if not (interaction.permissions and interaction.permissions.administrator):
+            await interaction.response.send_message('Only server administrators can use this command.', ephemeral=True)
+            return
+        def fmt(tup):
+            (count, p50, p95, p99, pmax) = tup
+            return '%d turns, p50 %d / p95 %d / p99 %d / max %d ms' % (count, p50*1000, p95*1000, p99*1000, pmax*1000,)
+        gid = str(interaction.guild_id)
+        ls = [ 'Turn timings (all servers):' ]
+        for stage in self.metrics.turn_stages():
+            tup = self.metrics.summary('turn.'+stage)
+            if tup:
+                ls.append('- %s: %s' % (stage, fmt(tup),))
+        formats = sorted(set([ key[1] for key in self.metrics.histograms if key[0] == 'turn.total' and key[1] ]))
+        for format in formats:
+            tup = self.metrics.summary('turn.total', format=format)
+            if tup:
+                ls.append('- total (%s): %s' % (format, fmt(tup),))
+        tup = self.metrics.summary('turn.total', gid=gid)
+        if tup:
+            ls.append('- total (this server): %s' % (fmt(tup),))
+        if len(ls) == 1:
+            ls.append('- no turns yet')
+        gauges = self.gather_gauges()
+        ls.append('Scheduler: running %d, queued %d, shed %d' % (gauges['scheduler_running'], gauges['scheduler_queued'], gauges['scheduler_shed'],))
+        ls.append('Outbound: sent %d, coalesced %d, failed %d, queued %d' % (gauges['outbound_sent'], gauges['outbound_coalesced'], gauges['outbound_failed'], gauges['outbound_queued'],))
+        if 'outbound_delayp95' in gauges:
+            ls.append('Outbound delay: avg %.2f s, p95 %.2f s' % (gauges['outbound_delayavg'], gauges['outbound_delayp95'],))
+        ls.append('Reaper: %d sessions, %d games, %s reclaimed' % (gauges['reaper_sessions'], gauges['reaper_games'], format_bytes(gauges['reaper_bytes']),))
+        ls.append('GlkState cache: %s' % (format_bytes(gauges['glkstate_cache_bytes']),))
+        await interaction.response.send_message('\n'.join(ls), ephemeral=True)
+
     @appcmd('channels', description='List channels that we can play on')
     async def on_cmd_channellist(self, interaction):
         """/channels
-        This also re-checks the valid channel list. This is a hack.
-        (We should have a way for the command-line API to tell the
-        running instance to recache.)
+        This also re-checks the valid channel list, so that channels
+        newly enabled by the command-line tool show up.
         """
-        self.cache_playchannels()
-        chanls = get_playchannels_for_server(self, interaction.guild_id, withgame=True)
+        await self.cache_playchannels()
+        chanls = await get_playchannels_for_server(self, interaction.guild_id, withgame=True)
         if not chanls:
             await interaction.response.send_message('Discoggin is not available on this Discord server.')
             return
@@ -417,32 +772,35 @@ class DiscogClient(discord.Client):
         await interaction.response.send_message(val)
         
     @appcmd('newsession', description='Start a new game session in this channel',
-            argdesc={ 'game':'Game name' })
+            argdesc={ 'game':'Game name' },
+            autocomplete={ 'game':'autocomplete_game' })
     async def on_cmd_newsession(self, interaction, game:str):
         """/newsession GAME
         """
         gamearg = game
-        playchan = get_valid_playchannel(self, interaction=interaction)
+        playchan = await get_valid_playchannel(self, interaction=interaction)
         if not playchan:
             await interaction.response.send_message('Discoggin does not play games in this channel.')
             return
-        game = get_game_by_name(self, gamearg)
+        game = await get_game_by_name(self, gamearg)
         if not game:
-            await interaction.response.send_message('Game not found: "%s"' % (gamearg,))
+            await self.respond_game_not_found(interaction, gamearg)
             return
-        session = create_session(self, game, interaction.guild_id)
-        set_channel_session(self, playchan, session)
+        session = await create_session(self, game, interaction.guild_id)
+        self.discard_session_procs(playchan.sessid)
+        await set_channel_session(self, playchan, session)
         session.logger().info('new session for "%s" in #%s', game.filename, playchan.channame)
         await interaction.response.send_message('Began a new session for "%s" (**/start** to start the game.)' % (game.filename,))
         # No status line, game hasn't started yet
         
     @appcmd('select', description='Select a game or session to play in this channel',
-            argdesc={ 'game':'Game name or session number' })
+            argdesc={ 'game':'Game name or session number' },
+            autocomplete={ 'game':'autocomplete_game' })
     async def on_cmd_select(self, interaction, game:str):
         """/select [ GAME | SESSION ]
         """
         gamearg = game
-        playchan = get_valid_playchannel(self, interaction=interaction)
+        playchan = await get_valid_playchannel(self, interaction=interaction)
         if not playchan:
             await interaction.response.send_message('Discoggin does not play games in this channel.')
             return
@@ -461,29 +819,31 @@ class DiscogClient(discord.Client):
         This is called by on_cmd_select(). It is responsible for responding
         to the interaction.
         """
-        game = get_game_by_name(self, gamearg)
+        game = await get_game_by_name(self, gamearg)
         if not game:
-            await interaction.response.send_message('Game not found: "%s"' % (gamearg,))
+            await self.respond_game_not_found(interaction, gamearg)
             return
-        curgame = get_game_by_channel(self, playchan.gckey)
+        curgame = await get_game_by_channel(self, playchan.gckey)
         if curgame and game.hash == curgame.hash:
             await interaction.response.send_message('This channel is already playing "%s".' % (curgame.filename,))
             return
             
-        session = get_available_session_for_hash(self, game.hash, interaction.guild_id)
+        session = await get_available_session_for_hash(self, game.hash, interaction.guild_id)
         if session:
-            set_channel_session(self, playchan, session)
+            self.discard_session_procs(playchan.sessid)
+            self.discard_session_procs(session.sessid)
+            await set_channel_session(self, playchan, session)
             session.logger().info('selected "%s" in #%s', game.filename, playchan.channame)
             await interaction.response.send_message('Activated session %d for "%s"' % (session.sessid, game.filename,))
             # Display the status line of this session
-            glkstate = get_glkstate_for_session(self, session)
-            if glkstate:
+            outls = self.get_status_markup(session)
+            if outls is not None:
                 chan = interaction.channel
-                outls = [ content_to_markup(val, glkstate.hyperlinklabels) for val in glkstate.statuswindat ]
-                await self.print_lines(outls, chan, '|\n')
+                await self.show_status(chan, playchan, outls)
             return
-        session = create_session(self, game, interaction.guild_id)
-        set_channel_session(self, playchan, session)
+        session = await create_session(self, game, interaction.guild_id)
+        self.discard_session_procs(playchan.sessid)
+        await set_channel_session(self, playchan, session)
         session.logger().info('new session for "%s" in #%s', game.filename, playchan.channame)
         await interaction.response.send_message('Began a new session for "%s" (**/start** to start the game.)' % (game.filename,))
         # No status line, game hasn't started yet
@@ -493,19 +853,21 @@ class DiscogClient(discord.Client):
         This is called by on_cmd_select(). It is responsible for responding
         to the interaction.
         """
-        session = get_session_by_id(self, sessid)
+        session = await get_session_by_id(self, sessid)
         if not session or session.gid != interaction.guild_id:
             await interaction.response.send_message('No session %d.' % (sessid,))
             return
-        prevchan = get_playchannel_for_session(self, session.sessid)
+        prevchan = await get_playchannel_for_session(self, session.sessid)
         if prevchan:
             if prevchan.chanid == playchan.chanid:
                 await interaction.response.send_message('This channel is already using session %d.' % (session.sessid,))
             else:
                 await interaction.response.send_message('Session %d is already being used in channel <#%s>.' % (session.sessid, prevchan.chanid,))
             return
-        set_channel_session(self, playchan, session)
-        game = get_game_by_hash(self, session.hash)
+        self.discard_session_procs(playchan.sessid)
+        self.discard_session_procs(session.sessid)
+        await set_channel_session(self, playchan, session)
+        game = await get_game_by_hash(self, session.hash)
         if not game:
             playchan.logger().warning('activated session, but could not find game')
             await interaction.response.send_message('Activated session %s, but cannot find associated game' % (session.sessid,))
@@ -513,11 +875,10 @@ class DiscogClient(discord.Client):
         session.logger().info('selected "%s" in #%s', game.filename, playchan.channame)
         await interaction.response.send_message('Activated session %d for "%s"' % (session.sessid, game.filename,))
         # Display the status line of this session
-        glkstate = get_glkstate_for_session(self, session)
-        if glkstate:
+        outls = self.get_status_markup(session)
+        if outls is not None:
             chan = interaction.channel
-            outls = [ content_to_markup(val, glkstate.hyperlinklabels) for val in glkstate.statuswindat ]
-            await self.print_lines(outls, chan, '|\n')
+            await self.show_status(chan, playchan, outls)
         
     async def on_message(self, message):
         """Event handler for regular Discord chat messages.
@@ -527,7 +888,8 @@ class DiscogClient(discord.Client):
             # silently ignore messages we sent
             return
 
-        playchan = get_valid_playchannel(self, message=message, withgame=True)
+        # We don't load the game yet; most messages are just chat.
+        playchan = await get_valid_playchannel(self, message=message)
         if not playchan:
             # silently ignore messages in non-play channels
             return
@@ -541,16 +903,21 @@ class DiscogClient(discord.Client):
         if not cmd:
             # silently ignore messages that don't look like commands
             # but record the message as a comment!
-            self.record_comment(message, playchan)
+            await hydrate_playchannel(self, playchan, withgame=False)
+            await self.record_comment(message, playchan)
             return
         
+        timer = TurnTimer()
+        await hydrate_playchannel(self, playchan)
         if not playchan.game:
-            await message.channel.send('No game is being played in this channel.')
+            await self.outbound.send(message.channel, 'No game is being played in this channel.')
             return
+        timer.lap('db')
         
         glkstate = get_glkstate_for_session(self, playchan.session)
+        timer.lap('load')
         if glkstate is None or not glkstate.islive():
-            await message.channel.send('The game is not running. (**/start** to start it.)')
+            await self.outbound.send(message.channel, 'The game is not running. (**/start** to start it.)')
             return
 
         if playchan.sessid in self.inflight:
@@ -558,11 +925,11 @@ class DiscogClient(discord.Client):
             return
         self.inflight.add(playchan.sessid)
         try:
-            await self.run_turn(cmd, message.channel, playchan, glkstate)
+            await self.run_turn(cmd, message.channel, playchan, glkstate, timer=timer)
         finally:
             self.inflight.discard(playchan.sessid)
 
-    def record_comment(self, message, playchan):
+    async def record_comment(self, message, playchan):
         if not playchan.sessid:
             return
         if not message.author:
@@ -580,27 +947,27 @@ class DiscogClient(discord.Client):
             "timestamp": outputtime
         }
         try:
+            # The writer creates the directory if necessary.
             autosavedir = os.path.join(self.autosavedir, playchan.session.sessdir)
-            if not os.path.exists(autosavedir):
-                os.mkdir(autosavedir)
-            
-            trapath = os.path.join(autosavedir, 'transcript.glktra')
-            with open(trapath, 'a') as outfl:
-                json.dump(tradat, outfl)
-                outfl.write('\n')
+            count = await self.transcripts.write(autosavedir, tradat)
+            self.usage.note_transcript(playchan.session, count)
         except Exception as ex:
-            logger.warning('Failed to write comment: %s', ex, exc_info=ex)
+            playchan.logger().warning('Failed to write comment: %s', ex, exc_info=ex)
 
 
-    async def run_turn(self, cmd, chan, playchan, glkstate):
+    async def run_turn(self, cmd, chan, playchan, glkstate, timer=None):
         """Execute a turn by invoking an interpreter.
         The cmd and glkstate arguments should be None for the initial turn
         (starting the game).
         We always set sessid in the inflight set before calling this,
         and clear it after this completes. This lets us avoid invoking
         two turns on the same session at the same time.
+        The timer (a TurnTimer) may already have stages from the caller;
+        we add ours, and record them in self.metrics and the transcript.
         """
         logger = playchan.logger()
+        if timer is None:
+            timer = TurnTimer()
         
         if not chan:
             logger.warning('run_turn: channel not set')
@@ -612,7 +979,7 @@ class DiscogClient(discord.Client):
         gamefile = os.path.join(self.gamesdir, playchan.game.hash, playchan.game.filename)
         if not os.path.exists(gamefile):
             logger.error('run_turn: game file not found: %s', gamefile)
-            await chan.send('Error: The game file seems to be missing.')
+            await self.outbound.send(chan, 'Error: The game file seems to be missing.')
             return
 
         autosavedir = os.path.join(self.autosavedir, playchan.session.sessdir)
@@ -626,7 +993,13 @@ class DiscogClient(discord.Client):
         iargs, ienv = format_interpreter_args(playchan.game.format, firsttime, terpsdir=self.terpsdir, gamefile=gamefile, savefiledir=savefiledir, autosavedir=autosavedir)
         if iargs is None:
             logger.warning('run_turn: unknown format: %s', playchan.game.format)
-            await chan.send('Error: No known interpreter for this format (%s)' % (playchan.game.format,))
+            await self.outbound.send(chan, 'Error: No known interpreter for this format (%s)' % (playchan.game.format,))
+            return
+
+        quotamsg = await self.usage.check(playchan.session)
+        if quotamsg:
+            logger.warning('run_turn: over disk quota')
+            await self.outbound.send(chan, quotamsg)
             return
 
         # Inherit env vars
@@ -666,63 +1039,106 @@ class DiscogClient(discord.Client):
                 input = glkstate.construct_input(cmd)
                 indat = json.dumps(input)
             except Exception as ex:
-                await chan.send('Input: %s' % (ex,))
+                await self.outbound.send(chan, 'Input: %s' % (ex,))
                 return
 
             if input.get('type') == 'specialresponse' and input.get('response') == 'fileref_prompt':
                 extrainput = cmd
 
+        # In persistent mode, we may have a live interpreter for this
+        # session already. If not, we'll start one (if the format allows).
+        # Failing that, we may have a pre-spawned single-turn interpreter.
+        live = None
+        prespawned = None
+        if firsttime:
+            # Any process left over from a previous run is stale.
+            self.discard_session_procs(playchan.sessid)
+        else:
+            if self.procpool.enabled():
+                live = self.procpool.get(playchan.sessid, playchan.game.hash)
+            if live is None and self.prespawner.enabled():
+                prespawned = self.prespawner.take(playchan.sessid, playchan.game.hash, glkstate.generation)
+        
         # Launch the interpreter, push an input event into it, and then pull
         # an update out.
         try:
             async def func():
-                proc = await asyncio.create_subprocess_exec(
-                    *iargs,
-                    env=allenv,
-                    stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
-                return await proc.communicate((indat+'\n').encode())
-            (outdat, errdat) = await asyncio.wait_for(func(), 5)
+                nonlocal live
+                if live is None and self.procpool.enabled():
+                    largs, lenv = format_interpreter_args(playchan.game.format, firsttime, terpsdir=self.terpsdir, gamefile=gamefile, savefiledir=savefiledir, autosavedir=autosavedir, singleturn=False)
+                    if largs is not None:
+                        lallenv = os.environ.copy()
+                        if lenv:
+                            lallenv.update(lenv)
+                        live = await self.procpool.launch(playchan.sessid, playchan.game.hash, largs, lallenv)
+                if live is not None:
+                    timer.lap('spawn')
+                    res = await live.turn(indat, maxbytes=self.maxoutput)
+                    timer.lap('run')
+                    return res
+                proc = prespawned
+                if proc is None:
+                    proc = await asyncio.create_subprocess_exec(
+                        *iargs,
+                        env=allenv,
+                        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+                timer.lap('spawn')
+                res = await run_single_turn(proc, indat, maxbytes=self.maxoutput)
+                timer.lap('run')
+                return res
+            timer.lap('prepare')
+            async with self.scheduler.slot(playchan.gid, playchan.chanid):
+                timer.lap('queue')
+                (update, errorls) = await asyncio.wait_for(func(), 5)
+        except SchedulerBusy:
+            logger.warning('Interpreter queue is full')
+            if prespawned is not None:
+                kill_proc(prespawned)
+            await self.outbound.send(chan, 'The server is busy right now. Please try again in a moment.')
+            return
         except TimeoutError:
             logger.error('Interpreter error: Command timed out')
-            await chan.send('Interpreter error: Command timed out.')
+            if live is not None:
+                self.procpool.discard(playchan.sessid)
+            await self.outbound.send(chan, 'Interpreter error: Command timed out.')
             return
-        except Exception as ex:
-            logger.error('Interpreter exception: %s', ex, exc_info=ex)
-            await chan.send('Interpreter exception: %s' % (ex,))
+        except OutputTooLarge as ex:
+            logger.error('Interpreter error: %s', ex)
+            if live is not None:
+                self.procpool.discard(playchan.sessid)
+            await self.outbound.send(chan, 'Interpreter error: Too much output.')
             return
-            
-        if errdat:
-            await chan.send('Interpreter stderr: %s' % (errdat,))
-            # but try to continue
-
-        try:
-            (update, errorls) = parse_json(outdat)
-        except json.JSONDecodeError:
-            try:
-                outstr = outdat.decode()
-            except:
-                outstr = str(outdat)
-            logger.error('Invalid JSON output: %r', outstr)
-            await chan.send('Invalid JSON output: %s' % (outstr[:160],))
+        except InvalidOutput as ex:
+            logger.error('Invalid JSON output: %r', str(ex))
+            if live is not None:
+                self.procpool.discard(playchan.sessid)
+            await self.outbound.send(chan, 'Invalid JSON output: %s' % (str(ex)[:160],))
             return
         except Exception as ex:
-            logger.error('JSON decode exception: %s', ex, exc_info=ex)
-            await chan.send('JSON decode exception: %s' % (ex,))
+            logger.error('Interpreter exception: %s', ex, exc_info=ex)
+            if live is not None:
+                self.procpool.discard(playchan.sessid)
+            await self.outbound.send(chan, 'Interpreter exception: %s' % (ex,))
             return
 
+        if live is not None and not live.isalive():
+            # The process exited after this turn (probably because the
+            # game ended). Clear it out of the pool.
+            self.procpool.discard(playchan.sessid)
+            
         # Display errorls, which contains the contents of JSON-encoded
         # error stanza(s). But don't exit just because we got errors.
         for msg in errorls:
             logger.error('Interpreter error message: %s', msg)
         outls = [ 'Interpreter error: %s' % (msg,) for msg in errorls ]
-        await self.print_lines(outls, chan)
+        await self.print_lines(outls, chan, wait=False)
 
         if update is None:
             # If we didn't get any *non*-errors, that's a reason to exit.
             # But make sure we report at least one error.
             if not errorls:
                 logger.error('Interpreter error: no update')
-                await chan.send('Interpreter error: no update')
+                await self.outbound.send(chan, 'Interpreter error: no update')
             return
 
         # Update glkstate with the output.
@@ -730,12 +1146,32 @@ class DiscogClient(discord.Client):
             glkstate.accept_update(update, extrainput)
         except Exception as ex:
             logger.error('Update error: %s', ex, exc_info=ex)
-            await chan.send('Update error: %s' % (ex,))
+            # The state may be half-updated; don't let it stay cached.
+            self.glkstates.discard(playchan.sessid)
+            await self.outbound.send(chan, 'Update error: %s' % (ex,))
             return
+        timer.lap('update')
 
-        put_glkstate_for_session(self, playchan.session, glkstate)
+        sizedelta = put_glkstate_for_session(self, playchan.session, glkstate)
 
-        update_session_movecount(self, playchan.session)
+        oldbytes = playchan.session.diskbytes()
+        usage = await self.usage.turn_usage(playchan.session, sizedelta, autosavedir, savefiledir)
+        await update_session_movecount(self, playchan.session, statusmarkup=glkstate.statusmarkup, usage=usage)
+        self.usage.note_update(playchan.session, oldbytes)
+        timer.lap('save')
+
+        if live is None and not glkstate.exited and self.prespawner.enabled() and self.scheduler.has_capacity():
+            # Get the next turn's interpreter started (and autorestoring)
+            # while we display this turn's output.
+            try:
+                niargs, nienv = format_interpreter_args(playchan.game.format, False, terpsdir=self.terpsdir, gamefile=gamefile, savefiledir=savefiledir, autosavedir=autosavedir)
+                nallenv = os.environ.copy()
+                if nienv:
+                    nallenv.update(nienv)
+                await self.prespawner.spawn(playchan.sessid, playchan.game.hash, glkstate.generation, niargs, nallenv)
+            except Exception as ex:
+                logger.warning('Pre-spawn failed: %s', ex, exc_info=ex)
+            timer.lap('prespawn')
 
         outputtime = int(time.time() * 1000)
         tradat = {
@@ -747,28 +1183,40 @@ class DiscogClient(discord.Client):
             "timestamp": inputtime,
             "outtimestamp": outputtime
         }
+        # The timings so far. Rendering and sending come after the
+        # transcript is written, so they're only in self.metrics.
+        tradat['timings'] = timer.to_jsonable()
         try:
-            trapath = os.path.join(autosavedir, 'transcript.glktra')
-            with open(trapath, 'a') as outfl:
-                json.dump(tradat, outfl)
-                outfl.write('\n')
+            count = await self.transcripts.write(autosavedir, tradat)
+            self.usage.note_transcript(playchan.session, count)
         except Exception as ex:
             logger.warning('Failed to write transcript: %s', ex, exc_info=ex)
 
         # Display the output.
         outls = [ content_to_markup(val, glkstate.hyperlinklabels) for val in glkstate.storywindat ]
         printcount = sum([ len(out) for out in outls ])
-        await self.print_lines(outls, chan, '>\n')
+        # Queue all the output before waiting, so that short pieces can
+        # go out as a single message.
+        await self.print_lines(outls, chan, '>\n', wait=False)
 
-        if printcount <= 4:
+        quiet = (printcount <= 4)
+        shown = False
+        if self.statusmode:
+            # Keep the tracked status message current on every turn.
+            shown = await self.show_status(chan, playchan, glkstate.statusmarkup)
+        elif quiet:
             # No story output, or not much. Try showing the status line.
-            outls = [ content_to_markup(val, glkstate.hyperlinklabels) for val in glkstate.statuswindat ]
-            printcount = sum([ len(out) for out in outls ])
-            await self.print_lines(outls, chan, '|\n')
+            shown = await self.show_status(chan, playchan, glkstate.statusmarkup, wait=False)
 
-        if printcount <= 4:
-            await chan.send('(no game output)')
+        if quiet and not shown:
+            self.outbound.post(chan, '(no game output)')
 
         if glkstate.exited:
-            await chan.send('The game has exited. (**/start** to restart it.)')
+            self.discard_session_procs(playchan.sessid)
+            self.outbound.post(chan, 'The game has exited. (**/start** to restart it.)')
+        timer.lap('render')
+
+        await self.outbound.drain(chan)
+        timer.lap('send')
+        self.metrics.observe_turn(timer, format=playchan.game.format, gid=str(playchan.gid))
             
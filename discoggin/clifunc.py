@@ -1,32 +1,21 @@
 import sys
+import os.path
 import re
 import logging
 
 from .sessions import get_session_by_id, get_sessions_for_hash, delete_session
-from .games import get_game_by_name, delete_game
+from .games import get_game_by_name, get_gamelist, delete_game
+from .games import get_gameinfo, set_gameinfo
+from .sniff import sniff_game
+from .schema import SCHEMA_VERSION, get_schema_version, upgrade_schema
 
 def cmd_createdb(args, app):
-    curs = app.db.cursor()
-    res = curs.execute('SELECT name FROM sqlite_master')
-    tables = [ tup[0] for tup in res.fetchall() ]
-    
-    if 'games' in tables:
-        print('"games" table exists')
-    else:
-        print('creating "games" table...')
-        curs.execute('CREATE TABLE games(hash unique, filename, url, format)')
-
-    if 'sessions' in tables:
-        print('"sessions" table exists')
-    else:
-        print('creating "sessions" table...')
-        curs.execute('CREATE TABLE sessions(sessid unique, gid, hash, movecount, lastupdate)')
-
-    if 'channels' in tables:
-        print('"channels" table exists')
-    else:
-        print('creating "channels" table...')
-        curs.execute('CREATE TABLE channels(gckey unique, gid, chanid, sessid)')
+    version = get_schema_version(app.db)
+    if version >= SCHEMA_VERSION:
+        print('database is up to date (version %d)' % (version,))
+        return
+    upgrade_schema(app.db, report=print)
+    print('database is now version %d' % (SCHEMA_VERSION,))
 
 def cmd_cmdinstall(args, app):
     app.cmdsync = True
@@ -98,4 +87,21 @@ def cmd_delgame(args, app):
     # TODO: There's a tiny race condition here if someone starts a session while we're deleting.
     delete_game(app, game.hash)
     print('deleted game', game.filename)
-    
+
+def cmd_scangames(args, app):
+    count = 0
+    for game in get_gamelist(app):
+        if get_gameinfo(app, game.hash) and not args.all:
+            continue
+        path = os.path.join(app.gamesdir, game.hash, game.filename)
+        try:
+            format, info = sniff_game(game.filename, path)
+        except Exception as ex:
+            print('cannot read %s: %s' % (game.filename, ex,))
+            continue
+        if format != game.format:
+            print('warning: %s looks like %s, but is installed as %s' % (game.filename, format, game.format,))
+        info.hash = game.hash
+        set_gameinfo(app, info)
+        count += 1
+    print('scanned %d games' % (count,))
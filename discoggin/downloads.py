@@ -0,0 +1,101 @@
+import logging
+import hashlib
+import asyncio
+import aiohttp
+
+class DownloadTooLarge(Exception):
+    pass
+
+class DownloadManager:
+    """Handles game downloads for the bot.
+    Data is read from the network in whatever chunks arrive, gathered
+    into buffers (growing from 64kB to 1MB), and handed to a worker
+    thread to be written and hashed. The next buffer is read while the
+    previous one is being written.
+    Downloads are limited to maxbytes (checked against Content-Length
+    up front, and again as the data arrives).
+    If the same URL is requested while a download of it is in progress,
+    the second request waits for the first one's result rather than
+    starting another download.
+    """
+    def __init__(self, maxbytes=64000000):
+        self.maxbytes = maxbytes
+        self.logger = logging.getLogger('cli')
+        self.inflight = {}  # maps URL to task
+
+    def create_session(self, headers=None):
+        """Create the aiohttp session which the bot uses for downloads.
+        This must be called inside the async event loop.
+        """
+        connector = aiohttp.TCPConnector(limit=8, limit_per_host=2, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=None, connect=30, sock_read=60)
+        return aiohttp.ClientSession(headers=headers, connector=connector, timeout=timeout)
+
+    async def dedupe(self, key, func):
+        """Call func() (a coroutine function) and return its result --
+        unless a call with the same key is already in progress, in which
+        case wait for that and return its result.
+        The work runs in its own task, so one requester giving up (being
+        cancelled) doesn't cancel it for the others.
+        """
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(func())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.logger.info('Joining in-progress download: %s', key)
+        return await asyncio.shield(task)
+
+    async def fetch(self, httpsession, url, path):
+        """Download a URL to a file. Returns (md5 hex digest, size).
+        Raises DownloadTooLarge if the file is over the limit; the
+        partial file is left for the caller to clean up.
+        Returns an error string if the server doesn't return 200.
+        """
+        loop = asyncio.get_running_loop()
+        async with httpsession.get(url) as resp:
+            if resp.status != 200:
+                return 'Download error: %s %s: %s' % (resp.status, resp.reason, url,)
+            if self.maxbytes and resp.content_length and resp.content_length > self.maxbytes:
+                raise DownloadTooLarge()
+
+            outfl = await loop.run_in_executor(None, open, path, 'wb')
+            try:
+                md5 = hashlib.md5()
+                totallen = 0
+                bufsize = 65536
+                buf = bytearray()
+                pending = None
+                async for dat in resp.content.iter_any():
+                    totallen += len(dat)
+                    if self.maxbytes and totallen > self.maxbytes:
+                        raise DownloadTooLarge()
+                    buf.extend(dat)
+                    if len(buf) >= bufsize:
+                        if pending:
+                            await pending
+                        pending = loop.run_in_executor(None, write_and_hash, outfl, md5, bytes(buf))
+                        buf.clear()
+                        bufsize = min(2*bufsize, 1024*1024)
+                if pending:
+                    await pending
+                    pending = None
+                if buf:
+                    await loop.run_in_executor(None, write_and_hash, outfl, md5, bytes(buf))
+            finally:
+                if pending:
+                    # Don't close the file under a write in progress.
+                    try:
+                        await pending
+                    except Exception:
+                        pass
+                await loop.run_in_executor(None, outfl.close)
+        return (md5.hexdigest(), totallen)
+
+def write_and_hash(outfl, md5, dat):
+    """Write a chunk of data and add it to the hash. This runs in
+    a worker thread.
+    """
+    outfl.write(dat)
+    md5.update(dat)
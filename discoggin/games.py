@@ -3,7 +3,7 @@ import os, os.path
 import urllib.parse
 import time
 import logging
-import hashlib
+import asyncio
 
 class GameFile:
     def __init__(self, hash, filename, url, format):
@@ -61,6 +61,55 @@ def get_game_by_channel(app, gckey):
         return None
     return get_game_by_session(app, playchan.sessid)
 
+def create_game(app, hash, filename, url, format, info=None):
+    """Add a game to the database. (The file should already be in
+    place in gamesdir.) If info is provided, that goes in the gameinfo
+    table.
+    """
+    tup = (hash, filename, url, format)
+    curs = app.db.cursor()
+    curs.execute('INSERT INTO games (hash, filename, url, format) VALUES (?, ?, ?, ?)', tup)
+    if info is not None:
+        info.hash = hash
+        set_gameinfo(app, info)
+    return GameFile(*tup)
+
+def get_gameinfo(app, hash):
+    """Get the stored GameInfo for a game, or None if it was never
+    recorded.
+    """
+    curs = app.db.cursor()
+    res = curs.execute('SELECT hash, size, blorb, ifid, version, release, serial, execoffset, execlength, picts, sounds FROM gameinfo WHERE hash = ?', (hash,))
+    tup = res.fetchone()
+    if not tup:
+        return None
+    return GameInfo(*tup)
+
+def set_gameinfo(app, info):
+    tup = (info.hash, info.size, int(info.blorb), info.ifid, info.version, info.release, info.serial, info.execoffset, info.execlength, info.picts, info.sounds)
+    curs = app.db.cursor()
+    curs.execute('INSERT OR REPLACE INTO gameinfo (hash, size, blorb, ifid, version, release, serial, execoffset, execlength, picts, sounds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', tup)
+
+def get_orphan_games(app):
+    """Get games which have no sessions.
+    """
+    curs = app.db.cursor()
+    res = curs.execute('SELECT * FROM games WHERE hash NOT IN (SELECT hash FROM sessions)')
+    gamels = [ GameFile(*tup) for tup in res.fetchall() ]
+    return gamels
+
+def delete_orphan_game(app, hash):
+    """Delete a game's database rows, if it still has no sessions.
+    Returns whether it was deleted. The caller is responsible for
+    deleting the game's files.
+    """
+    curs = app.db.cursor()
+    curs.execute('DELETE FROM games WHERE hash = ? AND hash NOT IN (SELECT hash FROM sessions)', (hash,))
+    if curs.rowcount <= 0:
+        return False
+    curs.execute('DELETE FROM gameinfo WHERE hash = ?', (hash,))
+    return True
+
 def delete_game(app, hash):
     """Delete a game and all its files.
     This is called from the command-line.
@@ -74,6 +123,7 @@ def delete_game(app, hash):
 
     curs = app.db.cursor()
     curs.execute('DELETE FROM games WHERE hash = ?', (hash,))
+    curs.execute('DELETE FROM gameinfo WHERE hash = ?', (hash,))
 
 # Matches empty string, ".", "..", and so on.
 pat_alldots = re.compile('^[.]*$')
@@ -85,11 +135,15 @@ async def download_game_url(app, url, filename=None):
     If filename is not provided, slice it off the URL.
     On success, return a GameFile. On error, return a string describing
     the error. (Sorry, that's messy. Pretend it's a Result sort of thing.)
+    If the same URL is already being downloaded, this waits for that
+    download and returns its result.
     """
-    global download_nonce
-    
     app.logger.info('Requested download: %s', url)
+    return await app.downloads.dedupe(url, lambda: download_game_url_inner(app, url, filename))
 
+async def download_game_url_inner(app, url, filename):
+    global download_nonce
+    
     if not (url.lower().startswith('http://') or url.lower().startswith('https://')):
         return 'Download URL must start with `http://` or `https://`'
 
@@ -105,49 +159,54 @@ async def download_game_url(app, url, filename=None):
     tmpfile = '_tmp_%d_%d_%s' % (time.time(), download_nonce, filename,)
     tmppath = os.path.join(app.gamesdir, tmpfile)
     
-    async with app.httpsession.get(url) as resp:
-        if resp.status != 200:
-            return 'Download error: %s %s: %s' % (resp.status, resp.reason, url,)
-        
-        totallen = 0
-        md5 = hashlib.md5()
-        with open(tmppath, 'wb') as outfl:
-            async for dat in resp.content.iter_chunked(4096):
-                totallen += len(dat)
-                outfl.write(dat)
-                md5.update(dat)
-            dat = None
-            hash = md5.hexdigest()
+    try:
+        res = await app.downloads.fetch(app.httpsession, url, tmppath)
+    except DownloadTooLarge:
+        remove_if_present(tmppath)
+        return 'Download error: file is larger than %d bytes: %s' % (app.downloads.maxbytes, url,)
+    except:
+        remove_if_present(tmppath)
+        raise
+    if isinstance(res, str):
+        remove_if_present(tmppath)
+        return res
+    (hash, totallen) = res
 
-    curs = app.db.cursor()
-    res = curs.execute('SELECT * FROM games WHERE hash = ?', (hash,))
-    tup = res.fetchone()
-    if tup:
-        os.remove(tmppath)
-        return 'Game is already installed (try **/select %s**)' % (filename,)
+    try:
+        if await asyncdb.get_game_by_hash(app, hash):
+            os.remove(tmppath)
+            return 'Game is already installed (try **/select %s**)' % (filename,)
 
-    format = detect_format(filename, tmppath)
+        # This reads the file's header (and Blorb index), so keep it off
+        # the event loop.
+        loop = asyncio.get_running_loop()
+        (format, info) = await loop.run_in_executor(None, sniff_game, filename, tmppath)
+    except:
+        remove_if_present(tmppath)
+        raise
     if not format:
         os.remove(tmppath)
         return 'Format not recognized: %s' % (url,)
 
-    ### this would be a great place to pull ifiction from blorbs
-    ### and unpack resources, too
+    ### this would be a great place to unpack Blorb resources
     app.logger.info('Downloaded %s (hash %s, format %s)', url, hash, format)
 
     finaldir = os.path.join(app.gamesdir, hash)
     finalpath = os.path.join(app.gamesdir, hash, filename)
 
-    tup = (hash, filename, url, format)
-    game = GameFile(*tup)
-    curs.execute('INSERT INTO games (hash, filename, url, format) VALUES (?, ?, ?, ?)', tup)
-
     if not os.path.exists(finaldir):
         os.mkdir(finaldir)
     os.rename(tmppath, finalpath)
 
+    game = await asyncdb.create_game(app, hash, filename, url, format, info)
     return game
 
+def remove_if_present(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 def detect_format(filename, path=None):
     """Figure out the type of a file given its bare filename and, optionally,
     its full path.
@@ -155,43 +214,42 @@ def detect_format(filename, path=None):
     *might* be an IF game, so it's okay that we can't distinguish the
     type completely. We may return '?' there.
     """
+    if path:
+        # Check the contents. (See sniff.py.)
+        format, _ = sniff_game(filename, path)
+        return format
+    
     _, ext = os.path.splitext(filename)
     ext = ext.lower()
 
-    if ext in ('.ulx', '.gblorb'):
-        ### verify first word, if possible
+    if ext in glulx_exts:
         return 'glulx'
-    if ext in ('.z1', '.z2', '.z3', '.z4', '.z5', '.z6', '.z7', '.z8', '.zblorb'):
-        ### verify first byte, if possible
+    if ext in zcode_exts:
         return 'zcode'
-    if ext in ('.json', '.js'):
+    if ext in blorb_exts:
+        # Could be either.
+        return '?'
+    if ext in json_exts:
         # We could check for the full '.ink.json' suffix, but that's not
         # reliable; Ink files may be found with just '.js' (and perhaps
         # JSONP at that).
-        # Instead, we'll check the contents, if possible.
-        if not path:
-            return '?'
-        try:
-            obj = load_json(path)
-        except:
-            return None
-        if 'inkVersion' in obj:
-            return 'ink'
-        if 'program' in obj and 'strings' in obj:
-            return 'ys'
-        return None
+        return '?'
     return None
 
-def format_interpreter_args(format, firstrun, *, gamefile, terpsdir, savefiledir, autosavedir):
+def format_interpreter_args(format, firstrun, *, gamefile, terpsdir, savefiledir, autosavedir, singleturn=True):
     """Return an argument list and environment variables for the interpreter
     to run the given format.
+    If singleturn is false, the arguments are for a long-running
+    interpreter (persistent mode). Not all formats support this; for
+    those that don't, this returns (None, None).
     """
     if format == 'glulx':
         terp = os.path.join(terpsdir, 'glulxe')
+        turnargs = [ '-singleturn' ] if singleturn else []
         if firstrun:
-            args = [ terp, '-singleturn', '-filedir', savefiledir, '-onlyfiledir', '--autosave', '--autodir', autosavedir, gamefile ]
+            args = [ terp ] + turnargs + [ '-filedir', savefiledir, '-onlyfiledir', '--autosave', '--autodir', autosavedir, gamefile ]
         else:
-            args = [ terp, '-singleturn', '-filedir', savefiledir, '-onlyfiledir', '-autometrics', '--autosave', '--autorestore', '--autodir', autosavedir, gamefile ]
+            args = [ terp ] + turnargs + [ '-filedir', savefiledir, '-onlyfiledir', '-autometrics', '--autosave', '--autorestore', '--autodir', autosavedir, gamefile ]
         return (args, {})
 
     if format == 'zcode':
@@ -205,14 +263,18 @@ def format_interpreter_args(format, firstrun, *, gamefile, terpsdir, savefiledir
         # -H is BOCFEL_DISABLE_HISTORY_PLAYBACK
         # -m is BOCFEL_DISABLE_META_COMMANDS
         # -T is BOCFEL_TRANSCRIPT_NAME
+        turnargs = [ '-singleturn' ] if singleturn else []
         if firstrun:
             env['BOCFEL_SKIP_AUTORESTORE'] = '1'
-            args = [ terp, '-C', '-H', '-m', '-T', 'transcript.txt', '-singleturn', '-filedir', savefiledir, '-onlyfiledir', gamefile ]
+            args = [ terp, '-C', '-H', '-m', '-T', 'transcript.txt' ] + turnargs + [ '-filedir', savefiledir, '-onlyfiledir', gamefile ]
         else:
-            args = [ terp, '-C', '-H', '-m', '-T', 'transcript.txt', '-singleturn', '-filedir', savefiledir, '-onlyfiledir', '-autometrics', gamefile ]
+            args = [ terp, '-C', '-H', '-m', '-T', 'transcript.txt' ] + turnargs + [ '-filedir', savefiledir, '-onlyfiledir', '-autometrics', gamefile ]
         return (args, env)
         
     if format == 'ink':
+        # inkrun.js only runs in single-turn mode.
+        if not singleturn:
+            return (None, None)
         terp = os.path.join(terpsdir, 'inkrun.js')
         if firstrun:
             args = [ terp, '--start', '--autodir', autosavedir, gamefile ]
@@ -221,6 +283,9 @@ def format_interpreter_args(format, firstrun, *, gamefile, terpsdir, savefiledir
         return (args, {})
         
     if format == 'ys':
+        # ysrun only runs in single-turn mode.
+        if not singleturn:
+            return (None, None)
         terp = os.path.join(terpsdir, 'ysrun')
         if firstrun:
             args = [ terp, '--start', '--autodir', autosavedir, gamefile ]
@@ -233,6 +298,9 @@ def format_interpreter_args(format, firstrun, *, gamefile, terpsdir, savefiledir
 
 # Late imports
 from .sessions import get_playchannel, get_session_by_id
-from .util import delete_flat_dir, load_json
+from .util import delete_flat_dir
+from .sniff import GameInfo, sniff_game, glulx_exts, zcode_exts, blorb_exts, json_exts
+from .downloads import DownloadTooLarge
+from . import asyncdb
 
 
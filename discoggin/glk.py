@@ -1,36 +1,124 @@
 import os, os.path
+import re
 import json
+import gzip
+import collections
 import logging
 
 def get_glkstate_for_session(app, session):
     """Load the GlkState for a session. An exited session will return a
     GlkState with exit=True. If the game has never run at all (or has
     been force-quit), this returns None.
+    If the state is in app.glkstates (and the file hasn't changed since
+    it was cached), we return the cached object without reading the file.
+    Note that callers may modify the returned GlkState. If you do, you
+    must either put it back with put_glkstate_for_session(), or call
+    app.glkstates.discard().
     """
     path = os.path.join(app.autosavedir, session.sessdir, 'glkstate.json')
-    if not os.path.exists(path):
+    try:
+        stamp = file_stamp(path)
+    except FileNotFoundError:
+        app.glkstates.discard(session.sessid)
         return None
+    state = app.glkstates.get(session.sessid, stamp)
+    if state is not None:
+        return state
     try:
         with open(path) as fl:
             obj = json.load(fl)
-        return GlkState.from_jsonable(obj)
+        state = GlkState.from_jsonable(obj)
     except Exception as ex:
         session.logger().error('get_glkstate: %s', ex, exc_info=ex)
         return None
+    app.glkstates.put(session.sessid, state, stamp)
+    return state
 
 def put_glkstate_for_session(app, session, state):
     """Store the GlkState for a session, or delete it if state is None.
     This assumes the session directory exists. (Unless state is None,
     in which case it's okay if there is nothing to delete!)
+    The cache is updated to match.
+    Returns the change in the file's size, in bytes.
     """
     path = os.path.join(app.autosavedir, session.sessdir, 'glkstate.json')
+    try:
+        oldsize = os.stat(path).st_size
+    except FileNotFoundError:
+        oldsize = 0
     if not state:
+        app.glkstates.discard(session.sessid)
         if os.path.exists(path):
             os.remove(path)
+        return -oldsize
     else:
         obj = state.to_jsonable()
-        with open(path, 'w') as fl:
-            json.dump(obj, fl)
+        dat = json.dumps(obj, separators=(',', ':'))
+        try:
+            # Write a temp file and rename it into place, so that a crash
+            # can't leave a half-written state.
+            write_file_atomic(path, dat, fsync=app.filesyncer.immediate())
+        except:
+            app.glkstates.discard(session.sessid)
+            raise
+        app.filesyncer.add(path)
+        stamp = file_stamp(path)
+        app.glkstates.put(session.sessid, state, stamp)
+        return stamp[1] - oldsize
+
+def file_stamp(path):
+    """Return a value which changes whenever the file is rewritten:
+    (mtime, size). Raises FileNotFoundError if the file doesn't exist.
+    """
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+class GlkStateCache:
+    """A bounded LRU cache of GlkState objects, keyed by session ID.
+    Each entry remembers the file stamp of the glkstate.json it matches.
+    If the file has changed (or vanished) since then, perhaps because
+    the command-line tool deleted the session, the entry is ignored.
+    The cache is limited by the total size of the cached states' JSON
+    files, which is a reasonable proxy for their memory use.
+    """
+    def __init__(self, maxbytes=0):
+        self.maxbytes = maxbytes
+        self.totalbytes = 0
+        # Maps sessid to (state, stamp), in LRU order (oldest first).
+        self.map = collections.OrderedDict()
+
+    def get(self, sessid, stamp):
+        tup = self.map.get(sessid)
+        if tup is None:
+            return None
+        (state, ostamp) = tup
+        if ostamp != stamp:
+            self.discard(sessid)
+            return None
+        self.map.move_to_end(sessid)
+        return state
+
+    def put(self, sessid, state, stamp):
+        self.discard(sessid)
+        size = stamp[1]
+        if size > self.maxbytes:
+            return
+        self.map[sessid] = (state, stamp)
+        self.totalbytes += size
+        while self.totalbytes > self.maxbytes:
+            (_, (_, ostamp)) = self.map.popitem(last=False)
+            self.totalbytes -= ostamp[1]
+
+    def discard(self, sessid):
+        tup = self.map.pop(sessid, None)
+        if tup is not None:
+            self.totalbytes -= tup[1][1]
+
+# Version number for GlkState.to_jsonable(). Version 1 (with no "v" key)
+# stored content lines in ContentLine.to_jsonable() form. Version 2
+# uses the shorter form from ContentLine.to_compact(), and is written
+# without extra whitespace.
+GLKSTATE_VERSION = 2
 
 class GlkState:
     _singleton_keys = [ 'generation', 'exited', 'lineinputwin', 'charinputwin', 'specialinput', 'hyperlinkinputwin' ]
@@ -56,6 +144,10 @@ class GlkState:
         self.hyperlinkinputwin = None
         self.exited = False
         self.generation = 0
+        # The status window as Discord markup (a list of strings, one
+        # per line). Rendered once per update, so that displaying the
+        # status line doesn't need to look at the window data.
+        self.statusmarkup = []
 
     def to_jsonable(self):
         """Turn a GlkState into a jsonable dict. We use this for
@@ -64,14 +156,15 @@ class GlkState:
         you shouldn't hold onto the object returned by this call;
         serialize it immediately and discard it.
         """
-        obj = {}
+        obj = { 'v': GLKSTATE_VERSION }
         for key in GlkState._singleton_keys:
             obj[key] = getattr(self, key)
         for key in GlkState._contentlist_keys:
             arr = getattr(self, key)
-            obj[key] = [ dat.to_jsonable() for dat in arr ]
+            obj[key] = [ dat.to_compact() for dat in arr ]
         obj['statuslinestarts'] = strkeydict(self.statuslinestarts)
         obj['windows'] = strkeydict(self.windows)
+        obj['statusmarkup'] = self.statusmarkup
         if self.hyperlinkkeys:
             obj['hyperlinkkeys'] = strkeydict(self.hyperlinkkeys)
             # self.hyperlinklabels is a back-cache
@@ -83,12 +176,20 @@ class GlkState:
     @staticmethod
     def from_jsonable(obj):
         """Create a GlkState from a jsonable object (from to_jsonable).
+        This accepts the older (unversioned) format as well.
         """
+        version = obj.get('v', 1)
+        if version > GLKSTATE_VERSION:
+            raise Exception('unknown GlkState version %s' % (version,))
+        if version == 1:
+            linefunc = ContentLine.from_jsonable
+        else:
+            linefunc = ContentLine.from_compact
         state = GlkState()
         for key in GlkState._singleton_keys:
             setattr(state, key, obj[key])
         for key in GlkState._contentlist_keys:
-            ls = [ ContentLine.from_jsonable(val) for val in obj[key] ]
+            ls = [ linefunc(val) for val in obj[key] ]
             setattr(state, key, ls)
         state.statuslinestarts = intkeydict(obj['statuslinestarts'])
         state.windows = intkeydict(obj['windows'])
@@ -96,6 +197,10 @@ class GlkState:
             state.hyperlinkkeys = intkeydict(obj['hyperlinkkeys'])
             for (label, key) in state.hyperlinkkeys.items():
                 state.hyperlinklabels[key] = label
+        if 'statusmarkup' in obj:
+            state.statusmarkup = obj['statusmarkup']
+        else:
+            state.render_status()
         return state
     
     def accept_update(self, update, extrainput=None):
@@ -234,6 +339,14 @@ class GlkState:
                     self.hyperlinklabels[link] = counter
                     counter += 1
 
+        self.render_status()
+
+    def render_status(self):
+        """Fill in self.statusmarkup from the status window contents.
+        This must happen after the hyperlink labels are worked out.
+        """
+        self.statusmarkup = [ content_to_markup(val, self.hyperlinklabels) for val in self.statuswindat ]
+
     def construct_input(self, cmd):
         """Given a player command string, construct a GlkOte input
         appropriate to what the game is expecting.
@@ -283,12 +396,6 @@ def strkeydict(map):
 def intkeydict(map):
     return dict([ (int(key), val) for (key, val) in map.items() ])
 
-def stanza_is_transcript(sta):
-    """Returns true if the stanza is part of a transcript (as opposed
-    to a comment or metadata).
-    """
-    return sta.get('format') == 'glkote'
-            
 def storywindat_from_stanza(stanza, storywindat=None):
     """Look at a stanza (as from stanza_reader()), extract the story
     window output, and return it as a list of ContentLines.
@@ -337,6 +444,24 @@ class ContentLine:
         dat.arr = arr
         return dat
 
+    def to_compact(self):
+        """A shorter jsonable form, used for storing GlkStates. Most lines
+        are a single unstyled run; those become a plain string. Other
+        lines are stored as in to_jsonable().
+        """
+        if len(self.arr) == 1 and len(self.arr[0]) == 1:
+            return self.arr[0][0]
+        return self.arr
+
+    @staticmethod
+    def from_compact(val):
+        dat = ContentLine()
+        if isinstance(val, str):
+            dat.arr.append( (val,) )
+        else:
+            dat.arr = val
+        return dat
+
     def uniformlink(self):
         if not self.arr:
             return None
@@ -375,94 +500,206 @@ def extract_raw(line):
             res.add(val.get('text', ''), val.get('style', 'normal'), val.get('hyperlink', None))
     return res
 
-def stanza_reader(path):
-    """ Read a file as a sequence of newline-separated JSON stanzas.
-
-    A partial stanza at the end will be silently ignored.
+class StanzaDecoder:
+    """Incremental decoder for a stream of JSON stanzas (as bytes).
+    Feed it data as it arrives; it returns the stanzas that are complete,
+    as (offset, obj) pairs, where offset is the byte position of the
+    stanza's opening brace in the stream.
 
-    It's okay if the JSON has more whitespace or newlines. You just need
-    at least one newline between stanzas.
+    Stanzas may span several lines (RemGlk pretty-prints its output).
+    This runs in linear time. A stanza which is still incomplete is
+    not re-decoded until the buffer has doubled, or the data appears to
+    be at a stanza boundary (a pause in the stream right after a "}").
 
-    If non-JSON occurs at the start or between stanzas, this will throw
-    an exception. Bad formatting inside a stanza will silently end the
-    parsing (after reading in the entire rest of the file). No, that's not
-    ideal.
+    Anything which isn't a valid stanza is skipped, up to the next "{"
+    at the start of a line. (A parse error counts as bad data only if
+    there's a newline after it; before that, the stanza might just be
+    unfinished.) The skipped byte ranges are recorded in
+    self.skipped as (offset, length). A stanza that grows past maxsize
+    bytes without parsing is also skipped, so memory stays bounded.
     """
-    with open(path, 'r') as fl:
-        buf = ''
-        while True:
-            ln = fl.readline()
-            if not ln:
-                # End of file.
-                # We may have an incomplete stanza in the buffer, but we
-                # ignore that.
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.decoder = json.JSONDecoder()
+        self.buf = bytearray()
+        self.base = 0        # stream offset of buf[0]
+        self.retrysize = 0   # don't re-decode until we have this much
+        self.scanpos = 0     # how far stanza_closed() has looked
+        self.depth = 0       # brace depth at scanpos
+        self.junk = False    # skipping to the next resync point
+        self.skipped = []
+
+    def feed(self, dat):
+        """Add data to the stream. Returns a list of (offset, obj) for
+        the stanzas completed.
+        """
+        self.buf.extend(dat)
+        force = dat.rstrip().endswith(b'}')
+        return self.process(force=force)
+
+    def finish(self):
+        """Indicate end of stream. Returns a list of (offset, obj) for
+        any stanzas remaining. (An incomplete stanza is skipped.)
+        """
+        return self.process(final=True)
+
+    def skip(self, pos, end):
+        if end <= pos:
+            return
+        offset = self.base + pos
+        if self.skipped:
+            (lastoff, lastlen) = self.skipped[-1]
+            if lastoff + lastlen == offset:
+                self.skipped[-1] = (lastoff, lastlen + end - pos)
+                return
+        self.skipped.append( (offset, end - pos) )
+
+    def process(self, final=False, force=False):
+        if not (final or self.junk) and len(self.buf) < self.retrysize:
+            # Still waiting for an incomplete stanza to grow. (If the data
+            # ended with "}", check whether that closed the stanza.)
+            if not (force and self.stanza_closed()):
+                return []
+        res = []
+        buf = self.buf
+        text = buf.decode('utf-8', 'surrogateescape')
+        ascii = (len(text) == len(buf))
+        tpos = 0   # position in text
+        pos = 0    # the same position in buf
+        while tpos < len(text):
+            if self.junk:
+                end = text.find('\n{', tpos)
+                if end < 0:
+                    # Keep a trailing newline; it might start a resync point.
+                    end = len(text)
+                    if text.endswith('\n') and not final:
+                        end -= 1
+                    newpos = pos + bytelen(text, tpos, end, ascii)
+                    self.skip(pos, newpos)
+                    (tpos, pos) = (end, newpos)
+                    break
+                newpos = pos + bytelen(text, tpos, end+1, ascii)
+                self.skip(pos, newpos)
+                (tpos, pos) = (end+1, newpos)
+                self.junk = False
+                continue
+
+            # Whitespace is all ASCII, so pos moves in step.
+            end = pat_jsonspace.match(text, tpos).end()
+            pos += (end - tpos)
+            tpos = end
+            if tpos >= len(text):
                 break
-            if not buf:
-                buf = ln.lstrip()
-                if buf and not buf.startswith('{'):
-                    raise Exception('non-JSON encountered')
-            else:
-                buf = buf + ln
+            if text[tpos] != '{':
+                self.junk = True
+                continue
+
             try:
-                obj = json.loads(buf)
-            except:
+                (obj, end) = self.decoder.raw_decode(text, tpos)
+            except ValueError as ex:
+                obj = None
+                errpos = getattr(ex, 'pos', tpos)
+            if obj is not None:
+                res.append( (self.base+pos, obj) )
+                pos += bytelen(text, tpos, end, ascii)
+                tpos = end
+                self.retrysize = 0
+                continue
+
+            # If the error is on the last line of the data, the stanza
+            # may just be incomplete. (A stanza can span lines, so we
+            # can't judge until the parse reaches a newline.) Otherwise
+            # it's bad; skip to the next "{" at the start of a line.
+            if final or text.find('\n', errpos) >= 0:
+                self.junk = True
                 continue
-            yield obj
-            buf = ''
-
-def parse_json(val):
-    """Normally an interpreter returns a single JSON update stanza.
-    However, errors aren't always tidy. We might get one or more error
-    stanzas (type="error") in addition to the result. This function
-    deals with that situation; it returns (update, errorlist).
-    The errorlist is a list of strings (the "message" part of the error
-    stanza).
-    If there is no non-error stanza, update will be None.
-    Can raise JSONDecodeError for genuinely malformed JSON.
-    Note that the empty string (or whitespace) will return (None, []),
-    rather than raising JSONDecodeError.
+            if self.maxsize and len(buf)-pos > self.maxsize:
+                self.junk = True
+                continue
+            # Probably incomplete. Wait for more.
+            self.retrysize = 2 * (len(buf)-pos)
+            if self.maxsize:
+                self.retrysize = min(self.retrysize, self.maxsize+1)
+            break
+
+        if pos:
+            del buf[:pos]
+            self.base += pos
+            self.scanpos = 0
+            self.depth = 0
+        return res
+
+    def stanza_closed(self):
+        """Check whether the braces of the stanza at the start of the
+        buffer have balanced out. This scans incrementally, from where
+        the last call left off, so the cost is linear.
+        """
+        buf = self.buf
+        depth = self.depth
+        closed = False
+        pos = len(buf)
+        for match in pat_jsontoken.finditer(buf, self.scanpos):
+            tok = match.group()
+            if tok == b'{':
+                depth += 1
+            elif tok == b'}':
+                depth -= 1
+                if depth == 0:
+                    closed = True
+            elif tok == b'"':
+                # An unfinished string; resume here next time.
+                pos = match.start()
+                break
+        self.scanpos = pos
+        self.depth = depth
+        return closed
+
+def bytelen(text, start, end, ascii=False):
+    """The length in bytes of text[start:end], as encoded by
+    StanzaDecoder.
     """
-    try:
-        # The simple case: correct JSON.
-        obj = json.loads(val)
-        if obj.get('type') == 'error':
-            msg = obj.get('message', '???')
-            return (None, [ msg ])
-        return (obj, [])
-    except:
-        pass
-
-    # Assume this is a sequence of newline-separated JSON stanzas; try
-    # to decode that.
-    objls = []
-    errls = []
-    val = val.strip()
-    while val:
-        start = 0
+    if ascii:
+        return end - start
+    return len(text[start:end].encode('utf-8', 'surrogateescape'))
+
+pat_jsonspace = re.compile(r'[ \t\r\n]*')
+pat_jsontoken = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}"]')
+
+def stanza_reader(path, withoffsets=False, maxsize=64*1024*1024):
+    """Read a file as a sequence of newline-separated JSON stanzas.
+    If withoffsets is true, yield (offset, obj) pairs instead, where
+    offset is the stanza's byte position in the file.
+
+    Damaged data (non-JSON, a bad stanza, or a partial one at the end)
+    is logged and skipped; reading resumes at the next line that starts
+    with "{". This reads in fixed-size chunks, so memory use is bounded
+    (by maxsize, for a stanza that never ends).
+
+    A path ending in ".gz" is read as a gzip file.
+    """
+    if path.endswith('.gz'):
+        fl = gzip.open(path, 'rb')
+    else:
+        fl = open(path, 'rb')
+    decoder = StanzaDecoder(maxsize=maxsize)
+    with fl:
         while True:
-            pos = val.find(b'\n', start)
-            if pos < 0:
-                obj = json.loads(val)
-                pos = len(val)
-                break
-            try:
-                obj = json.loads(val[ : pos ])
+            dat = fl.read(65536)
+            if dat:
+                ls = decoder.feed(dat)
+            else:
+                ls = decoder.finish()
+            for (offset, obj) in ls:
+                if withoffsets:
+                    yield (offset, obj)
+                else:
+                    yield obj
+            if not dat:
                 break
-            except:
-                start = pos+1
-                continue
-        val = val[ pos : ].strip()
-        if obj.get('type') == 'error':
-            msg = obj.get('message', '???')
-            errls.append(msg)
-        else:
-            objls.append(obj)
-    if not objls:
-        return (None, errls)
-    if len(objls) == 1:
-        return (objls[0], errls)
-    errls.append('parse_json: more than one non-error result; discarding extras')
-    return (objls[0], errls)
+    if decoder.skipped:
+        (offset, _) = decoder.skipped[0]
+        total = sum([ length for (_, length) in decoder.skipped ])
+        logging.getLogger('cli').warning('Skipped %d bytes of bad data in %s (%d places, first at %d)', total, path, len(decoder.skipped), offset)
 
 def create_metrics(width=None, height=None):
     if not width:
@@ -478,4 +715,5 @@ def create_metrics(width=None, height=None):
 
 
 # Late imports
-from .markup import command_is_hyperlink
+from .markup import command_is_hyperlink, content_to_markup
+from .util import write_file_atomic
@@ -86,11 +86,20 @@ def escape(val):
 # Maximum size of a Discord message (minus a safety margin).
 MSG_LIMIT = 1990
 
-def rebalance_output(ls):
+# Don't bother filling the end of a message with a fragment of a long
+# paragraph if there's less room than this.
+MIN_FILL = MSG_LIMIT // 8
+
+def rebalance_output(ls, limit=MSG_LIMIT):
     """Given a list of lines (paragraphs) to be sent as a Discord message,
     combine them as much as possible while staying under the Discord
     size limit. If there are any lines longer than the limit, break
-    them up (preferably at word boundaries).
+    them up (preferably at sentence boundaries, then word boundaries).
+
+    Paragraphs are kept whole if they fit in a message. A paragraph
+    which is too long to fit anyway starts in the remaining space of
+    the current message, rather than a new one. Markup spans (bold,
+    italic, code) are closed at a split and reopened after it.
 
     This will introduce paragraph breaks into very long paragraphs;
     no help for that.
@@ -99,30 +108,39 @@ def rebalance_output(ls):
     cur = None
     for val in ls:
         if cur is not None:
-            if len(cur)+1+len(val) < MSG_LIMIT:
+            if len(cur)+1+len(val) < limit:
                 cur += '\n'
                 cur += val
                 continue
-        if cur:
-            res.append(cur)
-            cur = None
-        if len(val) < MSG_LIMIT:
+        if len(val) < limit:
+            if cur:
+                res.append(cur)
             cur = val
             continue
-        # This paragraph is over MSG_LIMIT by itself. Try to split it
-        # up at word boundaries. If we can't do that, just split it.
-        # BUG: This can split a markup span like "_italics_", which will
-        # break the markup.
-        while len(val) > MSG_LIMIT:
-            pos = val[ : MSG_LIMIT ].rfind(' ')
-            if pos >= 0:
-                res.append(val[ : pos ])
-                val = val[ pos+1 : ]
-                continue
-            res.append(val[ : MSG_LIMIT ])
-            val = val[ MSG_LIMIT : ]
+        # This paragraph is over the limit by itself, so it must be
+        # split. Fill up the current message first.
+        while True:
+            room = limit
+            if cur:
+                room -= (len(cur)+1)
+            if len(val) < room:
+                break
+            if room >= MIN_FILL:
+                (head, val) = split_markup(val, room)
+                if cur:
+                    cur += '\n'
+                    cur += head
+                else:
+                    cur = head
+            if cur:
+                res.append(cur)
+            cur = None
         if val:
-            res.append(val)
+            if cur:
+                cur += '\n'
+                cur += val
+            else:
+                cur = val
             
     if cur:
         res.append(cur)
@@ -133,3 +151,84 @@ def rebalance_output(ls):
     res = [ val.rstrip() for val in res ]
     res = [ val for val in res if val ]
     return res
+
+pat_sentence_end = re.compile('[.!?][\'"\\)\\]*_`]*(?=\\s)')
+
+def split_markup(val, room):
+    """Split a string of Discord markup (as generated by content_to_markup)
+    so that the first part is shorter than room. Returns (head, rest).
+    We split at a sentence boundary near the end if possible, otherwise
+    at a space, otherwise wherever we must (but never inside an escape
+    or a "**" marker). Any markup spans open at the split are closed at
+    the end of head and reopened at the start of rest.
+
+    Only the first room characters are scanned, so splitting a long
+    paragraph into pieces takes linear time overall. (The reopened
+    markers at the start of rest carry the open spans forward.)
+    """
+    # Leave space for closing markers ("**_`" at most).
+    maxlen = max(1, room - 5)
+    # Scan a little past maxlen, so that an escape or "**" straddling
+    # the cut point is seen whole.
+    (markers, nocut) = scan_markup(val[ : maxlen+2 ])
+
+    pos = -1
+    for match in pat_sentence_end.finditer(val, 0, maxlen):
+        pos = match.end()
+    if pos < maxlen * 3 // 4 or pos in nocut:
+        pos = val.rfind(' ', 0, maxlen)
+    if pos <= 0:
+        pos = maxlen
+        while pos in nocut:
+            pos -= 1
+
+    stack = []
+    for (mpos, marker) in markers:
+        if mpos >= pos:
+            break
+        if stack and stack[-1] == marker:
+            stack.pop()
+        elif marker in stack:
+            # Misnested; do our best.
+            stack.remove(marker)
+        else:
+            stack.append(marker)
+
+    head = val[ : pos ].rstrip() + ''.join(reversed(stack))
+    rest = ''.join(stack) + val[ pos : ].lstrip()
+    return (head, rest)
+
+def scan_markup(val):
+    """Find the markup markers in a string of Discord markup. Returns
+    (markers, nocut), where markers is a list of (pos, marker) and nocut
+    is a set of positions where the string must not be split.
+    Within a code span, nothing is markup except the closing backtick.
+    """
+    markers = []
+    nocut = set()
+    incode = False
+    pos = 0
+    while pos < len(val):
+        ch = val[pos]
+        if incode:
+            if ch == '`':
+                markers.append( (pos, '`') )
+                incode = False
+            pos += 1
+        elif ch == '\\' and pos+1 < len(val):
+            nocut.add(pos+1)
+            pos += 2
+        elif ch == '`':
+            markers.append( (pos, '`') )
+            incode = True
+            pos += 1
+        elif val.startswith('**', pos):
+            markers.append( (pos, '**') )
+            nocut.add(pos+1)
+            pos += 2
+        elif ch == '_':
+            markers.append( (pos, '_') )
+            pos += 1
+        else:
+            pos += 1
+    return (markers, nocut)
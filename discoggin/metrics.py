@@ -0,0 +1,159 @@
+import time
+import collections
+import logging
+from aiohttp import web
+
+# How many recent samples each histogram keeps for percentiles.
+SAMPLE_LIMIT = 1000
+
+# The stages of a turn, in order. (See DiscogClient.run_turn().)
+TURN_STAGES = [ 'db', 'load', 'prepare', 'queue', 'spawn', 'run', 'update', 'save', 'prespawn', 'render', 'send', 'total' ]
+
+class Histogram:
+    """Timings for one stage (with one set of labels). We keep the most
+    recent samples for percentiles, plus a running count and total.
+    """
+    def __init__(self):
+        self.samples = collections.deque(maxlen=SAMPLE_LIMIT)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, val):
+        self.samples.append(val)
+        self.count += 1
+        self.total += val
+
+def percentiles(samples):
+    """Given a sorted list of samples, return (p50, p95, p99, max).
+    """
+    def pick(frac):
+        return samples[int(frac * (len(samples)-1))]
+    return (pick(0.5), pick(0.95), pick(0.99), samples[-1])
+
+class TurnTimer:
+    """Times the stages of one turn. Call lap(stage) at the end of each
+    stage; the time since the previous lap is charged to that stage.
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+        self.last = self.start
+        self.stages = {}
+
+    def lap(self, stage):
+        now = time.monotonic()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self.last)
+        self.last = now
+
+    def total(self):
+        return time.monotonic() - self.start
+
+    def to_jsonable(self):
+        """The stage timings in integer milliseconds, for the transcript.
+        """
+        res = {}
+        for (stage, val) in self.stages.items():
+            res[stage] = int(val * 1000)
+        res['total'] = int(self.total() * 1000)
+        return res
+
+class Metrics:
+    """Collects timing histograms, labelled by stage, game format, and
+    server. (Those are the questions we ask when a turn is slow: where
+    did the time go, and is it one game or one server?)
+    """
+    def __init__(self):
+        self.histograms = {}   # maps (name, format, gid) to Histogram
+        self.started = time.time()
+
+    def observe(self, name, val, format=None, gid=None):
+        key = (name, format, gid)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = Histogram()
+            self.histograms[key] = hist
+        hist.observe(val)
+
+    def observe_turn(self, timer, format=None, gid=None):
+        for (stage, val) in timer.stages.items():
+            self.observe('turn.'+stage, val, format, gid)
+        self.observe('turn.total', timer.total(), format, gid)
+
+    def turn_stages(self):
+        """The turn stages which have been recorded, in order.
+        """
+        names = set([ key[0] for key in self.histograms ])
+        return [ stage for stage in TURN_STAGES if 'turn.'+stage in names ]
+
+    def summary(self, name, format=None, gid=None):
+        """Merge the histograms for a name, optionally restricted to one
+        format or server. Returns (count, p50, p95, p99, max), or None
+        if there are no samples.
+        """
+        samples = []
+        count = 0
+        for (key, hist) in self.histograms.items():
+            if key[0] != name:
+                continue
+            if format is not None and key[1] != format:
+                continue
+            if gid is not None and key[2] != gid:
+                continue
+            samples.extend(hist.samples)
+            count += hist.count
+        if not samples:
+            return None
+        samples.sort()
+        return (count,) + percentiles(samples)
+
+    def render_text(self, gauges=None):
+        """Render everything in the Prometheus text format. The gauges
+        argument is a dict of extra values (from the scheduler, etc).
+        """
+        ls = []
+        ls.append('# TYPE discoggin_seconds summary')
+        for (key, hist) in sorted(self.histograms.items(), key=lambda tup: str(tup[0])):
+            (name, format, gid) = key
+            labels = 'name="%s"' % (name,)
+            if format is not None:
+                labels += ',format="%s"' % (format,)
+            if gid is not None:
+                labels += ',guild="%s"' % (gid,)
+            if hist.samples:
+                (p50, p95, p99, _) = percentiles(sorted(hist.samples))
+                for (quant, val) in (('0.5', p50), ('0.95', p95), ('0.99', p99)):
+                    ls.append('discoggin_seconds{%s,quantile="%s"} %.6f' % (labels, quant, val,))
+            ls.append('discoggin_seconds_count{%s} %d' % (labels, hist.count,))
+            ls.append('discoggin_seconds_sum{%s} %.6f' % (labels, hist.total,))
+        if gauges:
+            for (key, val) in sorted(gauges.items()):
+                ls.append('discoggin_%s %s' % (key, val,))
+        ls.append('discoggin_uptime_seconds %d' % (time.time() - self.started,))
+        return '\n'.join(ls) + '\n'
+
+class MetricsServer:
+    """A tiny HTTP server which serves the metrics text at /metrics.
+    It listens on localhost only.
+    """
+    def __init__(self, app, port):
+        self.app = app
+        self.port = port
+        self.runner = None
+        self.logger = logging.getLogger('cli')
+
+    async def start(self):
+        webapp = web.Application()
+        webapp.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(webapp, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', self.port)
+        await site.start()
+        self.logger.info('Metrics available at http://127.0.0.1:%d/metrics', self.port)
+
+    async def handle(self, request):
+        text = self.app.metrics.render_text(self.app.gather_gauges())
+        return web.Response(text=text, content_type='text/plain')
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,69 @@
+from .sessions import PlayChannel
+
+class ObjCache:
+    """In-memory cache of PlayChannel, Session, and GameFile objects.
+    The channel list is loaded in full (there aren't many). Sessions
+    and games are loaded lazily, the first time they're asked for.
+    The cache is write-through: the accessors in asyncdb.py update it
+    whenever they change the database.
+    Changes made by the command-line tool (a separate process) show up
+    as a change in the database's data_version; asyncdb.check_data_version()
+    notices that and reloads the cache (see
+    DiscogClient.cache_playchannels()).
+    """
+    def __init__(self):
+        self.channels = {}   # gckey to PlayChannel
+        self.sessions = {}   # sessid to Session
+        self.games = {}      # hash to GameFile
+        self.dataversion = None   # data_version when the cache was loaded
+
+    def set_channels(self, chanls):
+        """Replace the whole cache with a fresh channel list.
+        Sessions and games are dropped too; they'll be reloaded as needed.
+        """
+        self.channels.clear()
+        self.sessions.clear()
+        self.games.clear()
+        for playchan in chanls:
+            self.channels[playchan.gckey] = playchan
+
+    def get_channel(self, gckey):
+        """Return a *copy* of the cached PlayChannel, or None.
+        Callers fill in channame, session, and game on the copy, so
+        those don't leak into the cache.
+        """
+        playchan = self.channels.get(gckey)
+        if playchan is None:
+            return None
+        return PlayChannel(playchan.gckey, playchan.gid, playchan.chanid, playchan.sessid, playchan.statusmsgid)
+
+    def get_channel_for_session(self, sessid):
+        for playchan in self.channels.values():
+            if playchan.sessid == sessid:
+                return self.get_channel(playchan.gckey)
+        return None
+
+    def set_channel_session(self, gckey, sessid):
+        playchan = self.channels.get(gckey)
+        if playchan is not None:
+            playchan.sessid = sessid
+
+    def set_channel_statusmsg(self, gckey, msgid):
+        playchan = self.channels.get(gckey)
+        if playchan is not None:
+            playchan.statusmsgid = msgid
+
+    def add_session(self, session):
+        self.sessions[session.sessid] = session
+
+    def delete_session(self, sessid):
+        self.sessions.pop(sessid, None)
+        for playchan in self.channels.values():
+            if playchan.sessid == sessid:
+                playchan.sessid = None
+
+    def add_game(self, game):
+        self.games[game.hash] = game
+
+    def delete_game(self, hash):
+        self.games.pop(hash, None)
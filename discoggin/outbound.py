@@ -0,0 +1,201 @@
+import time
+import collections
+import logging
+import asyncio
+
+from .markup import MSG_LIMIT
+
+class TokenBucket:
+    """A token bucket: up to burst actions at once, refilling at rate
+    per second.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self):
+        """How long until a token is available (zero if one is now).
+        """
+        self.refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class PendingSend:
+    def __init__(self, text, kwargs, fut, coalesce=True):
+        self.text = text
+        self.kwargs = kwargs
+        self.fut = fut
+        self.coalesce = coalesce and not kwargs
+        self.queuedtime = time.monotonic()
+
+class ChannelQueue:
+    """The messages waiting to go out to one Discord channel.
+    """
+    def __init__(self, chan, rate, burst):
+        self.chan = chan
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = collections.deque()
+        self.task = None
+        # The future for the most recently posted message.
+        self.lastfut = None
+
+    def __repr__(self):
+        return '<ChannelQueue %s: %d waiting>' % (self.chan.id, len(self.queue),)
+
+class OutboundScheduler:
+    """Paces the bot's messages to Discord channels.
+    Each channel has a token bucket, and there's a global one shared
+    by all channels. A channel's messages go out in order, from a worker
+    task which runs while the channel has anything queued. If several
+    plain-text messages are waiting for the same channel when its turn
+    comes, they are combined into one (as long as that fits in a
+    Discord message).
+    discord.py handles the actual rate-limit headers (and sleeps if we
+    hit a limit anyway). The buckets are static, set a bit under
+    Discord's published limits, so that we rarely get that far.
+    """
+    def __init__(self, chanrate=1.0, chanburst=5, globalrate=40.0, globalburst=40):
+        self.chanrate = chanrate
+        self.chanburst = chanburst
+        self.globalbucket = TokenBucket(globalrate, globalburst)
+        self.logger = logging.getLogger('cli.send')
+
+        self.channels = {}   # maps chanid to ChannelQueue
+
+        # Statistics.
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.delays = collections.deque(maxlen=500)
+
+    def post(self, chan, text, coalesce=True, **kwargs):
+        """Queue a message for a channel. Returns a future which resolves
+        to the sent Message (or raises if the send fails). Keyword
+        arguments are passed to chan.send(). Messages with arguments, or
+        with coalesce=False, are never combined with others. (Use that
+        if you need the Message to contain exactly this text.)
+        This must be called inside the async event loop.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        # Failures are logged by the worker; nobody has to look at them.
+        fut.add_done_callback(ignore_result)
+        cqueue = self.channels.get(chan.id)
+        if cqueue is None:
+            cqueue = ChannelQueue(chan, self.chanrate, self.chanburst)
+            self.channels[chan.id] = cqueue
+        cqueue.queue.append(PendingSend(text, kwargs, fut, coalesce=coalesce))
+        cqueue.lastfut = fut
+        if cqueue.task is None:
+            cqueue.task = asyncio.create_task(self.channel_loop(cqueue))
+        return fut
+
+    async def send(self, chan, text, coalesce=True, **kwargs):
+        """Send a message to a channel, waiting until it's gone out.
+        Returns the Message.
+        """
+        return await self.post(chan, text, coalesce=coalesce, **kwargs)
+
+    async def drain(self, chan):
+        """Wait until everything queued for a channel has gone out (or
+        failed).
+        """
+        cqueue = self.channels.get(chan.id)
+        if cqueue is None or cqueue.lastfut is None:
+            return
+        await asyncio.wait([ cqueue.lastfut ])
+
+    async def channel_loop(self, cqueue):
+        """Worker task for one channel. Exits when the queue is empty.
+        """
+        try:
+            while cqueue.queue:
+                while True:
+                    delay = max(cqueue.bucket.delay(), self.globalbucket.delay())
+                    if not delay:
+                        break
+                    await asyncio.sleep(delay)
+                cqueue.bucket.take()
+                self.globalbucket.take()
+
+                batch = [ cqueue.queue.popleft() ]
+                text = batch[0].text
+                kwargs = batch[0].kwargs
+                if batch[0].coalesce:
+                    while cqueue.queue:
+                        nextsend = cqueue.queue[0]
+                        if not nextsend.coalesce or len(text)+1+len(nextsend.text) >= MSG_LIMIT:
+                            break
+                        text = text + '\n' + nextsend.text
+                        batch.append(cqueue.queue.popleft())
+                    self.coalesced += (len(batch) - 1)
+
+                now = time.monotonic()
+                for pending in batch:
+                    self.delays.append(now - pending.queuedtime)
+                try:
+                    msg = await cqueue.chan.send(text, **kwargs)
+                except Exception as ex:
+                    self.failed += 1
+                    self.logger.warning('send to %s failed: %s', cqueue.chan.id, ex)
+                    for pending in batch:
+                        if not pending.fut.done():
+                            pending.fut.set_exception(ex)
+                    continue
+                self.sent += 1
+                for pending in batch:
+                    if not pending.fut.done():
+                        pending.fut.set_result(msg)
+        finally:
+            cqueue.task = None
+            if self.channels.get(cqueue.chan.id) is cqueue:
+                if cqueue.queue:
+                    # We were cancelled with messages still waiting.
+                    for pending in cqueue.queue:
+                        if not pending.fut.done():
+                            pending.fut.cancel()
+                    cqueue.queue.clear()
+                del self.channels[cqueue.chan.id]
+
+    async def close(self, timeout=5):
+        """Give queued messages a few seconds to go out, then give up
+        on them.
+        """
+        tasks = [ cqueue.task for cqueue in self.channels.values() if cqueue.task ]
+        if not tasks:
+            return
+        (_, pending) = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+    def stats(self):
+        """Return a dict of outbound statistics. The delays are how long
+        messages waited in the queue.
+        """
+        delays = sorted(self.delays)
+        res = {
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'queued': sum([ len(cqueue.queue) for cqueue in self.channels.values() ]),
+            'channelsqueued': len(self.channels),
+        }
+        if delays:
+            res['delayavg'] = sum(delays) / len(delays)
+            res['delayp95'] = delays[int(0.95 * (len(delays)-1))]
+            res['delaymax'] = delays[-1]
+        return res
+
+def ignore_result(fut):
+    if not fut.cancelled():
+        fut.exception()
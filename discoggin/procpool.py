@@ -0,0 +1,386 @@
+import time
+import collections
+import logging
+import asyncio
+import asyncio.subprocess
+
+class OutputTooLarge(Exception):
+    """Raised when an interpreter writes more than the output limit
+    in one turn.
+    """
+    pass
+
+class InvalidOutput(Exception):
+    """Raised when an interpreter's output contains no valid stanza at
+    all (but isn't empty). The message is the start of the output.
+    """
+    pass
+
+async def read_output(stream, decoder, pending, maxbytes=0, untilupdate=False):
+    """Read RemGlk output from an interpreter's stdout, decoding stanzas
+    as they arrive. Normally there's a single update stanza, but errors
+    aren't always tidy; we might get one or more error stanzas
+    (type="error") in addition to the result. Returns (update, errorlist).
+    The errorlist is a list of strings (the "message" part of the error
+    stanzas, plus a note about anything we couldn't decode).
+    If there is no non-error stanza, update will be None.
+
+    The decoder is a StanzaDecoder; pending is a deque of decoded
+    stanzas not yet consumed. (A live process keeps these between
+    turns.) If untilupdate is true, we return as soon as we have a
+    non-error stanza; otherwise we read to end of file.
+
+    If more than maxbytes arrive, raises OutputTooLarge. The caller
+    should kill the process. If the output was all garbage, raises
+    InvalidOutput.
+    """
+    update = None
+    errorls = []
+    total = 0
+    head = b''
+    skipcount = len(decoder.skipped)
+    while True:
+        while pending:
+            (_, obj) = pending.popleft()
+            if obj.get('type') == 'error':
+                errorls.append(obj.get('message', '???'))
+            elif update is None:
+                update = obj
+                if untilupdate:
+                    return (update, errorls)
+            else:
+                errorls.append('more than one non-error result; discarding extras')
+        if stream is None:
+            break
+        dat = await stream.read(65536)
+        if not dat:
+            pending.extend(decoder.finish())
+            stream = None
+            continue
+        total += len(dat)
+        if len(head) < 160:
+            head += dat[ : 160-len(head) ]
+        if maxbytes and total > maxbytes:
+            raise OutputTooLarge('interpreter output exceeded %d bytes' % (maxbytes,))
+        pending.extend(decoder.feed(dat))
+
+    skipped = decoder.skipped[ skipcount : ]
+    if skipped:
+        if update is None and not errorls:
+            raise InvalidOutput(head.decode('utf-8', 'replace'))
+        errorls.append('%d bytes of invalid output' % (sum([ length for (_, length) in skipped ]),))
+    return (update, errorls)
+
+async def run_single_turn(proc, indat, maxbytes=0):
+    """Send one input event to a single-turn interpreter and read its
+    output (to end of file). Returns (update, errorlist), as for
+    read_output(). If anything goes wrong (including a timeout which
+    cancels us), the process is killed.
+    """
+    try:
+        proc.stdin.write((indat+'\n').encode())
+        await proc.stdin.drain()
+        proc.stdin.close()
+        decoder = StanzaDecoder(maxsize=maxbytes)
+        res = await read_output(proc.stdout, decoder, collections.deque(), maxbytes=maxbytes)
+        await proc.wait()
+        return res
+    except BaseException:
+        kill_proc(proc)
+        raise
+
+class LiveProcess:
+    """A long-running interpreter process for one session.
+    This is an interpreter launched *without* the -singleturn option.
+    It sits there waiting for input events on stdin, and writes
+    update stanzas to stdout.
+    """
+    def __init__(self, sessid, hash, proc):
+        self.sessid = sessid
+        self.hash = hash
+        self.proc = proc
+        self.lastuse = time.time()
+        # Output read from stdout but not yet consumed.
+        self.decoder = StanzaDecoder()
+        self.pending = collections.deque()
+
+    def __repr__(self):
+        return '<LiveProcess s%s (pid %s)>' % (self.sessid, self.proc.pid,)
+
+    def isalive(self):
+        return self.proc.returncode is None
+
+    async def turn(self, indat, maxbytes=0):
+        """Send one input event to the interpreter and read back the
+        output stanzas. This stops after the first non-error stanza,
+        since the interpreter will then be blocked waiting for the
+        next input. (Or at end of file, if the process exits.)
+        Returns (update, errorlist), as for read_output().
+        """
+        self.lastuse = time.time()
+        self.proc.stdin.write((indat+'\n').encode())
+        await self.proc.stdin.drain()
+        self.decoder.maxsize = maxbytes
+        res = await read_output(self.proc.stdout, self.decoder, self.pending, maxbytes=maxbytes, untilupdate=True)
+        self.lastuse = time.time()
+        return res
+
+    async def shutdown(self, timeout=1.0):
+        """Close the process down. We close stdin and give the interpreter
+        a moment to exit on its own; if it doesn't, we kill it.
+        (The interpreters autosave whenever they wait for input, so
+        the on-disk state is current either way.)
+        """
+        if not self.isalive():
+            return
+        try:
+            self.proc.stdin.close()
+            await asyncio.wait_for(self.proc.wait(), timeout)
+        except Exception:
+            try:
+                self.proc.kill()
+            except ProcessLookupError:
+                pass
+            await self.proc.wait()
+
+class ProcPool:
+    """A pool of live interpreter processes, keyed by session ID.
+    This implements the optional persistent mode. Sessions that are being
+    actively played keep an interpreter running; when the pool is full,
+    the least-recently-used process is shut down. Processes that sit idle
+    too long are also shut down. A session without a live process falls
+    back to the normal single-turn behavior (autorestore, one move,
+    autosave). The pool never grows past maxprocs; if every process is
+    in the middle of a turn, a new session just doesn't get one.
+    """
+    def __init__(self, app, maxprocs=0, idletimeout=300):
+        self.app = app
+        self.maxprocs = maxprocs
+        self.idletimeout = idletimeout
+        self.logger = logging.getLogger('cli.procs')
+        # Maps sessid to LiveProcess, in LRU order (oldest first).
+        self.map = collections.OrderedDict()
+        self.idletask = None
+
+    def enabled(self):
+        return self.maxprocs > 0
+
+    def start(self):
+        """Begin the background task which shuts down idle processes.
+        This must be called inside the async event loop.
+        """
+        if self.enabled() and not self.idletask:
+            self.idletask = asyncio.create_task(self.idle_loop())
+
+    async def close(self):
+        """Shut down all live processes (at bot shutdown time).
+        """
+        if self.idletask:
+            self.idletask.cancel()
+            self.idletask = None
+        ls = list(self.map.values())
+        self.map.clear()
+        for live in ls:
+            await live.shutdown()
+        await wait_background()
+
+    def get(self, sessid, hash):
+        """Return the live process for a session, or None. This marks
+        the process as recently used.
+        A process which has exited, or which is running a different game
+        than expected, is discarded.
+        """
+        live = self.map.get(sessid)
+        if live is None:
+            return None
+        if not live.isalive() or live.hash != hash:
+            self.discard(sessid)
+            return None
+        self.map.move_to_end(sessid)
+        return live
+
+    async def launch(self, sessid, hash, iargs, env):
+        """Launch a new live process for a session. If the pool is full,
+        the least-recently-used process (that is not in the middle of
+        a turn) is shut down first. If they're all busy, we don't launch
+        anything; this returns None, and the caller should fall back to
+        single-turn mode.
+        """
+        self.discard(sessid)
+        while len(self.map) >= self.maxprocs:
+            victim = None
+            for (key, live) in self.map.items():
+                if key not in self.app.inflight:
+                    victim = key
+                    break
+            if victim is None:
+                self.logger.info('live process pool is full and busy; s%s runs single-turn', sessid)
+                return None
+            self.logger.info('evicting live process for s%s', victim)
+            self.discard(victim)
+        proc = await asyncio.create_subprocess_exec(
+            *iargs,
+            env=env,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        live = LiveProcess(sessid, hash, proc)
+        self.map[sessid] = live
+        self.logger.info('launched live process for s%s (%d running)', sessid, len(self.map))
+        return live
+
+    def discard(self, sessid):
+        """Remove a session's live process from the pool and shut it down.
+        This is safe to call if there is no such process. The shutdown
+        happens in the background.
+        """
+        live = self.map.pop(sessid, None)
+        if live is not None:
+            run_in_background(live.shutdown())
+
+    async def idle_loop(self):
+        """Background task: periodically shut down processes which have
+        not been used in idletimeout seconds.
+        """
+        interval = max(1, min(60, self.idletimeout / 4))
+        while True:
+            await asyncio.sleep(interval)
+            cutoff = time.time() - self.idletimeout
+            ls = [ key for (key, live) in self.map.items() if live.lastuse < cutoff or not live.isalive() ]
+            for key in ls:
+                if key in self.app.inflight:
+                    continue
+                self.logger.info('idle timeout for live process s%s', key)
+                self.discard(key)
+
+class Prespawner:
+    """Speculatively launched single-turn interpreters.
+    After a turn finishes, the next command for that session will
+    probably arrive soon. So we launch the next interpreter right away;
+    it does its autorestore and then blocks waiting for input. When the
+    command arrives, we only have to write it and read the result.
+    A pre-spawned process is tagged with the game generation it was
+    launched after. If the session has moved on (or been reset) by the
+    time it's needed, it is discarded rather than used. Unused processes
+    are killed after window seconds.
+    A pre-spawned process does real work (the autorestore), so it holds
+    a scheduler slot until it's claimed or killed. We only take a slot
+    that's free with nobody waiting; and if a turn needs a slot while
+    they're all taken, the scheduler calls reclaim() to kill the oldest
+    pre-spawned process.
+    """
+    def __init__(self, app, window=0):
+        self.app = app
+        self.window = window
+        self.logger = logging.getLogger('cli.procs')
+        # Maps sessid to (proc, hash, generation, timerhandle), oldest
+        # first. Each entry holds a scheduler slot.
+        self.map = collections.OrderedDict()
+
+    def enabled(self):
+        return self.window > 0
+
+    async def spawn(self, sessid, hash, generation, iargs, env):
+        """Launch a single-turn interpreter for a session and hold it
+        until take() or the window expires. If no scheduler slot is free,
+        this does nothing.
+        """
+        self.discard(sessid)
+        scheduler = self.app.scheduler
+        if not scheduler.try_acquire():
+            return
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *iargs,
+                env=env,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        except:
+            scheduler.release_speculative()
+            raise
+        loop = asyncio.get_running_loop()
+        handle = loop.call_later(self.window, self.expire, sessid, proc)
+        self.map[sessid] = (proc, hash, generation, handle)
+
+    def take(self, sessid, hash, generation):
+        """Claim the pre-spawned process for a session, if there is one
+        and it matches the game and generation we expect. Returns None
+        otherwise. The caller is responsible for the returned process.
+        """
+        tup = self.map.pop(sessid, None)
+        if tup is None:
+            return None
+        (proc, phash, pgeneration, handle) = tup
+        handle.cancel()
+        # The turn will acquire its own slot to run this.
+        self.app.scheduler.release_speculative()
+        if phash != hash or pgeneration != generation or proc.returncode is not None:
+            self.logger.info('discarding stale pre-spawned process for s%s', sessid)
+            kill_proc(proc)
+            return None
+        return proc
+
+    def expire(self, sessid, proc):
+        """Timer callback: the window has passed without the process
+        being used.
+        """
+        tup = self.map.get(sessid)
+        if tup is not None and tup[0] is proc:
+            del self.map[sessid]
+            self.app.scheduler.release_speculative()
+            kill_proc(proc)
+
+    def discard(self, sessid):
+        """Kill a session's pre-spawned process, if it has one.
+        Call this whenever the session state changes outside the normal
+        turn sequence (force-quit, restart, channel selection).
+        """
+        tup = self.map.pop(sessid, None)
+        if tup is not None:
+            (proc, _, _, handle) = tup
+            handle.cancel()
+            self.app.scheduler.release_speculative()
+            kill_proc(proc)
+
+    def reclaim(self):
+        """Kill the oldest pre-spawned process, to free its slot for a
+        real turn. (The scheduler calls this.)
+        """
+        if self.map:
+            sessid = next(iter(self.map))
+            self.logger.info('reclaiming pre-spawned process for s%s', sessid)
+            self.discard(sessid)
+
+    def close(self):
+        for sessid in list(self.map.keys()):
+            self.discard(sessid)
+
+def kill_proc(proc):
+    """Kill a subprocess (which we have no further use for). The process
+    is reaped in the background.
+    """
+    if proc.returncode is not None:
+        return
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        return
+    run_in_background(proc.wait())
+
+# Tasks started by run_in_background(). The event loop only keeps weak
+# references to tasks, so we hold on to them until they finish.
+_background = set()
+
+def run_in_background(coro):
+    """Run a coroutine as a task, without waiting for it.
+    """
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+async def wait_background():
+    """Wait for all the tasks started by run_in_background().
+    """
+    while _background:
+        await asyncio.gather(*list(_background), return_exceptions=True)
+
+# Late imports
+from .glk import StanzaDecoder
@@ -0,0 +1,182 @@
+import os, os.path
+import time
+import logging
+import asyncio
+
+from .util import delete_flat_dir, flat_dir_size
+from . import asyncdb
+
+class Reaper:
+    """Discards sessions and games which haven't been played for a while.
+    Every interval seconds we look for sessions not played in maxdays
+    days. Sessions which are selected in a channel, or which are in the
+    middle of a turn, are left alone. The rest are deleted in batches
+    of batchsize, pausing between batches so that a big backlog doesn't
+    hog the database or the disk. Then we delete games which have no
+    sessions left (and were installed at least maxdays ago).
+    File deletion happens in a worker thread; database work goes through
+    app.dbthread as usual.
+    Each sweep also re-measures the disk usage of sessions played since
+    the last one (see usage.py). That happens even if maxdays is zero
+    (meaning nothing expires).
+    """
+    def __init__(self, app, maxdays=30, interval=3600, batchsize=20, pause=1.0):
+        self.app = app
+        self.maxage = maxdays * 86400
+        self.interval = interval
+        self.batchsize = batchsize
+        self.pause = pause
+        self.logger = logging.getLogger('cli')
+        self.task = None
+
+        # Statistics.
+        self.sweeps = 0
+        self.sessionsreaped = 0
+        self.gamesreaped = 0
+        self.bytesreclaimed = 0
+
+    def enabled(self):
+        return (self.interval > 0)
+
+    def start(self):
+        if self.enabled() and not self.task:
+            self.task = asyncio.create_task(self.reap_loop())
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def reap_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception as ex:
+                self.logger.warning('Reaper sweep failed: %s', ex, exc_info=ex)
+
+    async def sweep(self):
+        """Do one pass. Returns (sessions deleted, games deleted, bytes
+        reclaimed).
+        """
+        app = self.app
+        sesscount = 0
+        gamecount = 0
+        totalbytes = 0
+
+        if self.maxage > 0:
+            (sesscount, gamecount, totalbytes) = await self.expire()
+        await app.usage.rescan_dirty(self.batchsize, self.pause)
+
+        self.sweeps += 1
+        self.sessionsreaped += sesscount
+        self.gamesreaped += gamecount
+        self.bytesreclaimed += totalbytes
+        if sesscount or gamecount:
+            self.logger.info('Reaper: deleted %d sessions and %d games, reclaimed %d bytes', sesscount, gamecount, totalbytes)
+        return (sesscount, gamecount, totalbytes)
+
+    async def expire(self):
+        """Delete expired sessions, then orphaned games. Returns
+        (sessions deleted, games deleted, bytes reclaimed).
+        """
+        app = self.app
+        loop = asyncio.get_running_loop()
+        cutoff = int(time.time()) - self.maxage
+        sesscount = 0
+        gamecount = 0
+        totalbytes = 0
+
+        sessls = await asyncdb.get_expired_sessions(app, cutoff)
+        sessls = [ session for session in sessls if session.sessid not in app.inflight ]
+        for ix in range(0, len(sessls), self.batchsize):
+            if ix:
+                await asyncio.sleep(self.pause)
+            for session in sessls[ ix : ix+self.batchsize ]:
+                res = await self.reap_session(session, cutoff)
+                if res is not None:
+                    sesscount += 1
+                    totalbytes += res
+
+        gamels = await asyncdb.get_orphan_games(app)
+        gamels = await loop.run_in_executor(None, self.filter_old_games, gamels, cutoff)
+        for ix in range(0, len(gamels), self.batchsize):
+            if ix:
+                await asyncio.sleep(self.pause)
+            for game in gamels[ ix : ix+self.batchsize ]:
+                res = await self.reap_game(game)
+                if res is not None:
+                    gamecount += 1
+                    totalbytes += res
+        return (sesscount, gamecount, totalbytes)
+
+    async def reap_session(self, session, cutoff):
+        """Delete one expired session. Returns the number of bytes
+        reclaimed, or None if the session turned out to be in use.
+        """
+        app = self.app
+        sessid = session.sessid
+        if sessid in app.inflight:
+            return None
+        # Holding the inflight flag keeps turns out while we work.
+        app.inflight.add(sessid)
+        try:
+            if not await asyncdb.delete_expired_session(app, sessid, cutoff):
+                return None
+            app.discard_session_procs(sessid)
+            app.glkstates.discard(sessid)
+            autosavedir = os.path.join(app.autosavedir, session.sessdir)
+            savefiledir = os.path.join(app.savefiledir, session.sessdir)
+            await app.transcripts.discard(autosavedir)
+            loop = asyncio.get_running_loop()
+            res = await loop.run_in_executor(None, delete_dirs, [ autosavedir, savefiledir ])
+            app.usage.forget(session.gid)
+            app.usage.dirty.discard(sessid)
+            session.logger().info('expired session deleted (%d bytes)', res)
+            return res
+        finally:
+            app.inflight.discard(sessid)
+
+    async def reap_game(self, game):
+        """Delete one orphaned game. Returns the number of bytes
+        reclaimed, or None if the game turned out to be in use.
+        """
+        app = self.app
+        if not await asyncdb.delete_orphan_game(app, game.hash):
+            return None
+        gamefiledir = os.path.join(app.gamesdir, game.hash)
+        loop = asyncio.get_running_loop()
+        res = await loop.run_in_executor(None, delete_dirs, [ gamefiledir ])
+        self.logger.info('Reaper: deleted game %s (%s, %d bytes)', game.filename, game.hash, res)
+        return res
+
+    def filter_old_games(self, gamels, cutoff):
+        """Keep the games whose files are older than cutoff. (A game
+        which was just installed has no sessions yet, but it's not
+        an orphan.) This runs in a worker thread.
+        """
+        res = []
+        for game in gamels:
+            path = os.path.join(self.app.gamesdir, game.hash, game.filename)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                mtime = 0
+            if mtime < cutoff:
+                res.append(game)
+        return res
+
+def delete_dirs(paths):
+    """Delete some flat directories, returning the total size of the
+    files removed. Errors are logged, not raised. This runs in a worker
+    thread.
+    """
+    total = 0
+    for path in paths:
+        try:
+            size = flat_dir_size(path)
+            delete_flat_dir(path)
+            total += size
+        except Exception as ex:
+            logging.getLogger('cli').warning('Reaper: could not delete %s: %s', path, ex)
+    return total
@@ -0,0 +1,255 @@
+import time
+import collections
+import logging
+import asyncio
+
+class SchedulerBusy(Exception):
+    """Raised when a turn cannot be queued because the queues are full.
+    """
+    pass
+
+class GuildQueue:
+    """The queued turns for one Discord server. Channels are served
+    round-robin within the server.
+    """
+    def __init__(self, gid, weight=1.0):
+        self.gid = gid
+        self.weight = weight
+        # Virtual finish tag of the last turn granted to this server.
+        self.lastfinish = 0.0
+        # Maps chanid to a deque of waiting futures, in round-robin order.
+        self.channels = collections.OrderedDict()
+        self.count = 0
+
+    def __repr__(self):
+        return '<GuildQueue %s: %d waiting>' % (self.gid, self.count,)
+
+class TurnScheduler:
+    """Controls how many interpreter processes run at once.
+    Every turn acquires a slot before launching (or feeding) an
+    interpreter. If all slots are busy, the turn waits in a queue.
+    Queues are served by weighted fair queuing across Discord servers
+    (self-clocked: each server's next turn gets a virtual finish tag of
+    1/weight past its last one, and the smallest tag goes first). Within
+    a server, channels take turns.
+    If the queues are too deep, acquire() raises SchedulerBusy rather
+    than adding to the backlog.
+    Speculative work (pre-spawned interpreters) can also hold slots, via
+    try_acquire(). Real turns come first: if a turn finds every slot
+    busy, the reclaimer callback is asked to give one speculative slot
+    back.
+    """
+    def __init__(self, maxrunning=4, maxqueued=32, maxguildqueued=8, weights=None):
+        self.maxrunning = maxrunning
+        self.maxqueued = maxqueued
+        self.maxguildqueued = maxguildqueued
+        self.weights = weights or {}
+        self.logger = logging.getLogger('cli.sched')
+
+        self.running = 0
+        self.speculative = 0   # how many of the running slots are speculative
+        self.reclaimer = None
+        self.queued = 0
+        self.vtime = 0.0
+        self.guilds = {}   # maps gid to GuildQueue
+
+        # Statistics, for sizing hosts.
+        self.granted = 0
+        self.shed = 0
+        self.maxdepth = 0
+        self.waittimes = collections.deque(maxlen=500)
+
+    def has_capacity(self):
+        """Return whether a slot is free with nobody waiting for it.
+        Speculative work (pre-spawning) should only start when this
+        is true.
+        """
+        return self.running < self.maxrunning and not self.queued
+
+    def try_acquire(self):
+        """Take a slot for speculative work, if one is free with nobody
+        waiting. Returns whether we got it. The holder must give it back
+        with release_speculative().
+        """
+        if not self.has_capacity():
+            return False
+        self.running += 1
+        self.speculative += 1
+        return True
+
+    def release_speculative(self):
+        self.speculative -= 1
+        self.release()
+
+    def slot(self, gid, chanid):
+        """Async context manager: acquire a slot for the duration of
+        the block.
+            async with app.scheduler.slot(gid, chanid):
+                ...
+        """
+        return SchedulerSlot(self, gid, chanid)
+
+    async def acquire(self, gid, chanid):
+        """Wait for a slot. Raises SchedulerBusy if the turn can't be
+        queued.
+        """
+        starttime = time.monotonic()
+        if self.running >= self.maxrunning and self.speculative and self.reclaimer:
+            # Bump some speculative work. (If turns are queued, the freed
+            # slot goes to the first of them.)
+            self.reclaimer()
+        if self.running < self.maxrunning and not self.queued:
+            self.running += 1
+            self.granted += 1
+            self.waittimes.append(0.0)
+            return
+
+        guild = self.guilds.get(gid)
+        if guild is None:
+            guild = GuildQueue(gid, self.weights.get(str(gid), 1.0))
+        if self.queued >= self.maxqueued or guild.count >= self.maxguildqueued:
+            self.shed += 1
+            self.logger.warning('shedding turn for %s-%s (%d queued)', gid, chanid, self.queued)
+            raise SchedulerBusy()
+
+        if gid not in self.guilds:
+            self.guilds[gid] = guild
+            # A server that was idle doesn't get credit for the idle time.
+            guild.lastfinish = max(guild.lastfinish, self.vtime)
+
+        fut = asyncio.get_running_loop().create_future()
+        if chanid not in guild.channels:
+            guild.channels[chanid] = collections.deque()
+        guild.channels[chanid].append(fut)
+        guild.count += 1
+        self.queued += 1
+        self.maxdepth = max(self.maxdepth, self.queued)
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # We were granted a slot just as we got cancelled.
+                self.release()
+            else:
+                self.remove_waiter(gid, chanid, fut)
+            raise
+        waittime = time.monotonic() - starttime
+        self.waittimes.append(waittime)
+        if waittime >= 1.0:
+            self.logger.info('turn for %s-%s waited %.2f sec (%d queued)', gid, chanid, waittime, self.queued)
+
+    def release(self):
+        """Give back a slot, and pass it along to the next waiting turn
+        (if any).
+        """
+        self.running -= 1
+        while self.queued and self.running < self.maxrunning:
+            fut = self.pop_next()
+            if fut is None:
+                break
+            self.running += 1
+            self.granted += 1
+            fut.set_result(True)
+
+    def pop_next(self):
+        """Remove and return the next waiting future, according to the
+        fair-queuing order. Returns None if nothing is waiting.
+        """
+        best = None
+        besttag = None
+        for guild in self.guilds.values():
+            tag = guild.lastfinish + 1.0 / guild.weight
+            if besttag is None or tag < besttag:
+                best = guild
+                besttag = tag
+        if best is None:
+            return None
+        self.vtime = besttag
+        best.lastfinish = besttag
+
+        (chanid, queue) = next(iter(best.channels.items()))
+        fut = queue.popleft()
+        if queue:
+            best.channels.move_to_end(chanid)
+        else:
+            del best.channels[chanid]
+        best.count -= 1
+        self.queued -= 1
+        if not best.count:
+            del self.guilds[best.gid]
+        return fut
+
+    def remove_waiter(self, gid, chanid, fut):
+        guild = self.guilds.get(gid)
+        if guild is None:
+            return
+        queue = guild.channels.get(chanid)
+        if queue is None or fut not in queue:
+            return
+        queue.remove(fut)
+        if not queue:
+            del guild.channels[chanid]
+        guild.count -= 1
+        self.queued -= 1
+        if not guild.count:
+            del self.guilds[gid]
+
+    def stats(self):
+        """Return a dict of scheduler statistics.
+        """
+        waits = sorted(self.waittimes)
+        res = {
+            'running': self.running,
+            'speculative': self.speculative,
+            'maxrunning': self.maxrunning,
+            'queued': self.queued,
+            'maxdepth': self.maxdepth,
+            'granted': self.granted,
+            'shed': self.shed,
+            'guildsqueued': len(self.guilds),
+        }
+        if waits:
+            res['waitavg'] = sum(waits) / len(waits)
+            res['waitp95'] = waits[int(0.95 * (len(waits)-1))]
+            res['waitmax'] = waits[-1]
+        return res
+
+class SchedulerSlot:
+    def __init__(self, scheduler, gid, chanid):
+        self.scheduler = scheduler
+        self.gid = gid
+        self.chanid = chanid
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.gid, self.chanid)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler.release()
+        return False
+
+def parse_weights(val):
+    """Parse a config line of the form "GID:WEIGHT, GID:WEIGHT, ...".
+    Weights must be positive numbers. Raises an exception for anything
+    malformed.
+    """
+    res = {}
+    if not val:
+        return res
+    for term in val.split(','):
+        term = term.strip()
+        if not term:
+            continue
+        gid, colon, weight = term.partition(':')
+        gid = gid.strip()
+        if not colon or not gid:
+            raise Exception('ServerWeights: expected GID:WEIGHT, got "%s"' % (term,))
+        try:
+            weight = float(weight)
+        except ValueError:
+            raise Exception('ServerWeights: bad weight in "%s"' % (term,))
+        if not (weight > 0 and weight != float('inf')):
+            raise Exception('ServerWeights: weight must be positive in "%s"' % (term,))
+        res[gid] = weight
+    return res
@@ -0,0 +1,130 @@
+import logging
+
+# The database schema is versioned with sqlite's user_version pragma.
+# Each entry in this list is a migration function which upgrades the
+# database from version N to version N+1. (So a database with
+# user_version 0 -- brand new, or created before versioning existed --
+# runs them all.) Add new migrations to the end; never change old ones.
+
+def migrate_create_tables(curs):
+    """Create the original tables.
+    A database from before schema versioning will already have these.
+    """
+    curs.execute('CREATE TABLE IF NOT EXISTS games(hash unique, filename, url, format)')
+    curs.execute('CREATE TABLE IF NOT EXISTS sessions(sessid unique, gid, hash, movecount, lastupdate)')
+    curs.execute('CREATE TABLE IF NOT EXISTS channels(gckey unique, gid, chanid, sessid)')
+
+def migrate_keys_and_indexes(curs):
+    """Add primary keys and indexes.
+    This gives sessions an autoincrementing ID, and indexes the common
+    lookups (sessions by server, game, and age; channels by session
+    and server). We rebuild each table, since sqlite can't add a primary
+    key in place. The columns stay untyped (except for the keys) so that stored
+    values keep their current types.
+    """
+    curs.execute('CREATE TABLE games_new(hash TEXT PRIMARY KEY, filename, url, format)')
+    curs.execute('INSERT INTO games_new (hash, filename, url, format) SELECT hash, filename, url, format FROM games')
+    curs.execute('DROP TABLE games')
+    curs.execute('ALTER TABLE games_new RENAME TO games')
+
+    curs.execute('CREATE TABLE sessions_new(sessid INTEGER PRIMARY KEY AUTOINCREMENT, gid, hash, movecount, lastupdate)')
+    curs.execute('INSERT INTO sessions_new (sessid, gid, hash, movecount, lastupdate) SELECT sessid, gid, hash, movecount, lastupdate FROM sessions')
+    curs.execute('DROP TABLE sessions')
+    curs.execute('ALTER TABLE sessions_new RENAME TO sessions')
+    curs.execute('CREATE INDEX sessions_gid ON sessions(gid)')
+    curs.execute('CREATE INDEX sessions_hash_gid ON sessions(hash, gid)')
+    curs.execute('CREATE INDEX sessions_lastupdate ON sessions(lastupdate)')
+
+    curs.execute('CREATE TABLE channels_new(gckey TEXT PRIMARY KEY, gid, chanid, sessid)')
+    curs.execute('INSERT INTO channels_new (gckey, gid, chanid, sessid) SELECT gckey, gid, chanid, sessid FROM channels')
+    curs.execute('DROP TABLE channels')
+    curs.execute('ALTER TABLE channels_new RENAME TO channels')
+    curs.execute('CREATE INDEX channels_sessid ON channels(sessid)')
+    curs.execute('CREATE INDEX channels_gid ON channels(gid)')
+
+def migrate_session_status(curs):
+    """Add a sessions column for the rendered status line.
+    This is a JSON array of strings (Discord markup), updated every turn,
+    so that displaying the status line is a simple lookup. NULL means
+    it hasn't been recorded; look at the GlkState instead.
+    """
+    curs.execute('ALTER TABLE sessions ADD COLUMN statusmarkup')
+
+def migrate_channel_statusmsg(curs):
+    """Add a channels column for the tracked status message.
+    This is the Discord message ID of the channel's status message, which
+    we edit in place (when the StatusMessage option is on).
+    """
+    curs.execute('ALTER TABLE channels ADD COLUMN statusmsgid')
+
+def migrate_gameinfo(curs):
+    """Add the gameinfo table.
+    This holds what we learned by looking inside a game file when it was
+    installed: size, Blorb layout, IFID, and header version. Games
+    installed before this have no row; "python -m discoggin scangames"
+    fills them in.
+    """
+    curs.execute('CREATE TABLE gameinfo(hash TEXT PRIMARY KEY, size, blorb, ifid, version, release, serial, execoffset, execlength, picts, sounds)')
+
+def migrate_session_usage(curs):
+    """Add sessions columns for disk usage.
+    These are the total sizes of the session's autosave directory
+    (including the transcript) and save-file directory, updated after
+    every turn. NULL means it hasn't been measured yet.
+    """
+    curs.execute('ALTER TABLE sessions ADD COLUMN autosavebytes')
+    curs.execute('ALTER TABLE sessions ADD COLUMN savefilebytes')
+
+migrations = [
+    migrate_create_tables,
+    migrate_keys_and_indexes,
+    migrate_session_status,
+    migrate_channel_statusmsg,
+    migrate_gameinfo,
+    migrate_session_usage,
+]
+
+SCHEMA_VERSION = len(migrations)
+
+def get_schema_version(db):
+    curs = db.cursor()
+    res = curs.execute('PRAGMA user_version')
+    return res.fetchone()[0]
+
+def get_data_version(db):
+    """Return sqlite's data_version stamp for the connection. This
+    changes whenever another connection (say, the command-line tool)
+    commits a change to the database; our own writes don't change it.
+    """
+    curs = db.cursor()
+    res = curs.execute('PRAGMA data_version')
+    return res.fetchone()[0]
+
+def upgrade_schema(db, report=None):
+    """Run whatever migrations are needed to bring the database up to
+    SCHEMA_VERSION. Each migration runs in its own transaction.
+    The report argument is a function to call with progress messages.
+    Returns the number of migrations run.
+    """
+    if report is None:
+        report = logging.getLogger('cli').info
+    version = get_schema_version(db)
+    if version > SCHEMA_VERSION:
+        raise Exception('database schema version %d is newer than this code (%d)' % (version, SCHEMA_VERSION,))
+    count = 0
+    curs = db.cursor()
+    while version < SCHEMA_VERSION:
+        func = migrations[version]
+        report('upgrading database to version %d: %s' % (version+1, func.__doc__.strip().splitlines()[0].rstrip('.'),))
+        curs.execute('BEGIN')
+        try:
+            func(curs)
+            # The pragma doesn't accept a bound parameter.
+            curs.execute('PRAGMA user_version = %d' % (version+1,))
+            curs.execute('COMMIT')
+        except:
+            curs.execute('ROLLBACK')
+            raise
+        version += 1
+        count += 1
+    return count
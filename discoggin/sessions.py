@@ -1,9 +1,10 @@
 import time
 import os, os.path
+import json
 import logging
 
 class Session:
-    def __init__(self, sessid, gid, hash, movecount=0, lastupdate=None):
+    def __init__(self, sessid, gid, hash, movecount=0, lastupdate=None, statusmarkup=None, autosavebytes=None, savefilebytes=None):
         if lastupdate is None:
             lastupdate = int(time.time())
         self.sessid = sessid
@@ -11,6 +12,13 @@ class Session:
         self.hash = hash
         self.movecount = movecount
         self.lastupdate = lastupdate
+        # List of strings, or None if not known. (Stored as JSON.)
+        if statusmarkup is not None:
+            statusmarkup = json.loads(statusmarkup)
+        self.statusmarkup = statusmarkup
+        # Disk usage, or None if not yet measured.
+        self.autosavebytes = autosavebytes
+        self.savefilebytes = savefilebytes
 
         self.sessdir = 's%d' % (self.sessid,)
 
@@ -21,12 +29,17 @@ class Session:
     def logger(self):
         return logging.getLogger('cli.s%d' % (self.sessid,))
 
+    def diskbytes(self):
+        return (self.autosavebytes or 0) + (self.savefilebytes or 0)
+
 class PlayChannel:
-    def __init__(self, gckey, gid, chanid, sessid=None):
+    def __init__(self, gckey, gid, chanid, sessid=None, statusmsgid=None):
         self.gckey = gckey
         self.gid = gid
         self.chanid = chanid
         self.sessid = sessid
+        # Message ID of the tracked status message, if any
+        self.statusmsgid = statusmsgid
 
         # Replaced more sensibly by get_valid_playchannel()
         self.channame = str(self.chanid)
@@ -116,15 +129,11 @@ def create_session(app, game, gid):
     """Create a new session for a game on a server.
     """
     curs = app.db.cursor()
-    res = curs.execute('SELECT sessid FROM sessions')
-    idlist = [ tup[0] for tup in res.fetchall() ]
-    if not idlist:
-        sessid = 1
-    else:
-        sessid = 1 + max(idlist)
-    tup = (sessid, gid, game.hash, 0, int(time.time()))
-    curs.execute('INSERT INTO sessions (sessid, gid, hash, movecount, lastupdate) VALUES (?, ?, ?, ?, ?)', tup)
-    return Session(*tup)
+    tup = (gid, game.hash, 0, int(time.time()))
+    curs.execute('INSERT INTO sessions (gid, hash, movecount, lastupdate) VALUES (?, ?, ?, ?)', tup)
+    # sessid is an autoincrement key, so IDs are never reused.
+    sessid = curs.lastrowid
+    return Session(sessid, *tup)
 
 def delete_session(app, sessid):
     """Delete a session and all its files (autosave and save files).
@@ -143,6 +152,25 @@ def delete_session(app, sessid):
     curs.execute('UPDATE channels SET sessid = ? WHERE sessid = ?', (None, sessid,))
     curs.execute('DELETE FROM sessions WHERE sessid = ?', (sessid,))
 
+def get_expired_sessions(app, cutoff):
+    """Get sessions which have not been played since cutoff (a timestamp)
+    and are not selected in any channel. Oldest first.
+    """
+    curs = app.db.cursor()
+    res = curs.execute('SELECT * FROM sessions WHERE lastupdate < ? AND sessid NOT IN (SELECT sessid FROM channels WHERE sessid IS NOT NULL) ORDER BY lastupdate', (cutoff,))
+    sessls = [ Session(*tup) for tup in res.fetchall() ]
+    return sessls
+
+def delete_expired_session(app, sessid, cutoff):
+    """Delete a session's database row, if it is still expired and
+    unselected. (Somebody may have selected or played it since we
+    looked.) Returns whether it was deleted. The caller is responsible
+    for deleting the session's files.
+    """
+    curs = app.db.cursor()
+    curs.execute('DELETE FROM sessions WHERE sessid = ? AND lastupdate < ? AND sessid NOT IN (SELECT sessid FROM channels WHERE sessid IS NOT NULL)', (sessid, cutoff,))
+    return (curs.rowcount > 0)
+
 def get_playchannels(app):
     """Get all channels (for all servers).
     """
@@ -191,13 +219,9 @@ def get_playchannel_for_session(app, sessid):
         return None
     return PlayChannel(*tup)
 
-def get_valid_playchannel(app, interaction=None, message=None, withgame=False):
-    """Get the channel for a given interaction or Discord message.
-    You must provide one or the other.
-    If withgame is true, this gets the session and game info for
-    the channel as well.
-    This is called very frequently (for every message on the server!) so
-    it relies on a cache of known play-channels for fast rejection.
+def playchannel_key(interaction=None, message=None):
+    """Work out the gckey for a given interaction or Discord message.
+    Returns (gckey, channame), or None if this is not a server channel.
     """
     channame = None
     if interaction:
@@ -226,6 +250,20 @@ def get_valid_playchannel(app, interaction=None, message=None, withgame=False):
         return None
     
     gckey = '%s-%s' % (gid, chanid,)
+    return (gckey, channame)
+
+def get_valid_playchannel(app, interaction=None, message=None, withgame=False):
+    """Get the channel for a given interaction or Discord message.
+    You must provide one or the other.
+    If withgame is true, this gets the session and game info for
+    the channel as well.
+    This is called very frequently (for every message on the server!) so
+    it relies on a cache of known play-channels for fast rejection.
+    """
+    tup = playchannel_key(interaction=interaction, message=message)
+    if not tup:
+        return None
+    (gckey, channame) = tup
     if gckey not in app.playchannels:
         # Fast check
         return None
@@ -253,14 +291,55 @@ def set_channel_session(app, playchan, session):
     curs = app.db.cursor()
     curs.execute('UPDATE channels SET sessid = ? WHERE gckey = ?', (session.sessid, playchan.gckey,))
 
-def update_session_movecount(app, session, movecount=None):
-    """Update the movecount and current time for a session.
+def set_channel_statusmsg(app, playchan, msgid):
+    """Record the tracked status message for a channel.
+    """
+    curs = app.db.cursor()
+    curs.execute('UPDATE channels SET statusmsgid = ? WHERE gckey = ?', (msgid, playchan.gckey,))
+
+def update_session_movecount(app, session, movecount=None, statusmarkup=None, usage=None):
+    """Update the movecount and current time for a session. If
+    statusmarkup is provided, record that too; likewise usage, which
+    is a tuple (autosavebytes, savefilebytes).
+    Returns the new (movecount, lastupdate).
     """
     if movecount is None:
         movecount = session.movecount + 1
     curs = app.db.cursor()
     lastupdate = int(time.time())
-    curs.execute('UPDATE sessions SET movecount = ?, lastupdate = ? WHERE sessid = ?', (movecount, lastupdate, session.sessid,))
+    cols = [ 'movecount = ?', 'lastupdate = ?' ]
+    vals = [ movecount, lastupdate ]
+    if statusmarkup is not None:
+        cols.append('statusmarkup = ?')
+        vals.append(json.dumps(statusmarkup))
+    if usage is not None:
+        cols.extend([ 'autosavebytes = ?', 'savefilebytes = ?' ])
+        vals.extend(usage)
+    vals.append(session.sessid)
+    curs.execute('UPDATE sessions SET %s WHERE sessid = ?' % (', '.join(cols),), vals)
+    return (movecount, lastupdate)
+
+def set_session_usage(app, session, usage):
+    """Record a session's disk usage, a tuple (autosavebytes,
+    savefilebytes).
+    """
+    curs = app.db.cursor()
+    curs.execute('UPDATE sessions SET autosavebytes = ?, savefilebytes = ? WHERE sessid = ?', tuple(usage) + (session.sessid,))
+
+def get_server_usage(app, gid):
+    """Return the total recorded disk usage of all sessions on a server.
+    """
+    curs = app.db.cursor()
+    res = curs.execute('SELECT SUM(autosavebytes), SUM(savefilebytes) FROM sessions WHERE gid = ?', (gid,))
+    (autosavebytes, savefilebytes) = res.fetchone()
+    return (autosavebytes or 0) + (savefilebytes or 0)
+
+def clear_session_statusmarkup(app, session):
+    """Forget the recorded status line for a session (because its
+    GlkState is gone).
+    """
+    curs = app.db.cursor()
+    curs.execute('UPDATE sessions SET statusmarkup = ? WHERE sessid = ?', (None, session.sessid,))
     
 
 
@@ -0,0 +1,270 @@
+import re
+import json
+import os, os.path
+import mmap
+import struct
+
+# How much of a file we look at to identify it. (Blorb files are
+# mmapped, so we only touch the pages we need.)
+SNIFF_PREFIX = 65536
+SNIFF_CHUNK = 1024*1024
+
+zcode_exts = ('.z1', '.z2', '.z3', '.z4', '.z5', '.z6', '.z7', '.z8', '.zblorb')
+glulx_exts = ('.ulx', '.gblorb')
+blorb_exts = ('.blorb', '.blb')
+json_exts = ('.json', '.js')
+
+class GameInfo:
+    """What we learned about a game file by looking at it. This is stored
+    in the gameinfo table when the game is installed.
+    Fields that don't apply (or weren't found) are None.
+    """
+    def __init__(self, hash=None, size=None, blorb=False, ifid=None, version=None, release=None, serial=None, execoffset=None, execlength=None, picts=None, sounds=None):
+        self.hash = hash
+        self.size = size
+        self.blorb = bool(blorb)
+        self.ifid = ifid
+        self.version = version
+        self.release = release
+        self.serial = serial
+        self.execoffset = execoffset
+        self.execlength = execlength
+        self.picts = picts
+        self.sounds = sounds
+
+    def __repr__(self):
+        ls = []
+        if self.blorb:
+            ls.append('blorb')
+        if self.ifid:
+            ls.append('ifid=%s' % (self.ifid,))
+        if self.version is not None:
+            ls.append('version=%s' % (self.version,))
+        return '<GameInfo %s: %s>' % (self.hash, ' '.join(ls),)
+
+def sniff_game(filename, path):
+    """Identify a game file, looking at its extension and then its
+    contents. Returns (format, GameInfo); the format is None if the file
+    isn't something we can play.
+    Only a bounded amount of the file is read (except for JSON files,
+    whose top-level keys may be anywhere; those are scanned in chunks).
+    """
+    _, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    info = GameInfo()
+
+    if not (ext in zcode_exts or ext in glulx_exts or ext in blorb_exts or ext in json_exts):
+        return (None, info)
+
+    with open(path, 'rb') as fl:
+        info.size = os.fstat(fl.fileno()).st_size
+        prefix = fl.read(SNIFF_PREFIX)
+
+        if ext in json_exts:
+            return (sniff_json(fl, prefix), info)
+
+        if prefix[0:4] == b'FORM' and prefix[8:12] == b'IFRS':
+            info.blorb = True
+            with mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                try:
+                    exectype = parse_blorb(mm, info)
+                except (struct.error, ValueError):
+                    # Damaged beyond what parse_blorb checks for.
+                    return (None, info)
+                if exectype == b'GLUL':
+                    if sniff_glulx(mm[ info.execoffset : info.execoffset+min(64, info.execlength) ], info):
+                        return ('glulx', info)
+                if exectype == b'ZCOD':
+                    if sniff_zcode(mm[ info.execoffset : info.execoffset+min(64, info.execlength) ], info):
+                        return ('zcode', info)
+            return (None, info)
+
+        if ext in glulx_exts and sniff_glulx(prefix, info):
+            return ('glulx', info)
+        if ext in zcode_exts and sniff_zcode(prefix, info):
+            return ('zcode', info)
+        return (None, info)
+
+def sniff_glulx(dat, info):
+    """Check a Glulx header. Fills in info.version and returns True if
+    it's good.
+    """
+    if len(dat) < 36 or dat[0:4] != b'Glul':
+        return False
+    (major, minor, sub) = struct.unpack('>HBB', dat[4:8])
+    info.version = '%d.%d.%d' % (major, minor, sub,)
+    return True
+
+def sniff_zcode(dat, info):
+    """Check a Z-code header. Fills in info.version, release, and
+    serial, and returns True if it's good.
+    """
+    if len(dat) < 64 or not (1 <= dat[0] <= 8):
+        return False
+    info.version = str(dat[0])
+    info.release = struct.unpack('>H', dat[2:4])[0]
+    serial = dat[0x12:0x18]
+    if serial.isdigit():
+        info.serial = serial.decode()
+    return True
+
+# The IFID in a Blorb's iFiction metadata.
+pat_ifid = re.compile(rb'<ifid>\s*([^<\s]+)\s*</ifid>', re.IGNORECASE)
+
+def parse_blorb(mm, info):
+    """Walk the chunks of a Blorb file (an mmap). Fills in the info
+    fields and returns the type of the executable chunk (b'GLUL',
+    b'ZCOD', etc) or None.
+    A chunk which runs past the end of the file is cut short, so a
+    truncated file can't send us out of bounds.
+    """
+    size = len(mm)
+    formlen = struct.unpack('>I', mm[4:8])[0]
+    end = min(size, 8+formlen)
+    execstart = None
+    chunks = {}   # start to (type, offset, length)
+    picts = 0
+    sounds = 0
+    pos = 12
+    while pos+8 <= end:
+        ctype = mm[pos:pos+4]
+        clen = struct.unpack('>I', mm[pos+4:pos+8])[0]
+        if pos+8+clen > end:
+            # Truncated chunk; keep what's actually there.
+            clen = end - (pos+8)
+        chunks[pos] = (ctype, pos+8, clen)
+        if ctype == b'RIdx' and clen >= 4:
+            count = struct.unpack('>I', mm[pos+8:pos+12])[0]
+            for ix in range(min(count, (clen-4) // 12)):
+                epos = pos+12+12*ix
+                (usage, _, start) = struct.unpack('>4sII', mm[epos:epos+12])
+                if usage == b'Exec':
+                    execstart = start
+                elif usage == b'Pict':
+                    picts += 1
+                elif usage == b'Snd ':
+                    sounds += 1
+        elif ctype == b'IFmd':
+            # The metadata is small; we only look at the first bit.
+            match = pat_ifid.search(mm[pos+8:pos+8+min(clen, SNIFF_PREFIX)])
+            if match:
+                info.ifid = match.group(1).decode('utf-8', 'replace')
+        pos += 8 + clen + (clen & 1)
+
+    info.picts = picts
+    info.sounds = sounds
+    if execstart is None or execstart not in chunks:
+        return None
+    (ctype, offset, length) = chunks[execstart]
+    info.execoffset = offset
+    info.execlength = length
+    return ctype
+
+# A JSON object, or one assigned to a Javascript variable (JSONP style).
+pat_jsonstart = re.compile(rb'^\s*(?:var\s+\w+\s*=\s*)?\{')
+# Everything up to the next quote or bracket.
+pat_jsonskip = re.compile(rb'[^"{}\[\]]*')
+# The body of a string, up to the closing quote (or the end of the
+# chunk, or a backslash at the end of the chunk).
+pat_jsonstring = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+pat_jsonspace = re.compile(rb'\s*')
+
+# Top-level keys longer than this aren't ones we care about.
+MAX_KEY = 256
+
+def sniff_json(fl, prefix):
+    """Decide whether a JSON file is an Ink or YarnSpinner game, by its
+    top-level keys: inkVersion for Ink, program and strings for
+    YarnSpinner. The keys are found by scanning the file a chunk at a
+    time (see json_top_keys()), stopping as soon as we know. If the
+    scan can't make sense of the file, we fall back to parsing the
+    whole thing.
+    """
+    if prefix.startswith(b'\xef\xbb\xbf'):
+        prefix = prefix[3:]
+    match = pat_jsonstart.match(prefix)
+    if not match:
+        return None
+    found = set()
+    try:
+        for key in json_top_keys(fl, prefix, match.end()):
+            if key == 'inkVersion':
+                return 'ink'
+            if key in ('program', 'strings'):
+                found.add(key)
+                if len(found) == 2:
+                    return 'ys'
+        return None
+    except ValueError:
+        pass
+
+    fl.seek(0)
+    try:
+        dat = fl.read().decode('utf-8-sig')
+        obj = json.loads(dat[ dat.index('{') : dat.rindex('}')+1 ])
+    except ValueError:
+        return None
+    if 'inkVersion' in obj:
+        return 'ink'
+    if 'program' in obj and 'strings' in obj:
+        return 'ys'
+    return None
+
+def json_top_keys(fl, dat, pos):
+    """Yield the keys of a JSON object, starting just inside its opening
+    brace at dat[pos], and reading on through fl (a chunk at a time)
+    as needed. Nested values are skipped over without being parsed.
+    Raises ValueError if the file ends before the object does.
+    """
+    depth = 1
+    while True:
+        pos = pat_jsonskip.match(dat, pos).end()
+        if pos >= len(dat):
+            dat = fl.read(SNIFF_CHUNK)
+            pos = 0
+            if not dat:
+                raise ValueError('unterminated JSON object')
+            continue
+        ch = dat[pos]
+        pos += 1
+        if ch in b'{[':
+            depth += 1
+            continue
+        if ch in b'}]':
+            depth -= 1
+            if depth == 0:
+                return
+            continue
+
+        # A string, which may run on into later chunks. We only keep
+        # the text of short ones at the top level.
+        parts = []
+        keylen = 0
+        while True:
+            end = pat_jsonstring.match(dat, pos).end()
+            if depth == 1 and keylen <= MAX_KEY:
+                parts.append(dat[pos:end])
+                keylen += (end - pos)
+            if dat[end:end+1] == b'"':
+                pos = end+1
+                break
+            # Keep a trailing backslash for the next chunk.
+            more = fl.read(SNIFF_CHUNK)
+            if not more:
+                raise ValueError('unterminated JSON string')
+            dat = dat[end:] + more
+            pos = 0
+        if depth != 1 or keylen > MAX_KEY:
+            continue
+
+        # It's a key if a colon follows.
+        while True:
+            pos = pat_jsonspace.match(dat, pos).end()
+            if pos < len(dat):
+                break
+            dat = fl.read(SNIFF_CHUNK)
+            pos = 0
+            if not dat:
+                raise ValueError('unterminated JSON object')
+        if dat[pos:pos+1] == b':':
+            yield json.loads(b'"' + b''.join(parts) + b'"')
@@ -0,0 +1,436 @@
+import os, os.path
+import re
+import json
+import gzip
+import shutil
+import struct
+import logging
+import asyncio
+
+# A session's transcript is a file of newline-separated JSON stanzas
+# (transcript.glktra, in the session's autosave directory). Alongside it
+# we keep an index (transcript.glkidx): the byte offset of every
+# "glkote" stanza, as a little-endian 64-bit integer. This lets us find
+# the last few moves without reading the whole transcript.
+#
+# The index entry is written *before* the stanza. So if something goes
+# wrong partway, the index may point at the end of the file (or at
+# a non-glkote stanza), which the reader will notice. It will never be
+# silently missing an entry.
+#
+# When the transcript grows past a size limit, it is rotated: renamed
+# (with its index) to transcript-0001.glktra, transcript-0002.glktra,
+# and so on. Rotated segments are then gzipped in the background. Their
+# indexes keep uncompressed offsets; gzip files can seek to those (by
+# decompressing up to that point, which is bounded by the segment size).
+# The readers here see all the segments, in order, as one transcript.
+#
+# The bot doesn't append to transcripts directly; it goes through a
+# TranscriptWriter, which buffers stanzas and writes them out in batches
+# from a worker thread.
+
+INDEX_ENTRY = struct.Struct('<Q')
+
+pat_segment = re.compile('^transcript-([0-9]+)[.]glktra(?:[.]gz)?$')
+
+def transcript_paths(autosavedir):
+    """Return (trapath, idxpath) for a session's autosave directory.
+    """
+    trapath = os.path.join(autosavedir, 'transcript.glktra')
+    idxpath = os.path.join(autosavedir, 'transcript.glkidx')
+    return (trapath, idxpath)
+
+def segment_paths(autosavedir, num):
+    """Return (trapath, idxpath) for a rotated segment (not yet gzipped).
+    """
+    trapath = os.path.join(autosavedir, 'transcript-%04d.glktra' % (num,))
+    idxpath = os.path.join(autosavedir, 'transcript-%04d.glkidx' % (num,))
+    return (trapath, idxpath)
+
+def list_segments(autosavedir):
+    """Return a list of the rotated segments in a session directory, as
+    (num, trapath, idxpath), oldest first. The trapath may end in ".gz".
+    (If a segment exists both ways, we were interrupted while gzipping
+    it. Either file is complete; we prefer the uncompressed one.)
+    """
+    found = {}
+    try:
+        ls = os.listdir(autosavedir)
+    except FileNotFoundError:
+        return []
+    for filename in ls:
+        match = pat_segment.match(filename)
+        if not match:
+            continue
+        num = int(match.group(1))
+        if num in found and not found[num].endswith('.gz'):
+            continue
+        found[num] = os.path.join(autosavedir, filename)
+    res = []
+    for num in sorted(found.keys()):
+        (_, idxpath) = segment_paths(autosavedir, num)
+        res.append( (num, found[num], idxpath) )
+    return res
+
+def open_segment(trapath):
+    """Open a transcript segment for binary reading, gzipped or not.
+    """
+    if trapath.endswith('.gz'):
+        return gzip.open(trapath, 'rb')
+    return open(trapath, 'rb')
+
+def encode_stanza(tradat):
+    """Turn a stanza (a jsonable dict) into the (isglkote, bytes) form
+    that append_stanzas() wants.
+    """
+    dat = (json.dumps(tradat) + '\n').encode()
+    return (tradat.get('format') == 'glkote', dat)
+
+def append_stanzas(autosavedir, stanzas, maxbytes=0):
+    """Append a list of encoded stanzas to a session's transcript,
+    updating the index for the glkote ones. The directory is created
+    if necessary.
+    If maxbytes is nonzero and the transcript has grown past it, rotate
+    it out. In that case, return a list of segment paths which should
+    be passed to compress_segment(). (Normally just the one we rotated,
+    but if we previously crashed before compressing, there may be more.)
+    Otherwise, return None.
+    """
+    (trapath, idxpath) = transcript_paths(autosavedir)
+    os.makedirs(autosavedir, exist_ok=True)
+    with open(trapath, 'ab') as outfl:
+        start = outfl.seek(0, os.SEEK_END)
+        # If the transcript is new, start an index. If the transcript
+        # exists but the index doesn't, leave it; the reader will
+        # rebuild it.
+        if start == 0 or os.path.exists(idxpath):
+            pos = start
+            entries = []
+            for (isglkote, dat) in stanzas:
+                if isglkote:
+                    entries.append(INDEX_ENTRY.pack(pos))
+                pos += len(dat)
+            if entries:
+                try:
+                    with open(idxpath, 'ab') as idxfl:
+                        idxfl.write(b''.join(entries))
+                except:
+                    remove_index(idxpath)
+                    raise
+        outfl.write(b''.join([ dat for (_, dat) in stanzas ]))
+        pos = outfl.tell()
+
+    if not maxbytes or pos < maxbytes:
+        return None
+    return rotate_transcript(autosavedir)
+
+def rotate_transcript(autosavedir):
+    """Move the current transcript (and index) aside as the next segment.
+    Returns a list of segments which need compressing.
+    """
+    (trapath, idxpath) = transcript_paths(autosavedir)
+    segls = list_segments(autosavedir)
+    num = (segls[-1][0] + 1) if segls else 1
+    (segpath, segidxpath) = segment_paths(autosavedir, num)
+    if os.path.exists(idxpath):
+        os.replace(idxpath, segidxpath)
+    os.replace(trapath, segpath)
+    res = [ path for (_, path, _) in segls if not path.endswith('.gz') ]
+    res.append(segpath)
+    return res
+
+def compress_segment(segpath):
+    """Gzip a rotated transcript segment. This may be slow, so run it in
+    a worker thread.
+    """
+    if not os.path.exists(segpath):
+        return
+    gzpath = segpath + '.gz'
+    tmppath = gzpath + '.tmp'
+    with open(segpath, 'rb') as infl:
+        with gzip.open(tmppath, 'wb') as outfl:
+            shutil.copyfileobj(infl, outfl, 1024*1024)
+    os.replace(tmppath, gzpath)
+    os.remove(segpath)
+
+class TranscriptWriter:
+    """Buffers transcript stanzas and appends them to the transcript
+    files in batches, from a worker thread. The buffer is flushed every
+    interval seconds, or sooner if it grows past maxpending bytes (in
+    which case write() waits for the flush).
+    Anybody reading a transcript should go through read_tail(), which
+    flushes the session and reads it under the writer's lock.
+    Segments rotated out (at segmentbytes) are gzipped in the background.
+    """
+    def __init__(self, segmentbytes=0, interval=1, maxpending=262144):
+        self.segmentbytes = segmentbytes
+        self.interval = interval
+        self.maxpending = maxpending
+        self.logger = logging.getLogger('cli')
+
+        self.pending = {}  # maps autosavedir to list of encoded stanzas
+        self.pendingbytes = 0
+        self.compressing = {}  # maps segment path to task
+        self.task = None
+        # These must be created inside the event loop.
+        self.lock = None
+        self.wakeup = None
+
+    def start(self):
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        if self.interval > 0 and not self.task:
+            self.task = asyncio.create_task(self.flush_loop())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+        if self.compressing:
+            await asyncio.gather(*self.compressing.values(), return_exceptions=True)
+
+    async def write(self, autosavedir, tradat):
+        """Add a stanza (a jsonable dict) to a session's transcript.
+        The stanza is encoded immediately, so the caller may reuse it.
+        Returns the number of bytes added.
+        """
+        tup = encode_stanza(tradat)
+        if autosavedir not in self.pending:
+            self.pending[autosavedir] = []
+        self.pending[autosavedir].append(tup)
+        self.pendingbytes += len(tup[1])
+        if not self.task or self.pendingbytes >= self.maxpending:
+            await self.flush()
+        return len(tup[1])
+
+    def pending_bytes(self, autosavedir):
+        """How much is buffered (not yet written) for a session.
+        """
+        ls = self.pending.get(autosavedir)
+        if not ls:
+            return 0
+        return sum([ len(dat) for (_, dat) in ls ])
+
+    async def discard(self, autosavedir):
+        """Drop whatever is buffered for a session which is about to be
+        deleted. This also waits out any write or compression in progress,
+        so that nothing touches the directory afterwards.
+        """
+        ls = self.pending.pop(autosavedir, None)
+        if ls:
+            self.pendingbytes -= sum([ len(dat) for (_, dat) in ls ])
+        if self.lock:
+            async with self.lock:
+                pass
+        prefix = os.path.join(autosavedir, '')
+        tasks = [ task for (segpath, task) in self.compressing.items() if segpath.startswith(prefix) ]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def flush_soon(self):
+        """Wake up the flush task, without waiting for it.
+        """
+        if self.wakeup and self.pending:
+            self.wakeup.set()
+
+    async def flush(self, autosavedir=None):
+        """Write out everything buffered for one session (or for all
+        sessions, if autosavedir is None).
+        """
+        if self.lock is None:
+            self.start()
+        # Hold the lock until the writes are done, so that a second
+        # flush for the same session can't get its batch in first.
+        async with self.lock:
+            segpaths = await self.flush_locked(autosavedir)
+        self.compress_later(segpaths)
+
+    async def read_tail(self, autosavedir, count):
+        """Flush a session and return the last count glkote stanzas of
+        its transcript (see read_transcript_tail()). The read happens
+        under the same lock as the writes, rotation, and compression,
+        so it never sees a half-written batch or a segment in the middle
+        of being gzipped.
+        """
+        if self.lock is None:
+            self.start()
+        async with self.lock:
+            segpaths = await self.flush_locked(autosavedir)
+            loop = asyncio.get_running_loop()
+            try:
+                res = await loop.run_in_executor(None, read_transcript_tail, autosavedir, count)
+            finally:
+                self.compress_later(segpaths)
+        return res
+
+    async def flush_locked(self, autosavedir):
+        """Write out the buffered stanzas (see flush()). The caller must
+        hold the lock. Returns a list of rotated segments to compress.
+        """
+        if autosavedir is None:
+            batches = self.pending
+            self.pending = {}
+        else:
+            ls = self.pending.pop(autosavedir, None)
+            batches = { autosavedir: ls } if ls else {}
+        if not batches:
+            return []
+        for ls in batches.values():
+            self.pendingbytes -= sum([ len(dat) for (_, dat) in ls ])
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.write_batches, batches)
+
+    def compress_later(self, segpaths):
+        """Start gzipping rotated segments in the background.
+        """
+        for segpath in segpaths:
+            if segpath not in self.compressing:
+                self.compressing[segpath] = asyncio.create_task(self.compress(segpath))
+
+    def write_batches(self, batches):
+        """Append each session's stanzas. This runs in a worker thread.
+        A failure for one session is logged (and those stanzas are lost);
+        it doesn't stop the others.
+        Returns a list of rotated segments to compress.
+        """
+        res = []
+        for (autosavedir, stanzas) in batches.items():
+            try:
+                segpaths = append_stanzas(autosavedir, stanzas, maxbytes=self.segmentbytes)
+                if segpaths:
+                    res.extend(segpaths)
+            except Exception as ex:
+                self.logger.warning('Failed to write transcript (%s): %s', autosavedir, ex, exc_info=ex)
+        return res
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as ex:
+                self.logger.warning('Transcript flush failed: %s', ex, exc_info=ex)
+
+    async def compress(self, segpath):
+        """Gzip a rotated transcript segment, off the event loop.
+        If this fails (or we shut down first), the segment stays
+        uncompressed and we'll try again at the next rotation.
+        This holds the lock, so that read_tail() doesn't catch the
+        segment half-renamed.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            async with self.lock:
+                await loop.run_in_executor(None, compress_segment, segpath)
+        except Exception as ex:
+            self.logger.warning('Failed to compress %s: %s', segpath, ex, exc_info=ex)
+        finally:
+            self.compressing.pop(segpath, None)
+
+def read_transcript_tail(autosavedir, count):
+    """Return the last count glkote stanzas of a session's transcript,
+    oldest first. If there is no transcript, return None.
+    This reads count index entries and count stanzas, regardless of
+    the length of the transcript. (If the current segment has fewer
+    than count moves, we continue into earlier segments.)
+    """
+    (trapath, idxpath) = transcript_paths(autosavedir)
+    segls = list_segments(autosavedir)
+    if os.path.exists(trapath):
+        segls.append( (None, trapath, idxpath) )
+    if not segls:
+        return None
+    res = []
+    for (_, segpath, segidxpath) in reversed(segls):
+        if len(res) >= count:
+            break
+        ls = read_segment_tail(segpath, segidxpath, count - len(res))
+        res = ls + res
+    return res
+
+def read_segment_tail(trapath, idxpath, count):
+    """Return the last count glkote stanzas of one segment. If the index
+    is missing or doesn't match the segment, we rebuild it first (reading
+    the whole segment, once).
+    """
+    if os.path.exists(idxpath):
+        res = read_indexed_stanzas(trapath, idxpath, count)
+        if res is not None:
+            return res
+        logging.getLogger('cli').warning('Transcript index is out of date: %s', idxpath)
+    rebuild_index(trapath, idxpath)
+    res = read_indexed_stanzas(trapath, idxpath, count)
+    if res is None:
+        raise Exception('transcript index could not be rebuilt')
+    return res
+
+def read_indexed_stanzas(trapath, idxpath, count):
+    """Use the index to read the last count glkote stanzas. Returns None
+    if the index turns out to be inconsistent with the transcript.
+    """
+    with open(idxpath, 'rb') as idxfl:
+        idxsize = idxfl.seek(0, os.SEEK_END)
+        total = idxsize // INDEX_ENTRY.size
+        first = max(0, total - count)
+        idxfl.seek(first * INDEX_ENTRY.size)
+        dat = idxfl.read((total - first) * INDEX_ENTRY.size)
+    offsets = [ tup[0] for tup in INDEX_ENTRY.iter_unpack(dat) ]
+    for ix in range(1, len(offsets)):
+        if offsets[ix] <= offsets[ix-1]:
+            return None
+
+    res = []
+    with open_segment(trapath) as fl:
+        for pos in offsets:
+            fl.seek(pos)
+            obj = read_stanza_at(fl)
+            if obj is None or obj.get('format') != 'glkote':
+                return None
+            res.append(obj)
+    return res
+
+def read_stanza_at(fl):
+    """Read one stanza starting at the current file position. Returns
+    None at end of file or if the data there isn't a stanza.
+    """
+    decoder = StanzaDecoder()
+    while True:
+        dat = fl.read(8192)
+        if dat:
+            ls = decoder.feed(dat)
+        else:
+            ls = decoder.finish()
+        if ls:
+            (offset, obj) = ls[0]
+            if offset != 0:
+                return None
+            return obj
+        if decoder.skipped or not dat:
+            return None
+
+def rebuild_index(trapath, idxpath):
+    """Scan a transcript and write a fresh index for it.
+    """
+    offsets = []
+    for (pos, obj) in stanza_reader(trapath, withoffsets=True):
+        if obj.get('format') == 'glkote':
+            offsets.append(pos)
+    tmppath = idxpath + '.tmp'
+    with open(tmppath, 'wb') as fl:
+        for pos in offsets:
+            fl.write(INDEX_ENTRY.pack(pos))
+    os.replace(tmppath, idxpath)
+
+def remove_index(idxpath):
+    try:
+        os.remove(idxpath)
+    except FileNotFoundError:
+        pass
+
+# Late imports
+from .glk import StanzaDecoder, stanza_reader
@@ -0,0 +1,146 @@
+import os.path
+import asyncio
+
+from .util import flat_dir_size
+from . import asyncdb
+
+class UsageTracker:
+    """Keeps track of disk usage and enforces quotas.
+    Each session's usage (its autosave directory, which includes the
+    transcript, and its save-file directory) is stored in the sessions
+    table. The directories are measured on a session's first turn.
+    After that, turns just add the sizes we already know: the change
+    in glkstate.json and the transcript stanzas written.
+    What we can't see that way (the interpreter's own autosave files,
+    save files, transcript segments being compressed) is caught up by
+    rescanning. Sessions which have played since they were last measured
+    are rescanned in the reaper's sweep. (/usage just reports the
+    recorded figures.)
+    Per-server totals are loaded from the database the first time
+    they're needed and then adjusted as sessions change.
+    A quota of zero means no limit.
+    """
+    def __init__(self, app, sessionquota=0, serverquota=0):
+        self.app = app
+        self.sessionquota = sessionquota
+        self.serverquota = serverquota
+        self.servers = {}   # maps gid to total bytes
+        self.dirty = set()  # sessids played since they were measured
+
+    def forget(self, gid=None):
+        """Drop the cached total for a server (or all servers). It will
+        be reloaded from the database when next needed.
+        """
+        if gid is None:
+            self.servers.clear()
+        else:
+            self.servers.pop(gid, None)
+
+    async def server_total(self, gid):
+        total = self.servers.get(gid)
+        if total is None:
+            total = await asyncdb.get_server_usage(self.app, gid)
+            self.servers[gid] = total
+        return total
+
+    def adjust(self, gid, delta):
+        if gid in self.servers:
+            self.servers[gid] += delta
+
+    async def measure(self, autosavedir, savefiledir):
+        """Measure a session's directories. Returns (autosavebytes,
+        savefilebytes). Transcript stanzas which are still buffered
+        are counted too.
+        """
+        pending = self.app.transcripts.pending_bytes(autosavedir)
+        loop = asyncio.get_running_loop()
+        autosavebytes = await loop.run_in_executor(None, flat_dir_size, autosavedir)
+        savefilebytes = await loop.run_in_executor(None, flat_dir_size, savefiledir)
+        return (autosavebytes + pending, savefilebytes)
+
+    async def turn_usage(self, session, delta, autosavedir, savefiledir):
+        """Work out a session's usage after a turn, given the change in
+        its glkstate.json size. Returns (autosavebytes, savefilebytes).
+        If the session has never been measured, this measures it.
+        """
+        if session.autosavebytes is None or session.savefilebytes is None:
+            return await self.measure(autosavedir, savefiledir)
+        self.dirty.add(session.sessid)
+        return (max(0, session.autosavebytes + delta), session.savefilebytes)
+
+    async def rescan(self, session):
+        """Measure a session's directories and record the result.
+        Returns False if the session is in the middle of a turn (and
+        so was left alone).
+        """
+        app = self.app
+        if session.sessid in app.inflight:
+            return False
+        autosavedir = os.path.join(app.autosavedir, session.sessdir)
+        savefiledir = os.path.join(app.savefiledir, session.sessdir)
+        usage = await self.measure(autosavedir, savefiledir)
+        # A turn may have started while we were measuring; if so, it
+        # will have the final word.
+        if session.sessid in app.inflight:
+            return False
+        oldbytes = session.diskbytes()
+        await asyncdb.set_session_usage(app, session, usage)
+        self.note_update(session, oldbytes)
+        self.dirty.discard(session.sessid)
+        return True
+
+    async def rescan_dirty(self, batchsize=20, pause=1.0):
+        """Rescan the sessions which have played since they were last
+        measured, batchsize at a time. Returns the number rescanned.
+        """
+        count = 0
+        sessids = list(self.dirty)
+        for ix in range(0, len(sessids), batchsize):
+            if ix:
+                await asyncio.sleep(pause)
+            for sessid in sessids[ ix : ix+batchsize ]:
+                session = await asyncdb.get_session_by_id(self.app, sessid)
+                if session is None:
+                    self.dirty.discard(sessid)
+                    continue
+                if await self.rescan(session):
+                    count += 1
+        return count
+
+    def note_update(self, session, oldbytes):
+        """Call after a session's usage has been updated, with its
+        previous total.
+        """
+        self.adjust(session.gid, session.diskbytes() - oldbytes)
+
+    def note_transcript(self, session, count):
+        """Note that count bytes were added to a session's transcript.
+        """
+        obj = self.app.objcache.sessions.get(session.sessid)
+        for sess in set([ session, obj ]):
+            if sess is not None:
+                sess.autosavebytes = (sess.autosavebytes or 0) + count
+        self.adjust(session.gid, count)
+
+    async def check(self, session):
+        """See whether a session may run another turn. Returns None if
+        so, or a message explaining why not.
+        """
+        if self.sessionquota and session.diskbytes() >= self.sessionquota:
+            return 'This session is using %s of disk space, which is over the limit of %s. (Try **/newsession** to start over.)' % (format_bytes(session.diskbytes()), format_bytes(self.sessionquota),)
+        if self.serverquota:
+            total = await self.server_total(session.gid)
+            if total >= self.serverquota:
+                return 'Game sessions on this server are using %s of disk space, which is over the limit of %s.' % (format_bytes(total), format_bytes(self.serverquota),)
+        return None
+
+def format_bytes(val):
+    """Format a byte count for display.
+    """
+    if val < 1000:
+        return '%d bytes' % (val,)
+    if val < 1000000:
+        return '%.1f kB' % (val / 1000,)
+    if val < 1000000000:
+        return '%.1f MB' % (val / 1000000,)
+    return '%.1f GB' % (val / 1000000000,)
@@ -1,5 +1,7 @@
 import os, os.path
 import json
+import logging
+import asyncio
 
 def delete_flat_dir(path):
     """Delete a directory and all the files it contains. This is *not*
@@ -18,6 +20,19 @@ def delete_flat_dir(path):
         os.remove(ent.path)
     os.rmdir(path)
     
+def flat_dir_size(path):
+    """Return the total size of the files in a directory (not
+    recursive). A missing directory counts as zero.
+    """
+    total = 0
+    try:
+        for ent in os.scandir(path):
+            if ent.is_file(follow_symlinks=False):
+                total += ent.stat(follow_symlinks=False).st_size
+    except FileNotFoundError:
+        pass
+    return total
+    
 def load_json(path):
     """
     Read and parse a JSON file. Allow for the possibility of JSONP
@@ -30,3 +45,94 @@ def load_json(path):
     dat = dat[ startpos : endpos+1 ]
     return json.loads(dat)
 
+
+def write_file_atomic(path, dat, fsync=False):
+    """Write a string to a file, replacing it atomically. We write a
+    temporary file alongside it and then rename it into place. If fsync
+    is true, the data is flushed to disk before the rename.
+    """
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as fl:
+        fl.write(dat)
+        if fsync:
+            fl.flush()
+            os.fsync(fl.fileno())
+    os.replace(tmppath, path)
+
+class FileSyncer:
+    """Decides when files written by write_file_atomic() get fsynced.
+    The mode is "none" (leave it to the OS), "always" (fsync every
+    write before renaming it into place), or "batch" (collect written
+    paths and fsync them, and their directories, every interval
+    seconds in a worker thread).
+    """
+    def __init__(self, mode='none', interval=5):
+        if mode not in ('none', 'always', 'batch'):
+            raise Exception('unknown sync mode: %s' % (mode,))
+        self.mode = mode
+        self.interval = interval
+        self.pending = set()
+        self.task = None
+        self.logger = logging.getLogger('cli')
+
+    def immediate(self):
+        """Should the writer fsync right away?
+        """
+        return (self.mode == 'always')
+
+    def add(self, path):
+        """Note that a file has been written.
+        """
+        if self.mode == 'batch':
+            self.pending.add(path)
+
+    def start(self):
+        if self.mode == 'batch' and not self.task:
+            self.task = asyncio.create_task(self.sync_loop())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        paths = self.pending
+        self.pending = set()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, sync_paths, paths)
+
+    async def sync_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as ex:
+                self.logger.warning('fsync failed: %s', ex, exc_info=ex)
+
+def sync_paths(paths):
+    """fsync a bunch of files, and then the directories containing them
+    (so that renames are durable too).
+    """
+    dirs = set()
+    for path in paths:
+        dirs.add(os.path.dirname(path))
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for dirpath in dirs:
+        try:
+            fd = os.open(dirpath, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,34 @@
+from discoggin.games import GameFile
+from discoggin.catalog import GameCatalog
+
+def make_catalog(names):
+    catalog = GameCatalog()
+    catalog.load([ GameFile('hash%d' % (ix,), name, 'http://x/'+name, 'zcode') for ix, name in enumerate(names) ])
+    return catalog
+
+def test_search_ranking():
+    catalog = make_catalog([ 'advent.z5', 'zork1.z5', 'zork2.z5', 'minizork.z3' ])
+    names = [ game.filename for game in catalog.search('zork') ]
+    assert names == [ 'zork1.z5', 'zork2.z5', 'minizork.z3' ]
+    assert catalog.search('hash0')[0].filename == 'advent.z5'
+
+def test_short_words_use_index():
+    catalog = make_catalog([ 'zork i.z5', 'zork ii.z5', 'advent.z5' ])
+    # Only games sharing trigrams with "zork" are considered, but the
+    # short word still has to match.
+    names = [ game.filename for game in catalog.search('zork i') ]
+    assert names[0] == 'zork i.z5'
+    assert 'advent.z5' not in names
+    # With no long words, everything is scanned.
+    assert [ game.filename for game in catalog.search('ii') ] == [ 'zork ii.z5' ]
+
+def test_find_requires_unique_match():
+    catalog = make_catalog([ 'zork1.z5', 'zork2.z5', 'advent.z5' ])
+    assert catalog.find('zork1.z5').filename == 'zork1.z5'
+    assert catalog.find('adv').filename == 'advent.z5'
+    assert catalog.find('hash1').filename == 'zork2.z5'
+    # Two equally good prefix matches.
+    assert catalog.find('zork') is None
+    # Similar but not a match.
+    assert catalog.search('advant')
+    assert catalog.find('advant') is None
@@ -0,0 +1,40 @@
+from discoggin.glk import StanzaDecoder
+
+def decode_all(dat, chunksize):
+    decoder = StanzaDecoder()
+    res = []
+    for pos in range(0, len(dat), chunksize):
+        res.extend(decoder.feed(dat[ pos : pos+chunksize ]))
+    res.extend(decoder.finish())
+    return (res, decoder.skipped)
+
+def test_one_line_stanzas():
+    dat = b'{"type":"update","gen":1}\n{"type":"update","gen":2}\n'
+    for chunksize in (1, 7, 1000):
+        (res, skipped) = decode_all(dat, chunksize)
+        assert res == [ (0, {'type':'update', 'gen':1}), (26, {'type':'update', 'gen':2}) ]
+        assert skipped == []
+
+def test_multiline_stanza():
+    # RemGlk pretty-prints, so "{" at the start of a line may be inside
+    # a stanza.
+    dat = b'{"type":"update","gen":1,\n"windows":[\n{ "id":1 }\n]}\n'
+    for chunksize in (1, 5, 38, 1000):
+        (res, skipped) = decode_all(dat, chunksize)
+        assert res == [ (0, {'type':'update', 'gen':1, 'windows':[ {'id':1} ]}) ]
+        assert skipped == []
+
+def test_multiline_stanza_prompt():
+    # The stanza is returned as soon as its closing brace arrives.
+    dat = b'{"type":"update",\n"windows":[\n{ "id":1 }\n]}'
+    decoder = StanzaDecoder()
+    for pos in range(len(dat)-1):
+        assert decoder.feed(dat[pos:pos+1]) == []
+    assert decoder.feed(dat[-1:]) == [ (0, {'type':'update', 'windows':[ {'id':1} ]}) ]
+
+def test_bad_data_skipped():
+    dat = b'junk\n{"a": bad}\n{"b":\n 2}\n{"c":"\xc3\xa9 {\\"}"}\n{"d":1'
+    for chunksize in (1, 3, 1000):
+        (res, skipped) = decode_all(dat, chunksize)
+        assert res == [ (16, {'b':2}), (26, {'c':'\xe9 {"}'}) ]
+        assert skipped == [ (0, 16), (42, 6) ]
@@ -0,0 +1,29 @@
+from discoggin import markup
+from discoggin.markup import rebalance_output, MSG_LIMIT
+
+def test_short_paragraphs_combined():
+    assert rebalance_output([ 'one', 'two', 'three' ]) == [ 'one\ntwo\nthree' ]
+
+def test_split_keeps_spans_balanced():
+    para = 'Some **bold text** and _italic_ words with `code` here. ' * 200
+    res = rebalance_output([ para ])
+    assert len(res) > 1
+    for val in res:
+        assert len(val) < MSG_LIMIT
+        assert val.count('**') % 2 == 0
+        assert val.count('`') % 2 == 0
+
+def test_long_paragraph_linear(monkeypatch):
+    # Splitting must only scan the text near each cut, not the whole
+    # remainder every time.
+    scanned = [ 0 ]
+    origscan = markup.scan_markup
+    def countscan(val):
+        scanned[0] += len(val)
+        return origscan(val)
+    monkeypatch.setattr(markup, 'scan_markup', countscan)
+
+    para = ('Some **bold text** and _italic_ words with `code` here. ' * 4000)[ : 200000 ]
+    res = rebalance_output([ para ])
+    assert len(res) > 100
+    assert scanned[0] <= 2 * len(para)
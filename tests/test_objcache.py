@@ -0,0 +1,69 @@
+import asyncio
+import sqlite3
+
+from discoggin.schema import upgrade_schema
+from discoggin.asyncdb import DBThread, get_valid_playchannel, get_data_version
+from discoggin.asyncdb import get_playchannels
+from discoggin.objcache import ObjCache
+
+class FakeObj:
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name
+
+class FakeMessage:
+    def __init__(self, gid, chanid):
+        self.guild = FakeObj(gid)
+        self.channel = FakeObj(chanid, 'chan%d' % (chanid,))
+
+class FakeApp:
+    """Just enough of DiscogClient to run the cached accessors.
+    """
+    def __init__(self, dbfile):
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.isolation_level = None
+        self.dbthread = DBThread()
+        self.objcache = ObjCache()
+        self.playchannels = set()
+        self.reloads = 0
+
+    async def cache_playchannels(self):
+        self.reloads += 1
+        self.objcache.dataversion = await get_data_version(self)
+        ls = await get_playchannels(self)
+        self.objcache.set_channels(ls)
+        self.playchannels = set([ chan.gckey for chan in ls ])
+
+def test_cli_change_reloads_cache(tmp_path):
+    dbfile = str(tmp_path / 'test.db')
+    # Stands in for the command-line tool.
+    cli = sqlite3.connect(dbfile)
+    upgrade_schema(cli, report=lambda msg: None)
+    cli.execute('INSERT INTO channels (gckey, gid, chanid) VALUES (?, ?, ?)', ('1-2', '1', '2'))
+    cli.commit()
+
+    async def run():
+        app = FakeApp(dbfile)
+        await app.cache_playchannels()
+        assert app.reloads == 1
+        msg = FakeMessage(1, 2)
+
+        playchan = await get_valid_playchannel(app, message=msg)
+        assert playchan.gckey == '1-2'
+        assert app.reloads == 1
+
+        # Our own writes don't count as outside changes.
+        await app.dbthread.run(app.db.execute, 'UPDATE channels SET sessid = 5')
+        playchan = await get_valid_playchannel(app, message=msg)
+        assert playchan is not None
+        assert app.reloads == 1
+
+        cli.execute('DELETE FROM channels WHERE gckey = ?', ('1-2',))
+        cli.commit()
+        playchan = await get_valid_playchannel(app, message=msg)
+        assert playchan is None
+        assert app.reloads == 2
+        assert '1-2' not in app.playchannels
+
+        app.dbthread.close()
+    asyncio.run(run())
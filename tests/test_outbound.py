@@ -0,0 +1,115 @@
+import time
+import asyncio
+
+import pytest
+
+from discoggin.outbound import OutboundScheduler
+from discoggin.markup import MSG_LIMIT
+
+class FakeChannel:
+    """Records what was sent to it, and when. If gate is set, each send
+    waits for it.
+    """
+    def __init__(self, id, gate=None, fail=False):
+        self.id = id
+        self.gate = gate
+        self.fail = fail
+        self.sent = []
+
+    async def send(self, text, **kwargs):
+        if self.gate:
+            await self.gate.wait()
+        if self.fail:
+            raise Exception('send failed')
+        self.sent.append( (time.monotonic(), text, kwargs) )
+        return len(self.sent)
+
+def texts(chan):
+    return [ text for (_, text, _) in chan.sent ]
+
+def test_coalesce():
+    async def run():
+        outbound = OutboundScheduler(chanrate=100, chanburst=100, globalrate=100, globalburst=100)
+        gate = asyncio.Event()
+        chan = FakeChannel(1, gate=gate)
+        # The first message is held up in send(), so the rest pile up.
+        futs = [ outbound.post(chan, 'one') ]
+        await asyncio.sleep(0)
+        futs.append(outbound.post(chan, 'two'))
+        futs.append(outbound.post(chan, 'three'))
+        futs.append(outbound.post(chan, 'four', coalesce=False))
+        futs.append(outbound.post(chan, 'five'))
+        futs.append(outbound.post(chan, 'six', file='x'))
+        futs.append(outbound.post(chan, 'seven'))
+        gate.set()
+        await outbound.drain(chan)
+        assert texts(chan) == [ 'one', 'two\nthree', 'four', 'five', 'six', 'seven' ]
+        assert chan.sent[4][2] == { 'file':'x' }
+        # Each future resolves to the message its text went out in.
+        assert [ fut.result() for fut in futs ] == [ 1, 2, 2, 3, 4, 5, 6 ]
+        assert outbound.stats()['coalesced'] == 1
+        assert outbound.stats()['sent'] == 6
+        assert not outbound.channels
+    asyncio.run(run())
+
+def test_coalesce_limit():
+    async def run():
+        outbound = OutboundScheduler(chanrate=100, chanburst=100, globalrate=100, globalburst=100)
+        gate = asyncio.Event()
+        chan = FakeChannel(1, gate=gate)
+        outbound.post(chan, 'first')
+        await asyncio.sleep(0)
+        big = 'x' * (MSG_LIMIT // 2)
+        for _ in range(3):
+            outbound.post(chan, big)
+        gate.set()
+        await outbound.drain(chan)
+        # Two halves don't fit in one message (with the newline).
+        assert texts(chan) == [ 'first', big, big, big ]
+        assert all([ len(text) < MSG_LIMIT for text in texts(chan) ])
+    asyncio.run(run())
+
+def test_channel_pacing():
+    async def run():
+        outbound = OutboundScheduler(chanrate=20, chanburst=2, globalrate=1000, globalburst=1000)
+        chan = FakeChannel(1)
+        start = time.monotonic()
+        for ix in range(6):
+            outbound.post(chan, 'msg%d' % (ix,), coalesce=False)
+        await outbound.drain(chan)
+        assert texts(chan) == [ 'msg%d' % (ix,) for ix in range(6) ]
+        times = [ tim - start for (tim, _, _) in chan.sent ]
+        # A burst of two, then one every 0.05 seconds.
+        assert times[1] < 0.03
+        assert times[5] >= 0.19
+        for ix in range(2, 6):
+            assert times[ix] - times[ix-1] >= 0.04
+    asyncio.run(run())
+
+def test_global_pacing():
+    async def run():
+        outbound = OutboundScheduler(chanrate=1000, chanburst=1000, globalrate=20, globalburst=2)
+        chans = [ FakeChannel(ix) for ix in range(3) ]
+        start = time.monotonic()
+        for chan in chans:
+            outbound.post(chan, 'a', coalesce=False)
+            outbound.post(chan, 'b', coalesce=False)
+        for chan in chans:
+            await outbound.drain(chan)
+        times = sorted([ tim - start for chan in chans for (tim, _, _) in chan.sent ])
+        assert len(times) == 6
+        # Six messages over all channels: two at once, four more paced.
+        assert times[5] >= 0.19
+    asyncio.run(run())
+
+def test_send_failure():
+    async def run():
+        outbound = OutboundScheduler()
+        chan = FakeChannel(1, fail=True)
+        with pytest.raises(Exception, match='send failed'):
+            await outbound.send(chan, 'hello')
+        assert outbound.stats()['failed'] == 1
+        # The channel carries on afterwards.
+        chan.fail = False
+        assert await outbound.send(chan, 'again') == 1
+    asyncio.run(run())
@@ -0,0 +1,47 @@
+import sys
+import asyncio
+
+from discoggin.scheduler import TurnScheduler
+from discoggin.procpool import Prespawner, kill_proc, wait_background
+
+# A stand-in interpreter which just waits for stdin to close.
+IARGS = [ sys.executable, '-c', 'import sys; sys.stdin.read()' ]
+
+class FakeApp:
+    def __init__(self, maxrunning):
+        self.scheduler = TurnScheduler(maxrunning=maxrunning)
+        self.prespawner = Prespawner(self, window=30)
+        self.scheduler.reclaimer = self.prespawner.reclaim
+
+def test_prespawn_holds_slot():
+    async def run():
+        app = FakeApp(maxrunning=2)
+        await app.prespawner.spawn(1, 'hash', 5, IARGS, None)
+        await app.prespawner.spawn(2, 'hash', 5, IARGS, None)
+        assert app.scheduler.running == 2
+        # No slot free, so no third process.
+        await app.prespawner.spawn(3, 'hash', 5, IARGS, None)
+        assert list(app.prespawner.map.keys()) == [ 1, 2 ]
+        # Taking a process gives back its slot.
+        proc = app.prespawner.take(1, 'hash', 5)
+        assert proc is not None
+        assert app.scheduler.running == 1
+        kill_proc(proc)
+        app.prespawner.close()
+        assert app.scheduler.running == 0
+        await wait_background()
+    asyncio.run(run())
+
+def test_turn_reclaims_prespawn_slot():
+    async def run():
+        app = FakeApp(maxrunning=1)
+        await app.prespawner.spawn(1, 'hash', 5, IARGS, None)
+        assert app.scheduler.running == 1
+        # A real turn bumps the pre-spawned process rather than waiting.
+        await asyncio.wait_for(app.scheduler.acquire(100, 200), 1)
+        assert not app.prespawner.map
+        assert app.scheduler.speculative == 0
+        assert app.scheduler.running == 1
+        app.scheduler.release()
+        await wait_background()
+    asyncio.run(run())
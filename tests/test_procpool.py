@@ -0,0 +1,46 @@
+import sys
+import asyncio
+
+from discoggin.procpool import ProcPool
+
+# A stand-in interpreter which just waits for stdin to close.
+IARGS = [ sys.executable, '-c', 'import sys; sys.stdin.read()' ]
+
+class FakeApp:
+    def __init__(self):
+        self.inflight = set()
+
+def test_pool_evicts_lru():
+    async def run():
+        app = FakeApp()
+        pool = ProcPool(app, maxprocs=2)
+        await pool.launch(1, 'hash', IARGS, None)
+        await pool.launch(2, 'hash', IARGS, None)
+        # Using session 1 makes session 2 the least recently used.
+        assert pool.get(1, 'hash') is not None
+        await pool.launch(3, 'hash', IARGS, None)
+        assert list(pool.map.keys()) == [ 1, 3 ]
+        # The wrong game means no process.
+        assert pool.get(3, 'otherhash') is None
+        assert list(pool.map.keys()) == [ 1 ]
+        await pool.close()
+    asyncio.run(run())
+
+def test_pool_never_exceeds_cap():
+    async def run():
+        app = FakeApp()
+        pool = ProcPool(app, maxprocs=2)
+        await pool.launch(1, 'hash', IARGS, None)
+        await pool.launch(2, 'hash', IARGS, None)
+        # Both are mid-turn, so neither can be evicted.
+        app.inflight.update([ 1, 2 ])
+        live = await pool.launch(3, 'hash', IARGS, None)
+        assert live is None
+        assert len(pool.map) == 2
+        # Once one is free, it's evicted to make room.
+        app.inflight.discard(1)
+        live = await pool.launch(3, 'hash', IARGS, None)
+        assert live is not None
+        assert list(pool.map.keys()) == [ 2, 3 ]
+        await pool.close()
+    asyncio.run(run())
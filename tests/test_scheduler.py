@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from discoggin.scheduler import TurnScheduler, SchedulerBusy, parse_weights
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+async def queue_turns(sched, turns):
+    """Hold the only slot, queue up the given (gid, chanid) turns, then
+    release slots one at a time. Returns the order they were granted.
+    """
+    order = []
+    async def turn(gid, chanid):
+        await sched.acquire(gid, chanid)
+        order.append( (gid, chanid) )
+    await sched.acquire('hold', 0)
+    tasks = []
+    for (gid, chanid) in turns:
+        tasks.append(asyncio.create_task(turn(gid, chanid)))
+        await settle()
+    for _ in turns:
+        sched.release()
+        await settle()
+    await asyncio.gather(*tasks)
+    return order
+
+def test_fair_across_servers():
+    async def run():
+        sched = TurnScheduler(maxrunning=1)
+        # Server A queues up four turns before B queues any.
+        turns = [ ('A', 1) ] * 4 + [ ('B', 2) ] * 2
+        order = await queue_turns(sched, turns)
+        assert [ gid for (gid, _) in order ] == [ 'A', 'B', 'A', 'B', 'A', 'A' ]
+    asyncio.run(run())
+
+def test_channels_round_robin():
+    async def run():
+        sched = TurnScheduler(maxrunning=1)
+        turns = [ ('A', 1), ('A', 1), ('A', 2) ]
+        order = await queue_turns(sched, turns)
+        assert order == [ ('A', 1), ('A', 2), ('A', 1) ]
+    asyncio.run(run())
+
+def test_weights():
+    async def run():
+        sched = TurnScheduler(maxrunning=1, weights={ 'A':2.0 })
+        turns = [ ('A', 1) ] * 6 + [ ('B', 2) ] * 6
+        order = await queue_turns(sched, turns)
+        firstsix = [ gid for (gid, _) in order[:6] ]
+        assert firstsix.count('A') == 4
+        assert firstsix.count('B') == 2
+    asyncio.run(run())
+
+def test_shedding():
+    async def run():
+        sched = TurnScheduler(maxrunning=1, maxqueued=3, maxguildqueued=2)
+        await sched.acquire('A', 1)
+        tasks = [ asyncio.create_task(sched.acquire('A', 1)) for _ in range(2) ]
+        await settle()
+        # Server A is at its limit, but B may still queue.
+        with pytest.raises(SchedulerBusy):
+            await sched.acquire('A', 1)
+        tasks.append(asyncio.create_task(sched.acquire('B', 2)))
+        await settle()
+        # Now the whole queue is full.
+        with pytest.raises(SchedulerBusy):
+            await sched.acquire('C', 3)
+        assert sched.stats()['shed'] == 2
+        assert sched.queued == 3
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert sched.queued == 0
+    asyncio.run(run())
+
+def test_parse_weights():
+    assert parse_weights('') == {}
+    assert parse_weights('123:2, 456:0.5') == { '123':2.0, '456':0.5 }
+    for val in ('123:0', '123:-1', '123', '123:x', ':2', '123:nan', '123:inf'):
+        with pytest.raises(Exception):
+            parse_weights(val)
@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+from discoggin.schema import SCHEMA_VERSION, get_schema_version, upgrade_schema
+from discoggin import schema
+
+def opendb():
+    db = sqlite3.connect(':memory:')
+    db.isolation_level = None
+    return db
+
+def columns(db, table):
+    res = db.execute('PRAGMA table_info(%s)' % (table,))
+    return [ tup[1] for tup in res.fetchall() ]
+
+def indexes(db, table):
+    res = db.execute('PRAGMA index_list(%s)' % (table,))
+    return set([ tup[1] for tup in res.fetchall() if not tup[1].startswith('sqlite_') ])
+
+def test_upgrade_new_database():
+    db = opendb()
+    assert get_schema_version(db) == 0
+    msgs = []
+    count = upgrade_schema(db, report=msgs.append)
+    assert count == SCHEMA_VERSION
+    assert len(msgs) == SCHEMA_VERSION
+    assert get_schema_version(db) == SCHEMA_VERSION
+
+    assert columns(db, 'games') == [ 'hash', 'filename', 'url', 'format' ]
+    assert columns(db, 'sessions') == [ 'sessid', 'gid', 'hash', 'movecount', 'lastupdate', 'statusmarkup', 'autosavebytes', 'savefilebytes' ]
+    assert columns(db, 'channels') == [ 'gckey', 'gid', 'chanid', 'sessid', 'statusmsgid' ]
+    assert columns(db, 'gameinfo')[0] == 'hash'
+    assert indexes(db, 'sessions') == set([ 'sessions_gid', 'sessions_hash_gid', 'sessions_lastupdate' ])
+    assert indexes(db, 'channels') == set([ 'channels_sessid', 'channels_gid' ])
+
+    # Already up to date; nothing to do.
+    assert upgrade_schema(db, report=msgs.append) == 0
+
+def test_upgrade_old_database():
+    # A database from before schema versioning.
+    db = opendb()
+    db.execute('CREATE TABLE games(hash unique, filename, url, format)')
+    db.execute('CREATE TABLE sessions(sessid unique, gid, hash, movecount, lastupdate)')
+    db.execute('CREATE TABLE channels(gckey unique, gid, chanid, sessid)')
+    db.execute('INSERT INTO games VALUES (?, ?, ?, ?)', ('abc', 'game.ulx', 'http://x/game.ulx', 'glulx'))
+    db.execute('INSERT INTO sessions VALUES (?, ?, ?, ?, ?)', (3, '100', 'abc', 7, 1000))
+    db.execute('INSERT INTO channels VALUES (?, ?, ?, ?)', ('100-200', '100', '200', 3))
+
+    upgrade_schema(db, report=lambda msg: None)
+    assert get_schema_version(db) == SCHEMA_VERSION
+
+    res = db.execute('SELECT * FROM sessions')
+    assert res.fetchall() == [ (3, '100', 'abc', 7, 1000, None, None, None) ]
+    res = db.execute('SELECT * FROM channels')
+    assert res.fetchall() == [ ('100-200', '100', '200', 3, None) ]
+    res = db.execute('SELECT * FROM games')
+    assert res.fetchall() == [ ('abc', 'game.ulx', 'http://x/game.ulx', 'glulx') ]
+
+    # New sessions are numbered after the old ones.
+    db.execute('INSERT INTO sessions (gid, hash) VALUES (?, ?)', ('100', 'abc'))
+    res = db.execute('SELECT MAX(sessid) FROM sessions')
+    assert res.fetchone()[0] == 4
+
+def test_failed_migration_rolls_back(monkeypatch):
+    def migrate_broken(curs):
+        """Fail halfway through.
+        """
+        curs.execute('CREATE TABLE extra(x)')
+        raise Exception('broken')
+    monkeypatch.setattr(schema, 'migrations', schema.migrations+[ migrate_broken ])
+    monkeypatch.setattr(schema, 'SCHEMA_VERSION', SCHEMA_VERSION+1)
+
+    db = opendb()
+    with pytest.raises(Exception, match='broken'):
+        upgrade_schema(db, report=lambda msg: None)
+    # The earlier migrations stuck; the broken one left nothing behind.
+    assert get_schema_version(db) == SCHEMA_VERSION
+    res = db.execute('SELECT name FROM sqlite_master WHERE name = ?', ('extra',))
+    assert res.fetchone() is None
+
+def test_newer_database_refused():
+    db = opendb()
+    db.execute('PRAGMA user_version = %d' % (SCHEMA_VERSION+1,))
+    with pytest.raises(Exception, match='newer'):
+        upgrade_schema(db, report=lambda msg: None)
@@ -0,0 +1,86 @@
+import json
+import struct
+
+from discoggin import sniff
+from discoggin.sniff import sniff_game
+
+def make_blorb(exectype, execdat):
+    """Build a minimal Blorb file: a resource index with one Exec entry,
+    followed by the executable chunk.
+    """
+    ridx = struct.pack('>I', 1) + struct.pack('>4sII', b'Exec', 0, 12+8+len(struct.pack('>I', 1))+12)
+    chunks = b'RIdx' + struct.pack('>I', len(ridx)) + ridx
+    chunks += exectype + struct.pack('>I', len(execdat)) + execdat
+    return b'FORM' + struct.pack('>I', 4+len(chunks)) + b'IFRS' + chunks
+
+def test_blorb(tmp_path):
+    path = tmp_path / 'game.gblorb'
+    path.write_bytes(make_blorb(b'GLUL', b'Glul' + struct.pack('>HBB', 3, 1, 3) + bytes(56)))
+    (format, info) = sniff_game('game.gblorb', str(path))
+    assert format == 'glulx'
+    assert info.blorb
+    assert info.version == '3.1.3'
+
+def test_truncated_blorb(tmp_path):
+    dat = make_blorb(b'GLUL', b'Glul' + bytes(60))
+    # Cut the file off in the middle of the resource index, and at
+    # various other points.
+    for cut in (14, 18, 22, 26, 30, 40, 50):
+        path = tmp_path / 'game.gblorb'
+        path.write_bytes(dat[:cut])
+        (format, info) = sniff_game('game.gblorb', str(path))
+        assert format is None
+
+def test_corrupt_ridx(tmp_path):
+    # The index claims more entries than the chunk holds, and an
+    # offset past the end of the file.
+    ridx = struct.pack('>I', 100) + struct.pack('>4sII', b'Exec', 0, 999999)
+    chunks = b'RIdx' + struct.pack('>I', len(ridx)) + ridx
+    path = tmp_path / 'game.gblorb'
+    path.write_bytes(b'FORM' + struct.pack('>I', 4+len(chunks)) + b'IFRS' + chunks)
+    (format, info) = sniff_game('game.gblorb', str(path))
+    assert format is None
+
+def sniff_json_text(tmp_path, text, filename='game.json'):
+    path = tmp_path / filename
+    path.write_bytes(text.encode())
+    (format, info) = sniff_game(filename, str(path))
+    return format
+
+def test_ink(tmp_path):
+    assert sniff_json_text(tmp_path, '{"inkVersion":21,"root":[],"listDefs":{}}') == 'ink'
+    # The root can come first, and be large.
+    root = [ '^Line %d with "quotes" and {braces} and [brackets]\\' % (ix,) for ix in range(20000) ]
+    text = json.dumps({ 'root':root, 'inkVersion':21 })
+    assert len(text) > sniff.SNIFF_PREFIX
+    assert sniff_json_text(tmp_path, text) == 'ink'
+    # JSONP, with a byte order mark.
+    assert sniff_json_text(tmp_path, '\ufeffvar storyContent = {"inkVersion":21,"root":[]};', filename='game.js') == 'ink'
+    # Not at the top level.
+    assert sniff_json_text(tmp_path, '{"root":{"inkVersion":21}}') is None
+    # Not a key.
+    assert sniff_json_text(tmp_path, '{"root":"inkVersion","x":["inkVersion"]}') is None
+
+def test_yarnspinner(tmp_path):
+    assert sniff_json_text(tmp_path, '{"program":{"nodes":{}},"strings":{}}') == 'ys'
+    big = { 'node%d' % (ix,): { 'text':'x' * 50 } for ix in range(5000) }
+    text = json.dumps({ 'program':{ 'nodes':big }, 'other':1, 'strings':{} })
+    assert len(text) > sniff.SNIFF_PREFIX
+    assert sniff_json_text(tmp_path, text) == 'ys'
+    # Both keys are needed, at the top level.
+    assert sniff_json_text(tmp_path, '{"program":{},"data":{"strings":{}}}') is None
+    assert sniff_json_text(tmp_path, '{"data":{"program":{},"strings":{}}}') is None
+
+def test_json_chunks(tmp_path, monkeypatch):
+    # Tiny reads, so that strings, escapes, and keys straddle chunks.
+    text = json.dumps({ 'root':[ 'a\\"b', { 'x':'}' } ], 'long\\key':'\u00e9', 'program':[], 'strings':{} })
+    for size in range(1, 12):
+        monkeypatch.setattr(sniff, 'SNIFF_PREFIX', size)
+        monkeypatch.setattr(sniff, 'SNIFF_CHUNK', size)
+        assert sniff_json_text(tmp_path, text) == 'ys'
+        assert sniff_json_text(tmp_path, text.replace('"program"', '"prog"')) is None
+
+def test_bad_json(tmp_path):
+    assert sniff_json_text(tmp_path, 'not json') is None
+    assert sniff_json_text(tmp_path, '{"root":[1,2') is None
+    assert sniff_json_text(tmp_path, '{"root":"unterminated') is None
@@ -0,0 +1,178 @@
+import os, os.path
+import asyncio
+
+from discoggin.transcript import append_stanzas, encode_stanza, transcript_paths
+from discoggin.transcript import read_transcript_tail, INDEX_ENTRY
+from discoggin.transcript import list_segments, compress_segment
+from discoggin.transcript import TranscriptWriter
+
+def glkote(num):
+    return { 'format':'glkote', 'input':'cmd%d' % (num,), 'output':{ 'gen':num } }
+
+def comment(num):
+    return { 'format':'comment', 'text':'hello %d' % (num,) }
+
+def write_moves(autosavedir, first, last, maxbytes=0):
+    """Append moves first..last (inclusive), each followed by a comment.
+    Returns whatever append_stanzas() returned last.
+    """
+    res = None
+    for num in range(first, last+1):
+        res = append_stanzas(autosavedir, [ encode_stanza(glkote(num)), encode_stanza(comment(num)) ], maxbytes=maxbytes)
+    return res
+
+def gens(stanzas):
+    return [ obj['output']['gen'] for obj in stanzas ]
+
+def test_tail(tmp_path):
+    autosavedir = str(tmp_path / 'sess')
+    assert read_transcript_tail(autosavedir, 3) is None
+    write_moves(autosavedir, 1, 20)
+    (trapath, idxpath) = transcript_paths(autosavedir)
+    # One index entry per glkote stanza; comments aren't indexed.
+    assert os.path.getsize(idxpath) == 20 * INDEX_ENTRY.size
+    assert gens(read_transcript_tail(autosavedir, 3)) == [ 18, 19, 20 ]
+    assert gens(read_transcript_tail(autosavedir, 50)) == list(range(1, 21))
+
+def test_tail_rebuilds_index(tmp_path):
+    autosavedir = str(tmp_path / 'sess')
+    write_moves(autosavedir, 1, 5)
+    (trapath, idxpath) = transcript_paths(autosavedir)
+
+    # A missing index is rebuilt.
+    os.remove(idxpath)
+    assert gens(read_transcript_tail(autosavedir, 2)) == [ 4, 5 ]
+    assert os.path.getsize(idxpath) == 5 * INDEX_ENTRY.size
+
+    # So is one that points at the wrong place.
+    with open(idxpath, 'ab') as fl:
+        fl.write(INDEX_ENTRY.pack(1))
+    assert gens(read_transcript_tail(autosavedir, 2)) == [ 4, 5 ]
+    assert os.path.getsize(idxpath) == 5 * INDEX_ENTRY.size
+
+def test_rotation(tmp_path):
+    autosavedir = str(tmp_path / 'sess')
+    res = write_moves(autosavedir, 1, 10)
+    assert res is None
+    size = os.path.getsize(transcript_paths(autosavedir)[0])
+
+    # Pass the limit; the transcript is rotated out.
+    res = write_moves(autosavedir, 11, 11, maxbytes=size+1)
+    assert [ os.path.basename(path) for path in res ] == [ 'transcript-0001.glktra' ]
+    (trapath, idxpath) = transcript_paths(autosavedir)
+    assert not os.path.exists(trapath)
+    assert not os.path.exists(idxpath)
+    assert write_moves(autosavedir, 12, 14, maxbytes=size+1) is None
+
+    # Reading the tail crosses into the old segment, before and after
+    # it's gzipped.
+    assert gens(read_transcript_tail(autosavedir, 4)) == [ 11, 12, 13, 14 ]
+    compress_segment(res[0])
+    segls = list_segments(autosavedir)
+    assert [ os.path.basename(path) for (_, path, _) in segls ] == [ 'transcript-0001.glktra.gz' ]
+    assert gens(read_transcript_tail(autosavedir, 4)) == [ 11, 12, 13, 14 ]
+    assert gens(read_transcript_tail(autosavedir, 100)) == list(range(1, 15))
+
+    # A segment left uncompressed (say, by a crash) is picked up at
+    # the next rotation.
+    res = write_moves(autosavedir, 15, 15, maxbytes=1)
+    assert [ os.path.basename(path) for path in res ] == [ 'transcript-0002.glktra' ]
+    res2 = write_moves(autosavedir, 16, 16, maxbytes=1)
+    assert [ os.path.basename(path) for path in res2 ] == [ 'transcript-0002.glktra', 'transcript-0003.glktra' ]
+    assert gens(read_transcript_tail(autosavedir, 100)) == list(range(1, 17))
+
+def test_read_tail_flushes(tmp_path):
+    autosavedir = str(tmp_path / 'sess')
+    async def run():
+        writer = TranscriptWriter(interval=60)
+        writer.start()
+        for num in range(1, 6):
+            await writer.write(autosavedir, glkote(num))
+        # Still buffered...
+        assert writer.pending_bytes(autosavedir) > 0
+        assert read_transcript_tail(autosavedir, 2) is None
+        # ...but read_tail sees it.
+        assert gens(await writer.read_tail(autosavedir, 2)) == [ 4, 5 ]
+        assert writer.pending_bytes(autosavedir) == 0
+        await writer.close()
+    asyncio.run(run())
+
+def test_writer_buffers(tmp_path):
+    dir1 = str(tmp_path / 'sess1')
+    dir2 = str(tmp_path / 'sess2')
+    async def run():
+        writer = TranscriptWriter(interval=60, maxpending=1000)
+        writer.start()
+        count = await writer.write(dir1, glkote(1))
+        assert count == len(encode_stanza(glkote(1))[1])
+        await writer.write(dir2, comment(1))
+        assert writer.pendingbytes == writer.pending_bytes(dir1) + writer.pending_bytes(dir2)
+        assert not os.path.exists(dir1)
+
+        # Flushing one session leaves the other buffered.
+        await writer.flush(dir1)
+        assert writer.pending_bytes(dir1) == 0
+        assert gens(read_transcript_tail(dir1, 5)) == [ 1 ]
+        assert not os.path.exists(dir2)
+
+        # Passing maxpending flushes everything.
+        num = 2
+        while not os.path.exists(dir2):
+            await writer.write(dir1, glkote(num))
+            num += 1
+        assert writer.pendingbytes == 0
+        assert gens(read_transcript_tail(dir1, 100)) == list(range(1, num))
+
+        # A session about to be deleted loses its buffered stanzas.
+        await writer.write(dir2, glkote(1))
+        await writer.discard(dir2)
+        assert writer.pendingbytes == 0
+        await writer.close()
+        assert read_transcript_tail(dir2, 5) == []
+    asyncio.run(run())
+
+def test_writer_flush_loop(tmp_path):
+    autosavedir = str(tmp_path / 'sess')
+    async def run():
+        writer = TranscriptWriter(interval=0.05)
+        writer.start()
+        await writer.write(autosavedir, glkote(1))
+        assert writer.pendingbytes > 0
+        await asyncio.sleep(0.3)
+        assert writer.pendingbytes == 0
+        assert gens(read_transcript_tail(autosavedir, 5)) == [ 1 ]
+        await writer.close()
+    asyncio.run(run())
+
+def test_writer_failure_is_contained(tmp_path):
+    good = str(tmp_path / 'good')
+    # A plain file where a directory should be.
+    bad = str(tmp_path / 'bad')
+    with open(bad, 'w') as fl:
+        fl.write('x')
+    async def run():
+        writer = TranscriptWriter(interval=60)
+        writer.start()
+        await writer.write(bad, glkote(1))
+        await writer.write(good, glkote(1))
+        await writer.flush()
+        assert writer.pendingbytes == 0
+        assert gens(read_transcript_tail(good, 5)) == [ 1 ]
+        await writer.close()
+    asyncio.run(run())
+
+def test_writer_rotates(tmp_path):
+    autosavedir = str(tmp_path / 'sess')
+    async def run():
+        writer = TranscriptWriter(segmentbytes=500, interval=0)
+        writer.start()
+        for num in range(1, 31):
+            await writer.write(autosavedir, glkote(num))
+        await writer.close()
+        # Every rotated segment got gzipped.
+        segls = list_segments(autosavedir)
+        assert len(segls) > 1
+        assert all([ path.endswith('.gz') for (_, path, _) in segls ])
+        assert not writer.compressing
+        assert gens(await writer.read_tail(autosavedir, 100)) == list(range(1, 31))
+    asyncio.run(run())
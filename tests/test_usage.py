@@ -0,0 +1,134 @@
+import os, os.path
+import asyncio
+import sqlite3
+
+from discoggin.schema import upgrade_schema
+from discoggin.asyncdb import DBThread, create_session, update_session_movecount, get_session_by_id
+from discoggin.objcache import ObjCache
+from discoggin.games import GameFile
+from discoggin.usage import UsageTracker
+
+class FakeTranscripts:
+    def __init__(self):
+        self.pending = {}
+
+    def pending_bytes(self, autosavedir):
+        return self.pending.get(autosavedir, 0)
+
+class FakeApp:
+    """Just enough of DiscogClient for the usage tracker.
+    """
+    def __init__(self, tmp_path, sessionquota=0, serverquota=0):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.isolation_level = None
+        upgrade_schema(self.db, report=lambda msg: None)
+        self.dbthread = DBThread()
+        self.objcache = ObjCache()
+        self.transcripts = FakeTranscripts()
+        self.inflight = set()
+        self.autosavedir = str(tmp_path / 'autosaves')
+        self.savefiledir = str(tmp_path / 'savefiles')
+        self.usage = UsageTracker(self, sessionquota=sessionquota, serverquota=serverquota)
+
+    def dirs(self, session):
+        return (os.path.join(self.autosavedir, session.sessdir), os.path.join(self.savefiledir, session.sessdir))
+
+def write_file(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fl:
+        fl.write(bytes(size))
+
+async def take_turn(app, session, delta):
+    """Do the usage bookkeeping for a turn, as the client does.
+    """
+    (autosavedir, savefiledir) = app.dirs(session)
+    oldbytes = session.diskbytes()
+    usage = await app.usage.turn_usage(session, delta, autosavedir, savefiledir)
+    await update_session_movecount(app, session, usage=usage)
+    app.usage.note_update(session, oldbytes)
+
+GAME = GameFile('abc', 'game.ulx', 'http://x/game.ulx', 'glulx')
+
+def test_turn_accounting(tmp_path):
+    async def run():
+        app = FakeApp(tmp_path)
+        session = await create_session(app, GAME, 'g1')
+        other = await create_session(app, GAME, 'g1')
+        (autosavedir, savefiledir) = app.dirs(session)
+        write_file(os.path.join(autosavedir, 'glkstate.json'), 1000)
+        write_file(os.path.join(savefiledir, 'save1.glksave'), 500)
+        app.transcripts.pending[autosavedir] = 30
+        assert await app.usage.server_total('g1') == 0
+
+        # The first turn measures the directories (and buffered stanzas).
+        await take_turn(app, session, 1000)
+        assert (session.autosavebytes, session.savefilebytes) == (1030, 500)
+        assert await app.usage.server_total('g1') == 1530
+        assert session.sessid not in app.usage.dirty
+
+        # After that, turns just add what we know about.
+        write_file(os.path.join(savefiledir, 'save2.glksave'), 700)
+        await take_turn(app, session, 100)
+        assert (session.autosavebytes, session.savefilebytes) == (1130, 500)
+        app.usage.note_transcript(session, 50)
+        assert session.autosavebytes == 1180
+        assert await app.usage.server_total('g1') == 1680
+        assert session.sessid in app.usage.dirty
+
+        # The sweep catches up with what the turns didn't see.
+        assert await app.usage.rescan_dirty(pause=0) == 1
+        assert (session.autosavebytes, session.savefilebytes) == (1030, 1200)
+        assert await app.usage.server_total('g1') == 2230
+        assert not app.usage.dirty
+
+        # The recorded figures match what's in the database, and the
+        # server total reloads to the same thing.
+        app.objcache.sessions.clear()
+        dbsession = await get_session_by_id(app, session.sessid)
+        assert (dbsession.autosavebytes, dbsession.savefilebytes) == (1030, 1200)
+        app.usage.forget('g1')
+        assert await app.usage.server_total('g1') == 2230
+        assert other.diskbytes() == 0
+
+        app.dbthread.close()
+    asyncio.run(run())
+
+def test_rescan_skips_inflight(tmp_path):
+    async def run():
+        app = FakeApp(tmp_path)
+        session = await create_session(app, GAME, 'g1')
+        await take_turn(app, session, 0)
+        await take_turn(app, session, 10)
+        app.inflight.add(session.sessid)
+        assert await app.usage.rescan_dirty(pause=0) == 0
+        assert session.sessid in app.usage.dirty
+        assert session.autosavebytes == 10
+        app.inflight.discard(session.sessid)
+        assert await app.usage.rescan_dirty(pause=0) == 1
+        assert session.autosavebytes == 0
+        app.dbthread.close()
+    asyncio.run(run())
+
+def test_quotas(tmp_path):
+    async def run():
+        app = FakeApp(tmp_path, sessionquota=1000, serverquota=1500)
+        sess1 = await create_session(app, GAME, 'g1')
+        sess2 = await create_session(app, GAME, 'g1')
+        sess3 = await create_session(app, GAME, 'g2')
+        for sess in (sess1, sess2, sess3):
+            await take_turn(app, sess, 0)
+        assert await app.usage.check(sess1) is None
+
+        await take_turn(app, sess1, 1000)
+        msg = await app.usage.check(sess1)
+        assert 'this session' in msg.lower()
+
+        # Another session on the same server is held to the server
+        # quota; one on a different server isn't.
+        assert await app.usage.check(sess2) is None
+        await take_turn(app, sess2, 600)
+        msg = await app.usage.check(sess2)
+        assert 'on this server' in msg
+        assert await app.usage.check(sess3) is None
+        app.dbthread.close()
+    asyncio.run(run())